@@ -0,0 +1,208 @@
+"""Find the number of beads at which the water structure is converged
+
+Instead of guessing bead numbers, the start is estimated from the harmonic
+criterion P > beta hbar omega_max, with omega_max the highest vibrational
+frequency of a q-TIP4P/f molecule (the O-H stretch). Starting from the
+largest power of two below that estimate, P is doubled until the H radius
+of gyration, the O-H bond length and the H-O-H angle all change by less
+than a relative tolerance between two successive runs. The smaller P of
+the last pair is the converged bead number, so no run is made with many
+more beads than needed.
+
+Runs are made with launcher.run_simulation in the pimd_T{T}_P{P}
+directories the notebooks read, and are taken from the result cache when
+they were simulated before.
+
+Example:
+    python bead_convergence.py --temperature 300 --tolerance 0.01 --total-steps 20000
+    python bead_convergence.py --estimate-only --temperature 250 300 350
+"""
+import argparse
+import json
+import math
+import os
+import sys
+
+import numpy as np
+
+from launcher import run_simulation
+from pimd_analysis import run_properties
+from qtip4pf_driver import compute_qtip4pf
+from simulation_config import DEFAULT_PARAMS, QTIP4PF, equilibrium_molecule, run_dir_name
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+HBAR = 1.054571817e-34  # J s
+KB = 1.380649e-23  # J/K
+# kcal/mol/Angstrom^2/amu to s^-2
+OMEGA2_UNIT = 4184.0 / 6.02214076e23 / 1.66053907e-27 / 1e-20
+# rad/s to cm^-1
+WAVENUMBER = 1.0 / (2.0 * math.pi * 2.99792458e10)
+
+PROPERTIES = ["rg_H", "r_OH", "theta_HOH"]
+
+
+def harmonic_frequencies(params=QTIP4PF, h=1e-4):
+    """Return the angular frequencies (rad/s) of the vibrations of one molecule
+
+    The mass-weighted Hessian is built from central differences of the
+    analytic forces; the six zero modes (translation, rotation) are dropped.
+    """
+    x0 = np.array(equilibrium_molecule(params))
+    masses = np.repeat([params["mass_O"], params["mass_H"], params["mass_H"]], 3)
+    hessian = np.empty((9, 9))
+    for i in range(9):
+        plus, minus = x0.copy().ravel(), x0.copy().ravel()
+        plus[i] += h
+        minus[i] -= h
+        hessian[i] = -(compute_qtip4pf(plus.reshape(3, 3), params=params)[1]
+                       - compute_qtip4pf(minus.reshape(3, 3), params=params)[1]).ravel() / (2 * h)
+    hessian = 0.5 * (hessian + hessian.T) / np.sqrt(np.outer(masses, masses))
+    eigenvalues = np.linalg.eigvalsh(hessian)
+    return np.sqrt(eigenvalues[-3:] * OMEGA2_UNIT)
+
+
+def estimate_nbeads(temperature, params=QTIP4PF):
+    """Return beta hbar omega_max, the harmonic estimate of the required bead number"""
+    return HBAR * harmonic_frequencies(params).max() / (KB * float(temperature))
+
+
+def starting_nbeads(temperature, factor=1.0):
+    """Return the largest power of two below factor times the harmonic estimate"""
+    estimate = max(factor * estimate_nbeads(temperature), 1.0)
+    return 2**int(math.floor(math.log2(estimate)))
+
+
+def relative_changes(previous, current):
+    """Return the relative change of every property in PROPERTIES"""
+    changes = {}
+    for key in PROPERTIES:
+        scale = abs(current[key])
+        changes[key] = abs(current[key] - previous[key]) / scale if scale > 0 else math.inf
+    return changes
+
+
+def converge_nbeads(base_params, tolerance=0.01, start=None, max_beads=256, base_dir=None, discard=0.2,
+                    use_cache=True):
+    """Double the bead number until the structural properties are converged
+
+    Args:
+        base_params: run parameters (nbeads is ignored)
+        tolerance: largest relative change of every property in PROPERTIES
+            between two successive bead numbers
+        start: first bead number (default: starting_nbeads())
+        max_beads: give up above this bead number
+        base_dir: directory for the run directories (default: repository root)
+        discard: fraction of frames dropped as equilibration
+        use_cache: take runs from the result cache when possible
+
+    Returns:
+        dict: the converged bead number (None if max_beads was reached), the
+        harmonic estimate and the properties of every run
+    """
+    base_dir = base_dir or os.path.normpath(os.path.join(SCRIPT_DIR, '..'))
+    params = dict(DEFAULT_PARAMS)
+    params.update(base_params)
+    temperature = params["temperature"]
+    nbeads = start or starting_nbeads(temperature)
+    summary = {"temperature": temperature, "tolerance": tolerance,
+               "estimate": estimate_nbeads(temperature), "converged_nbeads": None, "runs": []}
+    print(f"Harmonic estimate at {temperature} K: P = {summary['estimate']:.1f}, starting with P = {nbeads}")
+
+    previous = None
+    while nbeads <= max_beads:
+        params["nbeads"] = nbeads
+        run_dir = os.path.join(base_dir, run_dir_name(params))
+        result = run_simulation(params, run_dir, use_cache=use_cache)
+        if not result["success"]:
+            raise RuntimeError(f"Run with P = {nbeads} failed: {result.get('error', 'non-zero exit')}")
+        properties = run_properties(run_dir, discard)
+        run = {"nbeads": nbeads, "run_dir": run_dir, "cached": bool(result.get("cached")), **properties}
+        line = (f"P = {nbeads:4d}: Rg(H) = {properties['rg_H']:.4f} A, r_OH = {properties['r_OH']:.4f} A, "
+                f"theta = {properties['theta_HOH']:.2f} deg")
+        if previous is not None:
+            run["changes"] = relative_changes(previous, properties)
+            line += f", largest change {max(run['changes'].values()):.2%}"
+        print(line + (" (cached)" if run["cached"] else ""))
+        summary["runs"].append(run)
+
+        if previous is not None and max(run["changes"].values()) < tolerance:
+            summary["converged_nbeads"] = nbeads // 2
+            return summary
+        previous = properties
+        nbeads *= 2
+    return summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Find the converged bead number by doubling P")
+    parser.add_argument("--temperature", nargs="+", type=float, default=[DEFAULT_PARAMS["temperature"]],
+                        help="Temperatures in K (one convergence study each)")
+    parser.add_argument("--tolerance", type=float, default=0.01,
+                        help="Largest relative change of Rg(H), r_OH and theta_HOH (default: 1%%)")
+    parser.add_argument("--start", type=int, default=None,
+                        help="First bead number (default: from the harmonic estimate)")
+    parser.add_argument("--factor", type=float, default=1.0,
+                        help="Scale the harmonic estimate for the first bead number")
+    parser.add_argument("--max-beads", type=int, default=256)
+    parser.add_argument("--estimate-only", action="store_true",
+                        help="Only print the harmonic estimate for every temperature")
+    parser.add_argument("--timestep", type=float, default=DEFAULT_PARAMS["timestep"], help="Timestep in fs")
+    parser.add_argument("--total-steps", type=int, default=DEFAULT_PARAMS["total_steps"])
+    parser.add_argument("--stride", type=int, default=DEFAULT_PARAMS["stride"])
+    parser.add_argument("--nclients", type=int, default=DEFAULT_PARAMS["nclients"],
+                        help="Force drivers per run")
+    parser.add_argument("--driver", choices=["lammps", "numpy"], default=DEFAULT_PARAMS["driver"])
+    parser.add_argument("--boundary", choices=["periodic", "cluster"], default=DEFAULT_PARAMS["boundary"])
+    parser.add_argument("--discard", type=float, default=0.2,
+                        help="Fraction of every trajectory dropped as equilibration")
+    parser.add_argument("--base-dir", default=None,
+                        help="Directory for the run directories (default: repository root)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always simulate, even runs found in the result cache")
+    parser.add_argument("--summary", default=None,
+                        help="Write the properties of all runs to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Integral temperatures keep the notebook directory names (pimd_T300_P32)
+    temperatures = [int(t) if float(t).is_integer() else t for t in args.temperature]
+
+    if args.estimate_only:
+        print(f"Highest q-TIP4P/f frequency: {harmonic_frequencies().max() * WAVENUMBER:.0f} cm^-1")
+        for temperature in temperatures:
+            print(f"T = {temperature} K: beta hbar omega_max = {estimate_nbeads(temperature):.1f}, "
+                  f"first P = {starting_nbeads(temperature, args.factor)}")
+        return
+
+    base_params = {
+        "timestep": args.timestep,
+        "total_steps": args.total_steps,
+        "stride": args.stride,
+        "nclients": args.nclients,
+        "driver": args.driver,
+        "boundary": args.boundary,
+    }
+    summaries = []
+    for temperature in temperatures:
+        start = args.start or starting_nbeads(temperature, args.factor)
+        summary = converge_nbeads(dict(base_params, temperature=temperature), args.tolerance, start,
+                                  args.max_beads, args.base_dir, args.discard, not args.no_cache)
+        if summary["converged_nbeads"] is None:
+            print(f"T = {temperature} K: not converged up to P = {args.max_beads}")
+        else:
+            print(f"T = {temperature} K: converged at P = {summary['converged_nbeads']}")
+        summaries.append(summary)
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summaries, f, indent=2)
+
+    if any(summary["converged_nbeads"] is None for summary in summaries):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Simulation throughput and energy conservation over a matrix of settings
+
+Runs short, fixed-length simulations for every combination of the
+force-evaluation scheme (full force field on every bead, ring-polymer
+contraction (RPC) and/or multiple time stepping (MTS)), bead number,
+thermostat, dynamics mode, output stride and driver, and prints for each:
+    steps/s     MD steps per second of wall time (i-PI timesteps)
+    ns/day      simulated time per day of wall time
+    first step  seconds from the start of i-PI to the first MD step
+    drift       slope of the conserved quantity in meV/ps per atom
+    fluct.      standard deviation of the conserved quantity in meV per atom
+
+MTS runs use a timestep mts_steps times larger, so that the
+intramolecular forces are integrated with the same step as in the full
+run, and cover the same simulated time with fewer steps.
+
+--output writes the results (with the host and software versions) to a
+JSON file; a later run with --baseline compares the steps/s of every
+matching configuration with that file and exits with status 1 if any is
+more than --tolerance slower. The NumPy driver (--driver numpy) needs
+no LAMMPS installation.
+
+Example:
+    python benchmark.py --nbeads 32 --rpc-beads 8 --mts-steps 4 --total-steps 2000
+    python benchmark.py --configurations full --nbeads 8 16 32 --thermostat-mode langevin pile_l svr \\
+        --dynamics-mode nvt --driver numpy --output baseline.json
+    python benchmark.py ... --driver numpy --baseline baseline.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from launcher import run_simulation
+from property_monitor import PropertiesTail
+from simulation_config import DEFAULT_PARAMS
+
+CONFIGURATIONS = ["full", "rpc", "mts", "rpc+mts"]
+
+# Settings that identify a row when comparing with a baseline
+MATRIX_KEYS = ["configuration", "nbeads", "rpc_beads", "mts_steps", "thermostat_mode", "dynamics_mode", "stride",
+               "driver", "boundary", "nclients"]
+
+
+def configuration_params(base_params, configuration, rpc_beads, mts_steps):
+    """Return the run parameters of one configuration of CONFIGURATIONS"""
+    params = dict(base_params, rpc_beads=0, mts_steps=1)
+    if "rpc" in configuration:
+        params["rpc_beads"] = rpc_beads
+    if "mts" in configuration:
+        params["mts_steps"] = mts_steps
+        params["timestep"] = float(base_params["timestep"]) * mts_steps
+        params["total_steps"] = max(int(base_params["total_steps"]) // mts_steps, 1)
+        params["stride"] = max(int(base_params["stride"]) // mts_steps, 1)
+    return params
+
+
+def energy_conservation(run_dir, prefix="simulation"):
+    """Return the drift (meV/ps per atom) and fluctuation (meV per atom) of the conserved quantity"""
+    tail = PropertiesTail(os.path.join(run_dir, f"{prefix}.out"))
+    rows = tail.read_new()
+    with open(os.path.join(run_dir, "init.xyz")) as f:
+        natoms = int(f.readline())
+    time_ps = tail.column(rows, "time")
+    conserved = tail.column(rows, "conserved") * 1000.0 / natoms
+    drift = np.polyfit(time_ps, conserved, 1)[0] if len(rows) > 1 else float("nan")
+    return drift, float(np.std(conserved))
+
+
+def benchmark_run(params, run_dir):
+    """Run one configuration and return its speed and energy conservation"""
+    start = time.perf_counter()
+    result = run_simulation(params, run_dir)
+    wall_time = time.perf_counter() - start
+    if not result["success"]:
+        raise RuntimeError(f"Benchmark run in {run_dir} failed: {result.get('error', 'non-zero exit')}")
+    steps_per_second = 1.0 / result["timing"]["time_per_step"]
+    drift, fluctuation = energy_conservation(run_dir)
+    return {
+        "nbeads": int(params["nbeads"]),
+        "rpc_beads": int(params["rpc_beads"]),
+        "mts_steps": int(params["mts_steps"]),
+        "thermostat_mode": params["thermostat_mode"],
+        "dynamics_mode": params["dynamics_mode"],
+        "stride": int(params["stride"]),
+        "driver": params["driver"],
+        "boundary": params["boundary"],
+        "nclients": int(params["nclients"]),
+        "timestep": float(params["timestep"]),
+        "total_steps": int(params["total_steps"]),
+        "wall_time": wall_time,
+        "steps_per_second": steps_per_second,
+        "ps_per_hour": steps_per_second * float(params["timestep"]) * 3.6,
+        "ns_per_day": steps_per_second * float(params["timestep"]) * 0.0864,
+        "time_to_first_step": result["timing"].get("time_to_first_step"),
+        "drift": float(drift),
+        "fluctuation": fluctuation,
+    }
+
+
+def matrix_key(row):
+    return tuple(row[key] for key in MATRIX_KEYS)
+
+
+def print_report(rows):
+    print(f"{'configuration':>14} {'beads':>6} {'rpc':>4} {'mts':>4} {'thermostat':>10} {'mode':>4} {'stride':>6} "
+          f"{'driver':>6} {'steps/s':>9} {'ns/day':>8} {'1st step':>8} {'drift':>10} {'fluct.':>8}")
+    for row in rows:
+        first_step = row["time_to_first_step"]
+        print(f"{row['configuration']:>14} {row['nbeads']:>6} {row['rpc_beads']:>4} {row['mts_steps']:>4} "
+              f"{row['thermostat_mode']:>10} {row['dynamics_mode']:>4} {row['stride']:>6} {row['driver']:>6} "
+              f"{row['steps_per_second']:>9.2f} {row['ns_per_day']:>8.3f} "
+              f"{first_step if first_step is not None else float('nan'):>8.2f} {row['drift']:>10.4f} "
+              f"{row['fluctuation']:>8.4f}")
+
+
+def load_results(path):
+    """Return the rows of a results file written with --output"""
+    with open(path) as f:
+        results = json.load(f)
+    # Files of older versions are a plain list of rows
+    return results["runs"] if isinstance(results, dict) else results
+
+
+def compare_with_baseline(rows, baseline_rows):
+    """Compare steps/s with the baseline rows of the same configuration
+
+    Returns:
+        list: (row, baseline row, relative change) of every matching row
+    """
+    baseline = {matrix_key(row): row for row in baseline_rows if all(key in row for key in MATRIX_KEYS)}
+    comparisons = []
+    for row in rows:
+        reference = baseline.get(matrix_key(row))
+        if reference is not None:
+            change = row["steps_per_second"] / reference["steps_per_second"] - 1.0
+            comparisons.append((row, reference, change))
+    return comparisons
+
+
+def print_comparison(comparisons, tolerance):
+    """Print the comparison and return the number of regressions"""
+    regressions = 0
+    print(f"\n{'configuration':>14} {'beads':>6} {'thermostat':>10} {'mode':>4} {'stride':>6} {'driver':>6} "
+          f"{'baseline':>9} {'steps/s':>9} {'change':>8}")
+    for row, reference, change in comparisons:
+        slower = change < -tolerance
+        regressions += slower
+        print(f"{row['configuration']:>14} {row['nbeads']:>6} {row['thermostat_mode']:>10} {row['dynamics_mode']:>4} "
+              f"{row['stride']:>6} {row['driver']:>6} {reference['steps_per_second']:>9.2f} "
+              f"{row['steps_per_second']:>9.2f} {change:>+8.1%}" + ("  REGRESSION" if slower else ""))
+    return regressions
+
+
+def metadata():
+    """Return the host and software versions a benchmark ran with"""
+    return {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": platform.node(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark PIMD throughput over a matrix of settings")
+    parser.add_argument("--configurations", nargs="+", choices=CONFIGURATIONS, default=CONFIGURATIONS)
+    parser.add_argument("--nbeads", nargs="+", type=int, default=[DEFAULT_PARAMS["nbeads"]])
+    parser.add_argument("--rpc-beads", type=int, default=None,
+                        help="Contracted beads for the intermolecular forces (default: nbeads / 4)")
+    parser.add_argument("--mts-steps", type=int, default=4,
+                        help="Intramolecular steps per timestep in the MTS runs")
+    parser.add_argument("--thermostat-mode", nargs="+", default=[DEFAULT_PARAMS["thermostat_mode"]],
+                        help="Thermostats, e.g. langevin pile_g pile_l svr ggmt (used with nvt)")
+    parser.add_argument("--dynamics-mode", nargs="+", default=["nve"],
+                        help="nve shows the energy conservation of the integrator alone")
+    parser.add_argument("--stride", nargs="+", type=int, default=[10], help="Output strides")
+    parser.add_argument("--driver", nargs="+", choices=["lammps", "numpy"], default=[DEFAULT_PARAMS["driver"]],
+                        help="numpy is a built-in q-TIP4P/f driver that needs no LAMMPS")
+    parser.add_argument("--timestep", type=float, default=DEFAULT_PARAMS["timestep"],
+                        help="Timestep in fs of the intramolecular forces")
+    parser.add_argument("--total-steps", type=int, default=2000,
+                        help="Steps of the runs without MTS")
+    parser.add_argument("--temperature", type=float, default=DEFAULT_PARAMS["temperature"])
+    parser.add_argument("--nclients", type=int, default=1, help="Drivers per force-field part")
+    parser.add_argument("--boundary", choices=["periodic", "cluster"], default=DEFAULT_PARAMS["boundary"])
+    parser.add_argument("--base-dir", default=None,
+                        help="Keep the run directories here (default: a temporary directory)")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=None,
+                        help="Compare steps/s with the results in this JSON file (written by --output)")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Flag runs slower than the baseline by more than this fraction (default: 0.1)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    base_params = dict(DEFAULT_PARAMS, timestep=args.timestep, total_steps=args.total_steps,
+                       temperature=args.temperature, nclients=args.nclients, boundary=args.boundary,
+                       checkpoint_stride=0)
+    baseline_rows = None
+    if args.baseline:
+        try:
+            baseline_rows = load_results(args.baseline)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: cannot read baseline {args.baseline}: {e}")
+            sys.exit(1)
+
+    matrix = list(itertools.product(args.configurations, args.nbeads, args.thermostat_mode, args.dynamics_mode,
+                                    args.stride, args.driver))
+    rows = []
+    failed = []
+    with tempfile.TemporaryDirectory(prefix="pimd_benchmark_") as tmp:
+        base_dir = args.base_dir or tmp
+        for configuration, nbeads, thermostat_mode, dynamics_mode, stride, driver in matrix:
+            params = dict(base_params, nbeads=nbeads, thermostat_mode=thermostat_mode, dynamics_mode=dynamics_mode,
+                          stride=stride, driver=driver)
+            params = configuration_params(params, configuration, args.rpc_beads or max(nbeads // 4, 1),
+                                          args.mts_steps)
+            name = (f"benchmark_{configuration.replace('+', '_')}_P{nbeads}_{thermostat_mode}_{dynamics_mode}"
+                    f"_s{stride}_{driver}")
+            print(f"Running {name}...")
+            try:
+                rows.append(dict(benchmark_run(params, os.path.join(base_dir, name)), configuration=configuration))
+            except (RuntimeError, ValueError) as e:
+                print(f"Error: {e}")
+                failed.append(name)
+
+    if rows:
+        print_report(rows)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"metadata": metadata(), "runs": rows}, f, indent=2)
+
+    regressions = 0
+    if baseline_rows is not None:
+        comparisons = compare_with_baseline(rows, baseline_rows)
+        if comparisons:
+            regressions = print_comparison(comparisons, args.tolerance)
+        print(f"\n{len(comparisons)} of {len(rows)} runs compared with {args.baseline}, "
+              f"{regressions} slower by more than {args.tolerance:.0%}")
+    if failed:
+        print(f"{len(failed)} runs failed: {', '.join(failed)}")
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
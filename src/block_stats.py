@@ -0,0 +1,266 @@
+"""On-the-fly block averages and early termination at target error bars
+
+Successive MD samples are correlated, so the standard error of their mean
+is estimated by blocking (Flyvbjerg and Petersen): the series is averaged
+in pairs over and over, and the naive standard error of the block averages
+grows with the block size until the blocks are uncorrelated. BlockAverage
+keeps one running sum per blocking level, so every new sample costs
+O(log n) and nothing is stored. The error is the largest estimate over the
+levels that still have at least min_blocks blocks.
+
+ErrorMonitor follows a running simulation: the columns of simulation.out
+(temperature, potential, kinetic_cv, ...) and, if requested, structural
+properties of the bead trajectories (rg_H, rg_O, r_OH, theta_HOH, see
+pimd_analysis.py). Once the error of every tracked property is below its
+target it writes an EXIT file into the run directory. i-PI checks for
+this file after every step and then stops cleanly: the last step is
+written completely and a RESTART file is saved, so all outputs stay
+consistent.
+
+Targets are given as text, in the units of simulation.out (K, eV) and of
+the structural properties (Angstrom, degrees):
+    temperature=2, kinetic_cv=0.002, rg_H=0.001
+
+Example:
+    python block_stats.py ../pimd_run_1                           # errors of a finished run
+    python block_stats.py ../pimd_run_1 --targets "temperature=2" --watch 5
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from pimd_analysis import frame_properties
+from property_monitor import PropertiesTail
+from trajectory_store import open_store
+
+EXIT_FILE = "EXIT"
+STATISTICS_FILE = "statistics.json"
+PROPERTY_COLUMNS = ["temperature", "conserved", "potential", "kinetic_cv"]
+STRUCTURE_PROPERTIES = ["rg_H", "rg_O", "r_OH", "theta_HOH"]
+
+# Seconds between two updates of a running simulation
+UPDATE_INTERVAL = 5.0
+
+# Fraction of total_steps left out of the averages as equilibration
+DISCARD_FRACTION = 0.1
+
+
+def parse_targets(text):
+    """Parse "name=error, name=error" into a dict of target standard errors"""
+    targets = {}
+    for item in text.replace(";", ",").split(","):
+        if not item.strip():
+            continue
+        name, _, value = item.partition("=")
+        name = name.strip()
+        if name not in PROPERTY_COLUMNS + STRUCTURE_PROPERTIES:
+            raise ValueError(f"Unknown property '{name}' in error targets "
+                             f"(choose from {', '.join(PROPERTY_COLUMNS + STRUCTURE_PROPERTIES)})")
+        targets[name] = float(value)
+    return targets
+
+
+class BlockAverage:
+    """Streaming mean and blocking standard error of one time series"""
+
+    def __init__(self, min_blocks=16):
+        self.min_blocks = min_blocks
+        # Per level: number of blocks, sum, sum of squares, unpaired block
+        self.levels = []
+
+    def add(self, values):
+        for value in np.ravel(values):
+            value = float(value)
+            for level in self._levels():
+                level[0] += 1
+                level[1] += value
+                level[2] += value * value
+                if level[3] is None:
+                    level[3] = value
+                    break
+                value = 0.5 * (level[3] + value)
+                level[3] = None
+
+    def _levels(self):
+        """Yield the levels in order, adding new ones as the series grows"""
+        index = 0
+        while True:
+            if index == len(self.levels):
+                self.levels.append([0, 0.0, 0.0, None])
+            yield self.levels[index]
+            index += 1
+
+    @property
+    def count(self):
+        return self.levels[0][0] if self.levels else 0
+
+    @property
+    def mean(self):
+        return self.levels[0][1] / self.count if self.count else math.nan
+
+    @property
+    def error(self):
+        """Blocking estimate of the standard error of the mean (inf until min_blocks samples)"""
+        errors = []
+        for count, total, squares, _ in self.levels:
+            if count < self.min_blocks:
+                break
+            variance = max(squares / count - (total / count)**2, 0.0)
+            errors.append(math.sqrt(variance / (count - 1)))
+        return max(errors) if errors else math.inf
+
+
+class ErrorMonitor:
+    """Block averages of the tracked properties of a running simulation
+
+    update() may be called from any thread while the run is going.
+    """
+
+    def __init__(self, run_dir, targets, discard_steps=0, min_blocks=16, prefix="simulation"):
+        self.run_dir = run_dir
+        self.targets = dict(targets)
+        self.discard_steps = discard_steps
+        self.prefix = prefix
+        self.averages = {name: BlockAverage(min_blocks) for name in self.targets}
+        self.tail = PropertiesTail(os.path.join(run_dir, f"{prefix}.out"))
+        self.structure = [name for name in self.targets if name in STRUCTURE_PROPERTIES]
+        self.store = None
+        self.last_step = None
+        self.converged_step = None
+        self.exit_requested = False
+        self.lock = threading.Lock()
+
+    def _update_properties(self):
+        rows = self.tail.read_new()
+        if len(rows) == 0:
+            return
+        steps = self.tail.column(rows, "step")
+        self.last_step = int(steps[-1])
+        keep = steps >= self.discard_steps
+        for name in self.targets:
+            if name in PROPERTY_COLUMNS:
+                self.averages[name].add(self.tail.column(rows, name)[keep])
+
+    def _update_structure(self):
+        if self.store is None:
+            try:
+                self.store = open_store(self.run_dir, update=False, prefix=self.prefix)
+            except FileNotFoundError:
+                return
+        start = self.store.nframes
+        if self.store.update() == 0:
+            return
+        keep = self.store.steps(start=start) >= self.discard_steps
+        properties = frame_properties(self.store.positions(start=start), self.store.atom_names)
+        for name in self.structure:
+            self.averages[name].add(properties[name][keep])
+
+    def update(self):
+        """Read what the run has written since the last call
+
+        Returns:
+            bool: True once every tracked property has reached its target error
+        """
+        with self.lock:
+            self._update_properties()
+            if self.structure:
+                self._update_structure()
+            if self.converged_step is None and self.converged():
+                self.converged_step = self.last_step
+            return self.converged_step is not None
+
+    def converged(self):
+        return all(self.averages[name].error < target for name, target in self.targets.items())
+
+    def request_exit(self):
+        """Ask i-PI for a soft exit after the current step"""
+        with open(os.path.join(self.run_dir, EXIT_FILE), 'w') as f:
+            f.write(f"Error targets reached at step {self.converged_step}\n")
+        self.exit_requested = True
+
+    def report(self):
+        """Return the mean, error and target of every tracked property"""
+        return {name: {"mean": average.mean, "error": average.error, "target": self.targets[name],
+                       "samples": average.count}
+                for name, average in self.averages.items()}
+
+    def summary_line(self):
+        return ", ".join(f"{name} {values['mean']:.5g} +/- {values['error']:.2g}"
+                         for name, values in self.report().items())
+
+    def write(self, total_steps, steps_done=None):
+        """Write statistics.json with the averages and the steps saved by stopping early
+
+        Returns:
+            dict: the file content
+        """
+        steps_done = steps_done if steps_done is not None else self.last_step
+        statistics = {
+            "properties": {name: {key: _json_number(value) for key, value in values.items()}
+                           for name, values in self.report().items()},
+            "discard_steps": self.discard_steps,
+            "converged_step": self.converged_step,
+            "stopped_early": self.exit_requested,
+            "total_steps": int(total_steps),
+            "steps_done": steps_done,
+            "steps_saved": max(int(total_steps) - steps_done, 0) if self.exit_requested and steps_done else 0,
+        }
+        with open(os.path.join(self.run_dir, STATISTICS_FILE), 'w') as f:
+            json.dump(statistics, f, indent=2)
+        return statistics
+
+
+def _json_number(value):
+    """JSON has no inf or nan; unknown errors are written as null"""
+    return None if isinstance(value, float) and not math.isfinite(value) else value
+
+
+def remove_exit_file(run_dir):
+    """Remove an EXIT file left by an earlier run, which would stop i-PI at once"""
+    try:
+        os.remove(os.path.join(run_dir, EXIT_FILE))
+    except FileNotFoundError:
+        pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Block-averaged means and standard errors of a PIMD run")
+    parser.add_argument("run_dir")
+    parser.add_argument("--targets", default=None,
+                        help="Tracked properties and target errors, e.g. \"temperature=2, rg_H=0.001\" "
+                             "(default: temperature, potential and kinetic_cv without targets)")
+    parser.add_argument("--discard-steps", type=int, default=0, help="Equilibration steps left out")
+    parser.add_argument("--watch", type=float, default=None, metavar="SECONDS",
+                        help="Follow a running simulation and stop it once every target is reached")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.targets:
+        targets = parse_targets(args.targets)
+    elif args.watch is not None:
+        print("Error: --watch needs --targets")
+        sys.exit(1)
+    else:
+        targets = {name: 0.0 for name in ("temperature", "potential", "kinetic_cv")}
+    monitor = ErrorMonitor(args.run_dir, targets, args.discard_steps)
+    try:
+        while True:
+            converged = monitor.update()
+            print(f"step {monitor.last_step}: {monitor.summary_line()}")
+            if args.watch is None:
+                break
+            if converged:
+                monitor.request_exit()
+                print(f"All targets reached at step {monitor.converged_step}, asked i-PI to stop")
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,271 @@
+"""Run a grid of PIMD simulations concurrently
+
+Every point of the parameter grid becomes one i-PI/LAMMPS pair with its own
+socket and its own run directory (named like the pimd_T{temp}_P{P}
+directories the analysis notebooks read). Runs are spread over a bounded
+process pool so that a large node stays busy without being oversubscribed.
+
+Example:
+    python campaign.py --temperature 250 300 350 --nbeads 1 8 16 32 --max-workers 16
+
+Scaling of the wall time per step with the number of LAMMPS drivers per run:
+    python campaign.py --nbeads 8 16 32 64 --nclients 1 2 4 8 --total-steps 2000 --max-workers 1
+
+Runs that were simulated before with the same configuration are copied
+from the result cache (see result_cache.py) unless --no-cache is given.
+
+Drivers on another node over TCP (every run gets its own free port):
+    python campaign.py --socket-mode inet --host $(hostname) --driver-command "ssh node01 cd {run_dir} && {command}"
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from checkpoint import latest_checkpoint
+from launcher import run_simulation
+from result_cache import NON_PHYSICAL_KEYS
+from run_metrics import METRICS_FORMATS
+from simulation_config import DEFAULT_PARAMS, run_dir_name
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def expand_grid(grid, base_params=None):
+    """Expand a {parameter: [values]} grid into a list of parameter dicts"""
+    base = dict(DEFAULT_PARAMS)
+    base.update(base_params or {})
+
+    keys = list(grid)
+    runs = []
+    for values in itertools.product(*(grid[key] for key in keys)):
+        params = dict(base)
+        params.update(zip(keys, values))
+        runs.append(params)
+    return runs
+
+
+def default_max_workers(nclients=1):
+    """Number of concurrent runs that keeps every core busy
+
+    Each run is an i-PI server plus nclients LAMMPS drivers, so every run
+    is given 1 + nclients cores.
+    """
+    return max(1, (os.cpu_count() or 1) // (1 + nclients))
+
+
+def scaling_report(results):
+    """Return the speedup of every run over the same run with fewest drivers
+
+    Runs are grouped by their physical parameters, leaving out nclients,
+    the transport (socket mode, host and the port of every run) and the
+    other settings that do not change the trajectory (see
+    result_cache.NON_PHYSICAL_KEYS); within a group the run with the
+    fewest drivers is the reference.
+
+    Returns:
+        list of dicts with nbeads, nclients, time_per_step and speedup
+    """
+    groups = {}
+    for result in results:
+        if "timing" not in result:
+            continue
+        params = {k: v for k, v in result["params"].items() if k not in NON_PHYSICAL_KEYS}
+        key = json.dumps(params, sort_keys=True)
+        groups.setdefault(key, []).append(result["timing"])
+
+    rows = []
+    for timings in groups.values():
+        timings.sort(key=lambda t: t["nclients"])
+        reference = timings[0]["time_per_step"]
+        for timing in timings:
+            rows.append(dict(timing, speedup=reference / timing["time_per_step"]))
+    rows.sort(key=lambda r: (r["nbeads"], r["nclients"]))
+    return rows
+
+
+def print_scaling_report(rows):
+    """Print the table returned by scaling_report"""
+    print(f"{'beads':>6} {'clients':>8} {'s/step':>10} {'speedup':>8}")
+    for row in rows:
+        print(f"{row['nbeads']:>6} {row['nclients']:>8} {row['time_per_step']:>10.4f} {row['speedup']:>8.2f}")
+
+
+def run_campaign(grid, base_dir=None, base_params=None, max_workers=None, resume=False, use_cache=True):
+    """Run every point of grid and return the list of run results
+
+    Args:
+        grid: dict mapping parameter names to lists of values
+        base_dir: directory in which the run directories are created
+            (default: the parent of src/, like the GUI)
+        base_params: values for the parameters that are not varied
+        max_workers: maximum number of simultaneous runs
+        resume: skip finished runs (with a timing.json) and continue
+            interrupted ones from their last checkpoint
+        use_cache: copy runs found in the result cache instead of
+            repeating them, and add new runs to the cache
+    """
+    base_dir = base_dir or os.path.normpath(os.path.join(SCRIPT_DIR, '..'))
+    # A split force field (contraction or MTS) has drivers for both parts
+    split = max(grid.get("rpc_beads", [0])) > 0 or max(grid.get("mts_steps", [1])) > 1
+    max_workers = max_workers or default_max_workers(max(grid.get("nclients", [1])) * (2 if split else 1))
+
+    # Parameters other than T and P are only part of the name if they vary
+    extra_keys = [key for key in grid
+                  if key not in ("temperature", "nbeads") and len(grid[key]) > 1]
+
+    runs = expand_grid(grid, base_params)
+    print(f"Running {len(runs)} simulations with at most {max_workers} at a time")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for params in runs:
+            run_dir = os.path.join(base_dir, run_dir_name(params, extra_keys))
+            resume_run = False
+            if resume:
+                if os.path.exists(os.path.join(run_dir, "timing.json")):
+                    print(f"{os.path.basename(run_dir)}: already finished")
+                    continue
+                resume_run = latest_checkpoint(run_dir) is not None
+            futures[executor.submit(run_simulation, params, run_dir, resume=resume_run,
+                                    use_cache=use_cache)] = run_dir
+
+        for future in as_completed(futures):
+            run_dir = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"run_dir": run_dir, "success": False, "error": str(e)}
+            status = "done" if result["success"] else f"FAILED ({result.get('error', 'non-zero exit')})"
+            if result.get("cached"):
+                status = f"taken from the cache ({os.path.basename(result['cache_dir'])[:12]})"
+            if result.get("timing", {}).get("steps_saved"):
+                status += f" (error targets reached, {result['timing']['steps_saved']} steps saved)"
+            if result.get("start_step"):
+                status += f" (resumed from step {result['start_step']})"
+            first_step = result.get("timing", {}).get("time_to_first_step")
+            startup = f", first step after {first_step:.2f} s" if first_step is not None else ""
+            print(f"{os.path.basename(run_dir)}: {status} in {result.get('wall_time', 0.0):.1f} s{startup}")
+            results.append(result)
+
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run a (T, P) grid of PIMD simulations concurrently")
+    parser.add_argument("--temperature", nargs="+", type=float, default=[DEFAULT_PARAMS["temperature"]],
+                        help="Temperatures in K")
+    parser.add_argument("--nbeads", nargs="+", type=int, default=[DEFAULT_PARAMS["nbeads"]],
+                        help="Numbers of beads")
+    parser.add_argument("--timestep", nargs="+", type=float, default=[DEFAULT_PARAMS["timestep"]],
+                        help="Timesteps in fs")
+    parser.add_argument("--total-steps", nargs="+", type=int, default=[DEFAULT_PARAMS["total_steps"]])
+    parser.add_argument("--stride", nargs="+", type=int, default=[DEFAULT_PARAMS["stride"]])
+    parser.add_argument("--tau", nargs="+", type=float, default=[DEFAULT_PARAMS["tau"]],
+                        help="Thermostat time constants in fs")
+    parser.add_argument("--dynamics-mode", nargs="+", default=[DEFAULT_PARAMS["dynamics_mode"]])
+    parser.add_argument("--thermostat-mode", nargs="+", default=[DEFAULT_PARAMS["thermostat_mode"]])
+    parser.add_argument("--nclients", nargs="+", type=int, default=[DEFAULT_PARAMS["nclients"]],
+                        help="Numbers of force drivers per run")
+    parser.add_argument("--driver", nargs="+", choices=["lammps", "numpy"], default=[DEFAULT_PARAMS["driver"]],
+                        help="Force drivers (LAMMPS or the NumPy q-TIP4P/f driver)")
+    parser.add_argument("--boundary", nargs="+", choices=["periodic", "cluster"], default=[DEFAULT_PARAMS["boundary"]],
+                        help="Periodic box with PPPM, or isolated molecule/cluster with direct Coulomb")
+    parser.add_argument("--rpc-beads", nargs="+", type=int, default=[DEFAULT_PARAMS["rpc_beads"]],
+                        help="Contracted beads for the intermolecular forces (0: all beads)")
+    parser.add_argument("--mts-steps", nargs="+", type=int, default=[DEFAULT_PARAMS["mts_steps"]],
+                        help="Intramolecular steps per timestep (1: no multiple time stepping)")
+    parser.add_argument("--nmolecules", nargs="+", type=int, default=[DEFAULT_PARAMS["nmolecules"]],
+                        help="Water molecules; more than one fills a periodic box at --density (see water_box.py)")
+    parser.add_argument("--density", type=float, default=DEFAULT_PARAMS["density"],
+                        help="Density of the water box in g/cm^3")
+    parser.add_argument("--socket-mode", choices=["unix", "inet"], default=DEFAULT_PARAMS["socket_mode"],
+                        help="unix sockets, or TCP with a free port per run (needed for --driver-command)")
+    parser.add_argument("--host", default=DEFAULT_PARAMS["host"],
+                        help="Address i-PI listens on in inet mode; must be reachable from the driver nodes")
+    parser.add_argument("--driver-command", default=DEFAULT_PARAMS["driver_command"],
+                        help="Template to start drivers elsewhere, e.g. \"ssh node01 cd {run_dir} && {command}\"")
+    parser.add_argument("--base-dir", default=None,
+                        help="Directory for the run directories (default: repository root)")
+    parser.add_argument("--max-workers", type=int, default=None,
+                        help="Maximum number of simultaneous runs (default: CPU count / (1 + nclients))")
+    parser.add_argument("--checkpoint-stride", type=int, default=DEFAULT_PARAMS["checkpoint_stride"],
+                        help="Steps between i-PI checkpoints (0: none)")
+    parser.add_argument("--target-errors", default=DEFAULT_PARAMS["target_errors"],
+                        help="Stop every run once these block-averaged errors are reached, "
+                             "e.g. \"temperature=2, kinetic_cv=0.002\" (see block_stats.py)")
+    parser.add_argument("--write-forces", action="store_true",
+                        help="Also write the bead forces, for the centroid-virial estimator (see virial_estimator.py)")
+    parser.add_argument("--metrics-format", choices=METRICS_FORMATS, default=DEFAULT_PARAMS["metrics_format"],
+                        help="Per-run progress metrics file: Prometheus textfile, CSV or none (see run_metrics.py)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile i-PI and the drivers of every run, written to profiles/ (see profiling.py)")
+    parser.add_argument("--chunk-frames", type=int, default=DEFAULT_PARAMS["chunk_frames"],
+                        help="Compress the trajectories into gzip chunks of this many frames during every run "
+                             "(0: plain XYZ files, see trajectory_chunks.py)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip finished runs and continue interrupted ones from their last checkpoint")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always simulate, even runs found in the result cache")
+    parser.add_argument("--summary", default=None,
+                        help="Write the run results to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Integral temperatures keep the notebook directory names (pimd_T300_P32)
+    temperatures = [int(t) if float(t).is_integer() else t for t in args.temperature]
+    grid = {
+        "temperature": temperatures,
+        "nbeads": args.nbeads,
+        "timestep": args.timestep,
+        "total_steps": args.total_steps,
+        "stride": args.stride,
+        "tau": args.tau,
+        "dynamics_mode": args.dynamics_mode,
+        "thermostat_mode": args.thermostat_mode,
+        "nclients": args.nclients,
+        "driver": args.driver,
+        "boundary": args.boundary,
+        "rpc_beads": args.rpc_beads,
+        "mts_steps": args.mts_steps,
+        "nmolecules": args.nmolecules,
+    }
+    base_params = {
+        "socket_mode": args.socket_mode,
+        "host": args.host,
+        "driver_command": args.driver_command,
+        "checkpoint_stride": args.checkpoint_stride,
+        "target_errors": args.target_errors,
+        "write_forces": int(args.write_forces),
+        "metrics_format": args.metrics_format,
+        "profile": int(args.profile),
+        "chunk_frames": args.chunk_frames,
+        "density": args.density,
+    }
+    # nclients does not change the result, so a scaling study would only
+    # find its own first run in the cache; a cached run has nothing to profile
+    use_cache = not args.no_cache and not args.profile and len(args.nclients) == 1
+    results = run_campaign(grid, args.base_dir, base_params, max_workers=args.max_workers, resume=args.resume,
+                           use_cache=use_cache)
+
+    if len(args.nclients) > 1:
+        print_scaling_report(scaling_report(results))
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = [r for r in results if not r["success"]]
+    if failed:
+        print(f"{len(failed)} of {len(results)} runs failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
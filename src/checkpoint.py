@@ -0,0 +1,168 @@
+"""Restart an interrupted i-PI run from its latest checkpoint
+
+i-PI writes <prefix>.chk every checkpoint_stride steps (see
+build_input_xml) and a RESTART file when it stops cleanly. Both are
+complete i-PI inputs holding the positions, momenta, thermostat and random
+number generator state, so a resumed run continues exactly the trajectory
+the interrupted run would have produced.
+
+Resuming a run directory:
+    1. prepare_resume() picks the newest checkpoint, writes restart.xml
+       with the socket of the new run and moves the existing outputs
+       aside to <file>.prev
+    2. i-PI is started with restart.xml and writes fresh output files
+    3. merge_outputs() cuts every .prev file just before the first step of
+       the new output and appends the new output to it, so each output is
+       again one continuous file without repeated steps
+"""
+import glob
+import os
+import re
+import shutil
+import xml.etree.ElementTree as ET
+
+from simulation_config import forcefield_part, part_socket_name
+from trajectory_chunks import expand_run
+from trajectory_store import store_dir
+
+RESTART_INPUT = "restart.xml"
+PREV_SUFFIX = ".prev"
+STEP_PATTERN = re.compile(rb"Step:\s*(\d+)")
+
+
+def checkpoint_step(path):
+    """Return the MD step stored in an i-PI checkpoint or RESTART file"""
+    try:
+        step = ET.parse(path).getroot().find("step")
+    except (OSError, ET.ParseError):
+        return None
+    return int(step.text) if step is not None else 0
+
+
+def latest_checkpoint(run_dir, prefix="simulation"):
+    """Return (path, step) of the newest checkpoint in run_dir, or None"""
+    found = []
+    for path in (os.path.join(run_dir, f"{prefix}.chk"), os.path.join(run_dir, "RESTART")):
+        step = checkpoint_step(path) if os.path.exists(path) else None
+        if step is not None:
+            found.append((step, path))
+    if not found:
+        return None
+    step, path = max(found)
+    return path, step
+
+
+def write_restart_input(checkpoint, run_dir, socket_name, socket_mode="unix", host="localhost", port=0):
+    """Write restart.xml: the checkpoint with the socket addresses of the new run"""
+    tree = ET.parse(checkpoint)
+    for ffsocket in tree.getroot().iter("ffsocket"):
+        ffsocket.set("mode", socket_mode)
+        address = ffsocket.find("address")
+        part = forcefield_part(ffsocket.get("name", ""))
+        address.text = host if socket_mode == "inet" else part_socket_name(socket_name, part)
+        if socket_mode == "inet":
+            ffsocket.find("port").text = str(port)
+    path = os.path.join(run_dir, RESTART_INPUT)
+    tree.write(path)
+    return path
+
+
+def output_files(run_dir, prefix="simulation"):
+    """Return the property and trajectory files i-PI writes for prefix"""
+    files = glob.glob(os.path.join(run_dir, f"{prefix}.out"))
+    files += glob.glob(os.path.join(run_dir, f"{prefix}.*.xyz"))
+    return sorted(files)
+
+
+def _properties_cut(f, first_new_step):
+    """Return the offset of the first row at or after first_new_step (or of a torn last line)"""
+    offset = 0
+    for line in f:
+        if not line.endswith(b"\n"):
+            return offset
+        if not line.startswith(b"#") and line.strip():
+            if int(float(line.split()[0])) >= first_new_step:
+                return offset
+        offset += len(line)
+    return offset
+
+
+def _xyz_cut(f, first_new_step):
+    """Return the offset of the first frame at or after first_new_step (or of a torn last frame)"""
+    offset = 0
+    while True:
+        count = f.readline()
+        if not count.endswith(b"\n"):
+            return offset
+        comment = f.readline()
+        atoms = [f.readline() for _ in range(int(count))]
+        if not all(line.endswith(b"\n") for line in [comment] + atoms):
+            return offset
+        step = STEP_PATTERN.search(comment)
+        if step and int(step.group(1)) >= first_new_step:
+            return offset
+        offset += len(count) + len(comment) + sum(len(line) for line in atoms)
+
+
+def _first_step(path):
+    """Return the first step in a property or XYZ file, or None if it has none"""
+    with open(path, 'rb') as f:
+        for line in f:
+            if path.endswith(".xyz"):
+                step = STEP_PATTERN.search(line)
+                if step:
+                    return int(step.group(1))
+            elif not line.startswith(b"#") and line.strip() and line.endswith(b"\n"):
+                return int(float(line.split()[0]))
+    return None
+
+
+def merge_outputs(run_dir, prefix="simulation"):
+    """Join every <file>.prev with the output written since the resume
+
+    Returns:
+        list: the merged files
+    """
+    merged = []
+    for prev in sorted(glob.glob(os.path.join(run_dir, f"{prefix}.*{PREV_SUFFIX}"))):
+        path = prev[:-len(PREV_SUFFIX)]
+        first_new_step = _first_step(path) if os.path.exists(path) else None
+        if first_new_step is not None:
+            with open(prev, 'rb') as f:
+                cut = _xyz_cut(f, first_new_step) if path.endswith(".xyz") else _properties_cut(f, first_new_step)
+            with open(prev, 'r+b') as out, open(path, 'rb') as new:
+                out.truncate(cut)
+                out.seek(cut)
+                if path.endswith(".xyz"):
+                    shutil.copyfileobj(new, out, 1 << 24)
+                else:
+                    # The new property file repeats the column header
+                    out.writelines(line for line in new if not line.startswith(b"#"))
+        os.replace(prev, path)
+        merged.append(path)
+    return merged
+
+
+def prepare_resume(run_dir, socket_name, socket_mode="unix", host="localhost", port=0, prefix="simulation"):
+    """Set up run_dir to continue from its newest checkpoint
+
+    Returns:
+        tuple: (restart input file, checkpoint step)
+    """
+    checkpoint = latest_checkpoint(run_dir, prefix)
+    if checkpoint is None:
+        raise FileNotFoundError(f"No checkpoint ({prefix}.chk or RESTART) in {run_dir}")
+    path, step = checkpoint
+
+    # A resume that was itself interrupted still has its outputs aside
+    merge_outputs(run_dir, prefix)
+    # The outputs are cut at the checkpoint as plain files (see trajectory_chunks.py)
+    expand_run(run_dir, prefix)
+    restart_file = write_restart_input(path, run_dir, socket_name, socket_mode, host, port)
+    for output in output_files(run_dir, prefix):
+        os.replace(output, output + PREV_SUFFIX)
+
+    # The converted trajectories may hold frames after the checkpoint
+    for name in ("pos", "for"):
+        shutil.rmtree(os.path.join(run_dir, store_dir(name)), ignore_errors=True)
+    return restart_file, step
@@ -0,0 +1,99 @@
+"""Bounded, batched console for the simulation GUI
+
+Any thread may call post(); lines are queued and only the Tk main loop
+touches the text widget. Every drain tick inserts all pending lines with a
+single insert, collapses runs of identical lines, caps the number of lines
+shown per tick and trims the widget to max_lines, so a long run costs the
+same to display as a short one. The complete, unfiltered output is
+streamed to a per-run log file.
+"""
+import queue
+import threading
+import tkinter as tk
+from datetime import datetime
+
+
+class ConsolePipeline:
+    """Thread-safe front end for a ScrolledText console"""
+
+    def __init__(self, root, widget, max_lines=5000, max_batch=500, interval_ms=100):
+        self.root = root
+        self.widget = widget
+        self.max_lines = max_lines
+        self.max_batch = max_batch
+        self.interval_ms = interval_ms
+        self.pending = queue.SimpleQueue()
+        self.log_lock = threading.Lock()
+        self.log_file = None
+        self.last_line = None
+        self.repeats = 0
+        self.root.after(self.interval_ms, self.drain)
+
+    def post(self, message, console=True):
+        """Queue a message for the console (from any thread)
+
+        With console=False the message only goes to the run log file.
+        """
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        with self.log_lock:
+            if self.log_file is not None:
+                self.log_file.write(f"[{timestamp}] {message}\n")
+        if console:
+            self.pending.put((timestamp, message))
+
+    def open_log(self, path, append=False):
+        """Stream all further messages to path, replacing any earlier log"""
+        with self.log_lock:
+            if self.log_file is not None:
+                self.log_file.close()
+            self.log_file = open(path, 'a' if append else 'w', buffering=1)
+
+    def close_log(self):
+        with self.log_lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+
+    def clear(self):
+        """Empty the console and drop pending lines (main thread only)"""
+        while not self.pending.empty():
+            self.pending.get_nowait()
+        self.last_line = None
+        self.repeats = 0
+        self.widget.delete(1.0, tk.END)
+
+    def _flush_repeats(self, lines):
+        if self.repeats:
+            lines.append(f"    (previous line repeated {self.repeats} more times)\n")
+            self.repeats = 0
+
+    def drain(self):
+        """Show the queued lines; reschedules itself on the Tk main loop"""
+        batch = []
+        while True:
+            try:
+                batch.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+
+        lines = []
+        if len(batch) > self.max_batch:
+            self._flush_repeats(lines)
+            lines.append(f"    ... {len(batch) - self.max_batch} lines not shown (see the run log) ...\n")
+            batch = batch[-self.max_batch:]
+            self.last_line = None
+        for timestamp, message in batch:
+            if message == self.last_line:
+                self.repeats += 1
+                continue
+            self._flush_repeats(lines)
+            self.last_line = message
+            lines.append(f"[{timestamp}] {message}\n")
+
+        if lines:
+            self.widget.insert(tk.END, "".join(lines))
+            nlines = int(self.widget.index("end-1c").split(".")[0])
+            if nlines > self.max_lines:
+                self.widget.delete("1.0", f"{nlines - self.max_lines + 1}.0")
+            self.widget.see(tk.END)
+        self.root.after(self.interval_ms, self.drain)
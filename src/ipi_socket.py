@@ -0,0 +1,265 @@
+"""Client side of the i-PI socket protocol
+
+i-PI talks to its force drivers through 12-byte ASCII headers followed by
+raw native-endian data, all in atomic units:
+
+    STATUS   -> READY / HAVEDATA / NEEDINIT
+    INIT     <- bead index (int32), length (int32), init string
+    POSDATA  <- cell (9 x f64), inverse cell (9 x f64), natoms (int32),
+                positions (3 natoms x f64)
+    GETFORCE -> FORCEREADY, energy (f64), natoms (int32),
+                forces (3 natoms x f64), virial (9 x f64),
+                extra length (int32), extra string
+    EXIT     (the driver stops)
+
+A server address is either the path of a unix socket or a (host, port)
+tuple for TCP (i-PI's inet mode), which lets drivers run on other nodes.
+
+Per-call round-trip latency of both transports:
+    python ipi_socket.py --latency
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+HEADER_SIZE = 12
+
+
+def new_socket(address):
+    """Return an unconnected stream socket for a unix path or a (host, port) tuple"""
+    if isinstance(address, tuple):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Every exchange is a few small messages; do not let Nagle's
+        # algorithm hold them back waiting for ACKs
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+    return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+
+def server_listening(address):
+    """Return True if a server accepts connections at address
+
+    The probe connection is closed straight away; i-PI drops it as a
+    disconnected client. Unlike checking for the socket file this cannot
+    succeed between bind() and listen().
+    """
+    sock = new_socket(address)
+    try:
+        sock.connect(address)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def _backoff_delays(first=0.005, maximum=0.2):
+    """Yield exponentially growing sleep times capped at maximum"""
+    delay = first
+    while True:
+        yield delay
+        delay = min(2 * delay, maximum)
+
+
+def wait_for_server(address, timeout=30, process=None):
+    """Wait until i-PI listens at address (unix socket path or (host, port))
+
+    Probes with exponential backoff (5 ms up to 0.2 s), so a server that is
+    already up is found within milliseconds. Returns False on timeout or if
+    process (the i-PI server) exits first.
+    """
+    start_time = time.time()
+    for delay in _backoff_delays():
+        if server_listening(address):
+            return True
+        if process is not None and process.poll() is not None:
+            return False
+        if time.time() - start_time > timeout:
+            return False
+        time.sleep(delay)
+
+
+def connect_server(address, timeout=30):
+    """Connect to i-PI at address (unix socket path or (host, port)), retrying with backoff until timeout"""
+    start_time = time.time()
+    for delay in _backoff_delays():
+        sock = new_socket(address)
+        try:
+            sock.connect(address)
+            return sock
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if time.time() - start_time > timeout:
+                raise TimeoutError(f"i-PI socket not available at {address} after {timeout} s")
+            time.sleep(delay)
+
+
+def send_header(sock, message):
+    sock.sendall(message.ljust(HEADER_SIZE).encode())
+
+
+def recv_exact(sock, nbytes):
+    """Receive exactly nbytes from sock"""
+    buffer = bytearray(nbytes)
+    view = memoryview(buffer)
+    received = 0
+    while received < nbytes:
+        n = sock.recv_into(view[received:], nbytes - received)
+        if n == 0:
+            raise ConnectionError("i-PI closed the connection")
+        received += n
+    return bytes(buffer)
+
+
+def recv_header(sock):
+    return recv_exact(sock, HEADER_SIZE).decode().strip()
+
+
+def recv_array(sock, dtype, count):
+    dtype = np.dtype(dtype)
+    return np.frombuffer(recv_exact(sock, dtype.itemsize * count), dtype=dtype)
+
+
+def run_client(sock, compute):
+    """Serve force requests from i-PI until it sends EXIT
+
+    Args:
+        sock: connected socket
+        compute: function (cell, positions) -> (energy, forces, virial)
+            taking and returning atomic units; cell holds the lattice
+            vectors as columns and positions has shape (natoms, 3)
+
+    Returns:
+        int: number of force evaluations served
+    """
+    initialized = False
+    have_data = False
+    nsteps = 0
+    energy = forces = virial = None
+
+    while True:
+        header = recv_header(sock)
+        if header == "STATUS":
+            if not initialized:
+                send_header(sock, "NEEDINIT")
+            elif have_data:
+                send_header(sock, "HAVEDATA")
+            else:
+                send_header(sock, "READY")
+        elif header == "INIT":
+            recv_array(sock, np.int32, 1)  # bead index
+            length = int(recv_array(sock, np.int32, 1)[0])
+            recv_exact(sock, length)
+            initialized = True
+        elif header == "POSDATA":
+            cell = recv_array(sock, np.float64, 9).reshape(3, 3).T
+            recv_array(sock, np.float64, 9)  # inverse cell
+            natoms = int(recv_array(sock, np.int32, 1)[0])
+            positions = recv_array(sock, np.float64, 3 * natoms).reshape(natoms, 3)
+            energy, forces, virial = compute(cell, positions)
+            have_data = True
+        elif header == "GETFORCE":
+            # One send per reply, so TCP sends it as one segment
+            sock.sendall(b"".join([
+                "FORCEREADY".ljust(HEADER_SIZE).encode(),
+                np.float64(energy).tobytes(),
+                np.int32(len(forces)).tobytes(),
+                np.ascontiguousarray(forces, dtype=np.float64).tobytes(),
+                np.ascontiguousarray(virial.T, dtype=np.float64).tobytes(),
+                np.int32(0).tobytes(),
+            ]))
+            have_data = False
+            nsteps += 1
+        elif header == "EXIT":
+            return nsteps
+        else:
+            raise ConnectionError(f"Unexpected message from i-PI: {header!r}")
+
+
+def _serve_force_calls(server, natoms, ncalls, times):
+    """Act like i-PI for ncalls force evaluations on the first client of server"""
+    conn, _ = server.accept()
+    with conn:
+        cell = np.eye(3) * 40.0
+        payload = b"".join([cell.tobytes(), np.linalg.inv(cell).tobytes(), np.int32(natoms).tobytes(),
+                            np.zeros(3 * natoms).tobytes()])
+        reply_size = HEADER_SIZE + 8 + 4 + 8 * 3 * natoms + 8 * 9 + 4
+        send_header(conn, "STATUS")
+        recv_header(conn)
+        conn.sendall(b"INIT".ljust(HEADER_SIZE) + np.int32(0).tobytes() + np.int32(1).tobytes() + b"\0")
+        for _ in range(ncalls):
+            start = time.perf_counter()
+            # The exchange i-PI does for every bead of every step
+            send_header(conn, "STATUS")
+            recv_header(conn)
+            conn.sendall(b"POSDATA".ljust(HEADER_SIZE) + payload)
+            send_header(conn, "STATUS")
+            recv_header(conn)
+            send_header(conn, "GETFORCE")
+            recv_exact(conn, reply_size)
+            times.append(time.perf_counter() - start)
+        send_header(conn, "EXIT")
+
+
+def measure_latency(mode, natoms=3, ncalls=2000, host="127.0.0.1"):
+    """Return the median time (s) of one force call through a socket
+
+    The server side mimics i-PI and the client is run_client with a force
+    routine that does no work, so the result is the pure transport cost per
+    bead and step.
+    """
+    if mode == "inet":
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Without this the STATUS that follows POSDATA waits for the
+        # driver's delayed ACK (about 40 ms per call on Linux)
+        server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server.bind((host, 0))
+        address = server.getsockname()
+    else:
+        address = f"/tmp/ipi_latency_{os.getpid()}"
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(address):
+            os.remove(address)
+        server.bind(address)
+    server.listen(1)
+
+    times = []
+    thread = threading.Thread(target=_serve_force_calls, args=(server, natoms, ncalls, times))
+    thread.start()
+    try:
+        zero_forces = np.zeros((natoms, 3))
+        with connect_server(address) as sock:
+            run_client(sock, lambda cell, positions: (0.0, zero_forces, np.zeros((3, 3))))
+        thread.join()
+    finally:
+        server.close()
+        if mode == "unix":
+            os.remove(address)
+    return float(np.median(times))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="i-PI socket protocol helpers")
+    parser.add_argument("--latency", action="store_true",
+                        help="Measure the per-call latency of unix and inet sockets, then exit")
+    parser.add_argument("--natoms", type=int, nargs="+", default=[3, 648],
+                        help="System sizes for --latency (default: 1 and 216 water molecules)")
+    parser.add_argument("--nbeads", type=int, default=32,
+                        help="Beads per step for the per-step latency (default: 32)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.latency:
+        # A step with one driver costs nbeads sequential force calls
+        print(f"{'natoms':>8} {'mode':>6} {'per call (us)':>14} {f'per step, {args.nbeads} beads (ms)':>26}")
+        for natoms in args.natoms:
+            for mode in ("unix", "inet"):
+                latency = measure_latency(mode, natoms)
+                print(f"{natoms:8d} {mode:>6} {latency * 1e6:14.1f} {latency * args.nbeads * 1e3:26.3f}")
@@ -0,0 +1,515 @@
+import json
+import os
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from block_stats import (DISCARD_FRACTION, STATISTICS_FILE, UPDATE_INTERVAL, ErrorMonitor, parse_targets,
+                         remove_exit_file)
+from checkpoint import checkpoint_step, merge_outputs, prepare_resume
+from ipi_socket import server_listening
+from profiling import PROFILE_DIR
+from result_cache import lookup, restore, store
+from run_metrics import run_metrics
+from trajectory_chunks import remove_run_chunks, trajectory_compressor
+from simulation_config import (FORCE_PARTS, force_parts, make_socket_name, part_socket_name, server_address,
+                               socket_path, write_run_inputs)
+from supervisor import ProcessEvent, ProcessSupervisor
+from trajectory_store import store_dir
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Force driver scripts; both speak the i-PI socket protocol
+DRIVER_SCRIPTS = {
+    "lammps": "run_lammps.py",
+    "numpy": "qtip4pf_driver.py",
+}
+
+TICK = 0.02  # seconds between the checks of the run loop while nothing happens
+SERVER_TIMEOUT = 30  # seconds for i-PI to accept connections
+PROGRESS_INTERVAL = 1.0  # seconds between progress metrics updates
+DRIVER_EXIT_TIMEOUT = 30  # seconds the drivers get to exit after i-PI
+
+
+def work_dir_path(name):
+    """Return the run directory of a working directory name: next to the .sh file, one level above src"""
+    if not name:
+        raise ValueError("Working directory name cannot be empty")
+    return os.path.normpath(os.path.join(SCRIPT_DIR, '..', name))
+
+
+def start_ipi(run_dir, socket_name, stdout=subprocess.PIPE, input_file="input.xml", profile=False):
+    """Start run_ipi.py inside run_dir and return the Popen object"""
+    env = os.environ.copy()
+    env['IPI_TIMEOUT'] = '600'  # 10 minutes timeout
+
+    command = [sys.executable, os.path.join(SCRIPT_DIR, 'run_ipi.py'), '--socket', socket_name, '--input', input_file]
+    if profile:
+        command.append('--profile')
+    return subprocess.Popen(
+        command,
+        cwd=run_dir,
+        stdout=stdout,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        bufsize=1,
+        env=env
+    )
+
+
+def remote_command(template, command, run_dir):
+    """Wrap a driver command line in a launch template
+
+    The template is split like a shell command line and {command} (the
+    quoted driver command) and {run_dir} are filled in, e.g.
+        "ssh node01 cd {run_dir} && {command}"   run on another node
+        "sh -c 'cd {run_dir} && {command}'"      local stand-in for testing
+    Remote nodes must see run_dir and the Python environment under the
+    same paths (shared file system).
+    """
+    values = {"command": shlex.join(command), "run_dir": shlex.quote(run_dir)}
+    return [token.format(**values) for token in shlex.split(template)]
+
+
+def start_driver(run_dir, socket_name, stdout=subprocess.PIPE, client_id=0, driver="lammps",
+                 boundary="periodic", socket_mode="unix", host="localhost", port=0, command_template="",
+                 part=None, profile=False):
+    """Start a force driver (see DRIVER_SCRIPTS) inside run_dir and return the Popen object
+
+    With a command_template (see remote_command) the driver is started
+    through it, e.g. on another node; this needs socket_mode "inet". With a
+    part ("intra" or "inter") the driver computes only that part of a split
+    force field and connects to its socket. profile=True writes a profile
+    of the force loop to profiles/ (see profiling.py).
+    """
+    env = os.environ.copy()
+    env['LAMMPS_IPI_TIMEOUT'] = '600'  # 10 minutes timeout
+
+    command = [sys.executable, os.path.join(SCRIPT_DIR, DRIVER_SCRIPTS[driver]),
+               '--socket', part_socket_name(socket_name, part), '--client-id', str(client_id),
+               '--boundary', boundary]
+    if part:
+        command += ['--part', part]
+    if socket_mode == "inet":
+        command += ['--mode', 'inet', '--host', host, '--port', str(port)]
+    if profile:
+        command.append('--profile')
+    if command_template:
+        command = remote_command(command_template, command, run_dir)
+
+    return subprocess.Popen(
+        command,
+        cwd=run_dir,
+        stdout=stdout,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        bufsize=1,
+        env=env
+    )
+
+
+def first_step_written(run_dir, since=0, prefix="simulation"):
+    """Return True once i-PI has written a data row to the properties file
+
+    i-PI writes the step-0 properties after the first force evaluation, so
+    this marks the end of the start-up. Files last modified before since
+    (left over from an earlier run) are ignored.
+    """
+    path = os.path.join(run_dir, f"{prefix}.out")
+    try:
+        if os.path.getmtime(path) < since:
+            return False
+        with open(path, 'rb') as f:
+            return any(line.strip() and not line.startswith(b"#") for line in f.read(65536).split(b"\n")[:-1])
+    except OSError:
+        return False
+
+
+def port_lock_file(port):
+    return os.path.join(tempfile.gettempdir(), f"ipi_port_{port}.lock")
+
+
+def _lock_is_stale(lock_file):
+    """Return True if the process that wrote lock_file no longer exists"""
+    try:
+        with open(lock_file) as f:
+            pid = int(f.read())
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except (OSError, ValueError):
+        return False
+    return False
+
+
+def allocate_port(host="localhost", attempts=100):
+    """Reserve a free TCP port for the i-PI server of one run
+
+    The kernel picks a port that is free right now; a lock file then keeps
+    concurrent runs from taking the same port before i-PI has bound it.
+    Release the port with release_port() when the run is over.
+    """
+    for _ in range(attempts):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind((host, 0))
+            port = sock.getsockname()[1]
+        lock_file = port_lock_file(port)
+        if os.path.exists(lock_file) and _lock_is_stale(lock_file):
+            os.remove(lock_file)
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        return port
+    raise RuntimeError(f"Could not reserve a free port on {host}")
+
+
+def release_port(port):
+    try:
+        os.remove(port_lock_file(port))
+    except FileNotFoundError:
+        pass
+
+
+def clean_run_dir(run_dir):
+    """Remove the results of an earlier run before a new run starts in run_dir
+
+    A timing.json would mark the new run as finished, an EXIT file would
+    stop it at once, the trajectory stores would hold the old frames and
+    old profiles and trajectory chunks would be mistaken for those of the
+    new run.
+    """
+    for name in ("timing.json", STATISTICS_FILE):
+        try:
+            os.remove(os.path.join(run_dir, name))
+        except FileNotFoundError:
+            pass
+    remove_exit_file(run_dir)
+    for name in ("pos", "for"):
+        shutil.rmtree(os.path.join(run_dir, store_dir(name)), ignore_errors=True)
+    shutil.rmtree(os.path.join(run_dir, PROFILE_DIR), ignore_errors=True)
+    remove_run_chunks(run_dir)
+
+
+def error_monitor(params, run_dir):
+    """Return an ErrorMonitor for the target_errors of params, or None if there are none"""
+    targets = parse_targets(str(params.get("target_errors", "")))
+    if not targets:
+        return None
+    return ErrorMonitor(run_dir, targets, int(DISCARD_FRACTION * int(params["total_steps"])))
+
+
+def remove_socket(socket_name):
+    """Remove the stale socket files of a run (one per force-field part), ignoring files that are already gone"""
+    for part in (None,) + FORCE_PARTS:
+        try:
+            os.remove(socket_path(part_socket_name(socket_name, part)))
+        except FileNotFoundError:
+            pass
+
+
+def driver_parts(params):
+    """Return (client_id, part) for every driver of a run
+
+    Every force-field part gets params["nclients"] drivers; the client ids
+    run on across the parts so that every driver has its own files.
+    """
+    nclients = int(params.get("nclients", 1))
+    return [(index * nclients + client, part)
+            for index, part in enumerate(force_parts(params)) for client in range(nclients)]
+
+
+def stop_processes(processes, timeout=5):
+    """Terminate every process that is still running"""
+    for process in processes:
+        if process and process.poll() is None:
+            try:
+                process.terminate()
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def write_timing(run_dir, params, nclients, drivers_started, finished, ipi_started=None, first_step=None,
+                 start_step=0, last_step=None):
+    """Write timing.json for a finished run and return its content
+
+    The time per step is measured from the start of the drivers to the exit
+    of i-PI, so the i-PI start-up is not included. When the start of i-PI is
+    given, the time until the server listened and until the first MD step
+    are recorded as well. A resumed run only did the steps after start_step,
+    and a run that stopped early (see block_stats.py) only those up to
+    last_step.
+    """
+    elapsed = finished - drivers_started
+    total_steps = int(params["total_steps"])
+    last_step = total_steps if last_step is None else min(last_step, total_steps)
+    steps = max(last_step - start_step, 1)
+    timing = {
+        "nbeads": int(params["nbeads"]),
+        "nclients": int(nclients),
+        "total_steps": int(params["total_steps"]),
+        "elapsed": elapsed,
+        "time_per_step": elapsed / steps,
+    }
+    if start_step:
+        timing["start_step"] = start_step
+    if last_step < total_steps:
+        timing["steps_done"] = last_step
+        timing["steps_saved"] = total_steps - last_step
+    if ipi_started is not None:
+        timing["server_startup"] = drivers_started - ipi_started
+        if first_step is not None:
+            timing["time_to_first_step"] = first_step - ipi_started
+    with open(os.path.join(run_dir, 'timing.json'), 'w') as f:
+        json.dump(timing, f, indent=2)
+    return timing
+
+
+def driver_log_name(client_id):
+    """Return the stdout log file name of one driver"""
+    return f"driver_stdout.{client_id}.log" if client_id else "driver_stdout.log"
+
+
+def cached_result(params, run_dir):
+    """Copy a cached run with the same configuration into run_dir
+
+    Returns:
+        dict: the result of the cached run (see run_simulation), or None
+    """
+    entry_dir = lookup(params)
+    if entry_dir is None:
+        return None
+    clean_run_dir(run_dir)
+    restore(os.path.basename(entry_dir), run_dir)
+    result = {"run_dir": run_dir, "params": dict(params), "start_step": 0, "cached": True,
+              "cache_dir": entry_dir, "wall_time": 0.0, "success": True}
+    try:
+        with open(os.path.join(run_dir, 'timing.json')) as f:
+            result["timing"] = json.load(f)
+    except (OSError, ValueError):
+        pass
+    return result
+
+
+def run_simulation(params, run_dir, socket_name=None, resume=False, use_cache=False, on_event=None,
+                   stop_event=None):
+    """Run one i-PI/LAMMPS pair to completion; the core of the GUI, pimd_cli.py and campaign.py
+
+    All inputs and outputs (including the stdout of every process) are
+    written to run_dir, and the socket name is unique to this run, so any
+    number of runs can execute side by side. params["nclients"] force
+    drivers of type params["driver"] connect to the server so that i-PI can spread the beads over
+    them. With resume=True the run continues from the newest checkpoint in
+    run_dir (see checkpoint.py) instead of starting over. If
+    params["target_errors"] is set, the run stops as soon as the block
+    averaged errors reach these targets (see block_stats.py). With
+    use_cache=True a run found in the result cache (see result_cache.py) is
+    copied into run_dir instead of being simulated again, and every
+    successful run is added to the cache. With params["chunk_frames"] the
+    trajectories are compressed into gzip chunks while the run goes on (see
+    trajectory_chunks.py).
+
+    on_event(event) is called in the calling thread with every output line
+    and exit of the processes (see supervisor.ProcessEvent) and with events
+    of the run itself, named "run": kind "status" (a message), "started"
+    (the drivers were started) and "progress" (text is the status line of
+    the progress metrics, see run_metrics.py). Setting stop_event (a
+    threading.Event) stops the processes; result["stopped"] is then True.
+
+    Returns:
+        dict: run directory, exit codes, wall time and timing.json content
+    """
+    def notify(kind, text):
+        if on_event is not None:
+            on_event(ProcessEvent(kind, "run", text, None, time.time()))
+
+    run_dir = os.path.abspath(run_dir)
+    if use_cache and not resume:
+        result = cached_result(params, run_dir)
+        if result is not None:
+            notify("status", f"Loaded the cached result {os.path.basename(result['cache_dir'])[:12]} into "
+                             f"{run_dir}; no simulation needed")
+            return result
+    socket_name = socket_name or make_socket_name()
+    params = dict(params)
+    socket_mode = params.get("socket_mode", "unix")
+    if params.get("driver_command") and socket_mode != "inet":
+        raise ValueError("Drivers started through driver_command need socket_mode 'inet'")
+    monitor = error_monitor(params, run_dir)
+    metrics = None
+    compressor = trajectory_compressor(params, run_dir)
+    allocated_port = None
+    if socket_mode == "inet" and int(params.get("port", 0)) == 0:
+        allocated_port = allocate_port(params.get("host", "localhost"))
+        params["port"] = allocated_port
+    start_step = 0
+    if resume:
+        try:
+            input_file, start_step = prepare_resume(run_dir, socket_name, socket_mode,
+                                                    params.get("host", "localhost"), params.get("port", 0))
+        except Exception:
+            if allocated_port is not None:
+                release_port(allocated_port)
+            raise
+        notify("status", f"Resuming {run_dir} from the checkpoint at step {start_step}")
+    else:
+        write_run_inputs(params, run_dir, socket_name)
+        input_file = "input.xml"
+        clean_run_dir(run_dir)
+    remove_exit_file(run_dir)
+    remove_socket(socket_name)
+
+    nclients = int(params.get("nclients", 1))
+    driver = params.get("driver", "lammps")
+    driver_name = "LAMMPS" if driver == "lammps" else "NumPy"
+
+    start_time = time.time()
+    processes = []
+    supervisor = None
+    logs = {}
+    result = {"run_dir": run_dir, "socket": socket_name, "params": dict(params), "start_step": start_step}
+    try:
+        # One supervisor reads the output of all processes into their log
+        # files, so no pipe can fill up and block a process
+        supervisor = ProcessSupervisor()
+        logs["I-PI"] = open(os.path.join(run_dir, 'ipi_stdout.log'), 'a' if resume else 'w', buffering=1)
+        ipi_started = time.time()
+        profile = bool(int(params.get("profile", 0)))
+        ipi_process = start_ipi(run_dir, socket_name, input_file=input_file, profile=profile)
+        processes.append(ipi_process)
+        supervisor.add("I-PI", ipi_process)
+        notify("status", "Started I-PI, waiting for it to accept connections...")
+        # A resumed run is compressed once its output is merged with the earlier one
+        if compressor is not None and not resume:
+            compressor.start()
+
+        addresses = [server_address(params, socket_name, part) for part in force_parts(params)]
+        drivers = None
+        drivers_started = first_step = ipi_finished = None
+        next_update = next_progress = time.time()
+        # i-PI stops the drivers once total_steps have been done; a driver
+        # that fails before that ends the run at once instead of leaving
+        # i-PI waiting for forces until its timeout
+        for event in supervisor.events(timeout=TICK):
+            now = time.time()
+            if stop_event is not None and stop_event.is_set():
+                result["stopped"] = True
+                break
+            if event is not None:
+                if event.kind == "output":
+                    logs[event.name].write(event.text + "\n")
+                elif event.name == "I-PI" and drivers is None:
+                    raise RuntimeError(f"I-PI exited with code {event.returncode} before accepting connections")
+                elif event.name == "I-PI":
+                    result["ipi_returncode"] = event.returncode
+                    ipi_finished = event.time
+                elif event.returncode != 0 and ipi_finished is None:
+                    raise RuntimeError(f"{event.name} exited with code {event.returncode}")
+                if on_event is not None:
+                    on_event(event)
+            if ipi_finished is not None:
+                # The drivers write their last output (and profiles) after i-PI has stopped them
+                if now - ipi_finished > DRIVER_EXIT_TIMEOUT:
+                    break
+                continue
+
+            if drivers is None:
+                # The drivers start as soon as i-PI accepts connections
+                if not all(server_listening(address) for address in addresses):
+                    if now - ipi_started > SERVER_TIMEOUT:
+                        raise RuntimeError("Timeout waiting for I-PI to accept connections")
+                    continue
+                drivers_started = time.time()
+                drivers = []
+                parts = driver_parts(params)
+                for client_id, part in parts:
+                    name = " ".join([driver_name] + ([part] if part else []) +
+                                    ([str(client_id)] if len(parts) > 1 else []))
+                    logs[name] = open(os.path.join(run_dir, driver_log_name(client_id)), 'a' if resume else 'w',
+                                      buffering=1)
+                    drivers.append(start_driver(run_dir, socket_name, client_id=client_id, driver=driver,
+                                                boundary=params.get("boundary", "periodic"),
+                                                socket_mode=socket_mode, host=params.get("host", "localhost"),
+                                                port=params.get("port", 0),
+                                                command_template=params.get("driver_command", ""), part=part,
+                                                profile=profile))
+                    supervisor.add(name, drivers[-1])
+                processes.extend(drivers)
+                metrics = run_metrics(params, run_dir, start_step, ipi_log=logs["I-PI"].name)
+                notify("started", f"I-PI is listening after {drivers_started - ipi_started:.2f} s, "
+                                  f"started {len(drivers)} {driver_name} driver(s)")
+
+            # Time from launching i-PI to the first MD step
+            if first_step is None:
+                if first_step_written(run_dir, ipi_started):
+                    first_step = now
+                    notify("status", f"First MD step after {first_step - ipi_started:.2f} s")
+                continue
+            if metrics is not None and now >= next_progress:
+                next_progress = now + PROGRESS_INTERVAL
+                values = metrics.update()
+                metrics.write(values)
+                notify("progress", metrics.status_line(values))
+            if monitor is not None and now >= next_update:
+                next_update = now + UPDATE_INTERVAL
+                if not monitor.exit_requested and monitor.update():
+                    notify("status", f"Error targets reached at step {monitor.converged_step} "
+                                     f"({monitor.summary_line()}), stopping I-PI")
+                    monitor.request_exit()
+
+        if result.get("ipi_returncode") == 0 and not result.get("stopped"):
+            last_step = None
+            if monitor is not None:
+                monitor.update()
+                if monitor.exit_requested:
+                    # i-PI saves the exact step it stopped at in RESTART
+                    last_step = checkpoint_step(os.path.join(run_dir, "RESTART")) or monitor.last_step
+                result["statistics"] = monitor.write(params["total_steps"], last_step)
+                notify("status", f"Block averages: {monitor.summary_line()}")
+            result["timing"] = write_timing(run_dir, params, nclients, drivers_started, ipi_finished,
+                                            ipi_started, first_step, start_step, last_step)
+            if metrics is not None:
+                metrics.update()
+                metrics.finish(completed=last_step is None)
+        result["driver_returncodes"] = [process.poll() for process in drivers or []]
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        if metrics is not None and metrics.running:
+            metrics.update()
+            metrics.finish(completed=False)
+        stop_processes(processes)
+        if supervisor is not None:
+            supervisor.close()
+        for process in processes:
+            if process.stdout is not None:
+                process.stdout.close()
+        remove_socket(socket_name)
+        remove_exit_file(run_dir)
+        if allocated_port is not None:
+            release_port(allocated_port)
+        if resume:
+            merge_outputs(run_dir)
+            notify("status", "Merged the resumed output with the earlier output")
+        if compressor is not None:
+            notify("status", f"Compressed the trajectories into {compressor.finish()} chunks")
+        for log in logs.values():
+            log.close()
+
+    result["wall_time"] = time.time() - start_time
+    result["success"] = ("error" not in result and not result.get("stopped")
+                         and result.get("ipi_returncode") == 0)
+    if use_cache and result["success"]:
+        try:
+            result["cache_dir"] = store(run_dir, params)
+            notify("status", f"Stored the result in the cache ({os.path.basename(result['cache_dir'])[:12]})")
+        except OSError as e:
+            notify("status", f"Warning: Could not store the result in the cache: {e}")
+    return result
@@ -0,0 +1,74 @@
+import tkinter as tk
+from tkinter import ttk
+
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.figure import Figure
+
+from property_monitor import DownsampledSeries, PropertiesTail
+
+# (column in simulation.out, plot title, y-axis label)
+PANELS = [
+    ("temperature", "Temperature", "T (K)"),
+    ("conserved", "Conserved Energy Drift", "ΔE (eV)"),
+    ("potential", "Potential Energy", "V (eV)"),
+    ("kinetic_cv", "Centroid-Virial Kinetic Energy", "KE (eV)"),
+]
+
+
+class LiveDashboard:
+    """Plots of the i-PI properties that follow simulation.out during a run"""
+
+    def __init__(self, parent, max_points=1000):
+        self.frame = ttk.Frame(parent)
+        self.max_points = max_points
+        self.tail = None
+
+        self.figure = Figure(figsize=(7, 5), dpi=80)
+        self.axes = {}
+        self.lines = {}
+        for i, (name, title, ylabel) in enumerate(PANELS):
+            ax = self.figure.add_subplot(2, 2, i + 1)
+            ax.set_title(title, fontsize=10)
+            ax.set_xlabel("Time (ps)", fontsize=9)
+            ax.set_ylabel(ylabel, fontsize=9)
+            ax.grid(True, color="lightgray")
+            self.axes[name] = ax
+            self.lines[name], = ax.plot([], [], lw=1)
+        self.figure.tight_layout()
+
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self.frame)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.reset(None)
+
+    def reset(self, filename):
+        """Clear the plots and follow filename (None to stop following)"""
+        self.tail = PropertiesTail(filename) if filename else None
+        self.series = {name: DownsampledSeries(self.max_points) for name, _, _ in PANELS}
+        self.conserved_start = None
+        for line in self.lines.values():
+            line.set_data([], [])
+        self.canvas.draw_idle()
+
+    def update(self):
+        """Parse the rows appended since the last call and redraw"""
+        if self.tail is None:
+            return
+        rows = self.tail.read_new()
+        if len(rows) == 0:
+            return
+
+        time_ps = self.tail.column(rows, "time")
+        for name, _, _ in PANELS:
+            if name not in self.tail.columns:
+                continue
+            values = self.tail.column(rows, name)
+            if name == "conserved":
+                if self.conserved_start is None:
+                    self.conserved_start = values[0]
+                values = values - self.conserved_start
+            series = self.series[name]
+            series.append(time_ps, values)
+            self.lines[name].set_data(series.x, series.y)
+            self.axes[name].relim()
+            self.axes[name].autoscale_view()
+        self.canvas.draw_idle()
@@ -0,0 +1,226 @@
+"""Analyse many runs at once on a pool of processes
+
+The runs of a sweep, and chunks of frames within every run, are spread
+over a process pool. Nothing large is pickled between the processes:
+
+    input   a run directory is read by every worker from its memory-mapped
+            trajectory store, so the pages are shared through the OS page
+            cache; an array passed in directly is copied once into shared
+            memory
+    output  the observables of every run are preallocated in a shared
+            memory block, and every worker writes its frames in place
+
+The result has the layout of the notebook functions: one dictionary per
+run with the compute_observables() arrays (rg, max_spread, oh_lengths,
+hoh_angles) and the atom names.
+
+Example:
+    from parallel_analysis import analyze_bead_convergence
+    results = analyze_bead_convergence([8, 16, 32, 64], temp=300)
+    print(results[32]['oh_lengths'].mean())
+
+From the command line (--compare also times the same analysis in one process):
+    python parallel_analysis.py --temperature 250 300 350 --nbeads 32 --compare
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from pimd_analysis import CHUNK_BYTES, compute_observables, fill_observables, frames_per_chunk, observable_shapes, \
+    summarize
+from simulation_config import run_dir_name
+from trajectory_store import TrajectoryStore, open_store
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.normpath(os.path.join(SCRIPT_DIR, '..'))
+
+
+class SharedArrays:
+    """Named float64 arrays in one shared-memory block
+
+    Only spec, the block name and the shapes, is sent to other processes,
+    which attach() to the same memory.
+    """
+
+    def __init__(self, shapes, name=None):
+        self.shapes = dict(shapes)
+        sizes = [8 * math.prod(shape) for shape in self.shapes.values()]
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(sum(sizes), 1))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.arrays = {}
+        offset = 0
+        for (key, shape), size in zip(self.shapes.items(), sizes):
+            self.arrays[key] = np.ndarray(shape, dtype=np.float64, buffer=self.shm.buf, offset=offset)
+            offset += size
+
+    @property
+    def spec(self):
+        return self.shm.name, self.shapes
+
+    @classmethod
+    def attach(cls, spec):
+        name, shapes = spec
+        return cls(shapes, name)
+
+    def copy(self):
+        """Return private copies of the arrays"""
+        return {key: array.copy() for key, array in self.arrays.items()}
+
+    def close(self, unlink=False):
+        # The views must be released before the block can be closed
+        self.arrays = {}
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def _open_store(run_dir):
+    """Worker: create or update the trajectory store of a run and return its layout"""
+    store = open_store(run_dir)
+    return store.index["nbeads"], store.nframes, store.index["natoms"], store.atom_names
+
+
+def _analyze_chunk(source, output_spec, start, stop, first):
+    """Worker: compute frames start:stop of one run into its shared output arrays"""
+    kind, value = source
+    inputs = None
+    if kind == "store":
+        positions = TrajectoryStore(value).positions(start=start, stop=stop)
+    else:
+        inputs = SharedArrays.attach(value)
+        positions = inputs.arrays["positions"][:, start:stop]
+    output = SharedArrays.attach(output_spec)
+    try:
+        fill_observables(output.arrays, positions, start - first)
+    finally:
+        del positions
+        output.close()
+        if inputs is not None:
+            inputs.close()
+
+
+def analyze_runs(runs, max_workers=None, discard=0.0, max_bytes=CHUNK_BYTES):
+    """Compute compute_observables() of many runs on a process pool
+
+    Args:
+        runs: dict of key -> run directory, or -> (beads, frames, atoms, 3)
+            array with the atoms in O, H, H order
+        max_workers: number of processes (default: all cores)
+        discard: fraction of the frames of every run left out as equilibration
+        max_bytes: temporary memory of one chunk in one process
+
+    Returns:
+        dict: key -> compute_observables() arrays and 'atom_names'
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    # Workers must share this process's resource tracker; one of their own
+    # would unlink the shared blocks as soon as the worker exits
+    resource_tracker.ensure_running()
+    shared = []
+    outputs = {}
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # Bring the trajectory stores up to date, one run per process
+            layouts = {key: executor.submit(_open_store, run) for key, run in runs.items() if isinstance(run, str)}
+            tasks = []
+            for key, run in runs.items():
+                if isinstance(run, str):
+                    nbeads, nframes, natoms, names = layouts[key].result()
+                    source = ("store", run)
+                else:
+                    run = np.asarray(run)
+                    nbeads, nframes, natoms, _ = run.shape
+                    names = ["O", "H", "H"] * (natoms // 3)
+                    inputs = SharedArrays({"positions": run.shape})
+                    shared.append(inputs)
+                    inputs.arrays["positions"][...] = run
+                    source = ("shared", inputs.spec)
+
+                first = int(discard * nframes)
+                output = SharedArrays(observable_shapes(nbeads, nframes - first, natoms))
+                shared.append(output)
+                outputs[key] = (output, names)
+                # Split every run so that a few long runs still keep all processes busy
+                chunk = min(frames_per_chunk(nbeads, natoms, max_bytes),
+                            max(1, math.ceil((nframes - first) / max_workers)))
+                for start in range(first, nframes, chunk):
+                    tasks.append(executor.submit(_analyze_chunk, source, output.spec, start,
+                                                 min(start + chunk, nframes), first))
+            for task in tasks:
+                task.result()
+        return {key: dict(output.copy(), atom_names=np.asarray(names)) for key, (output, names) in outputs.items()}
+    finally:
+        for block in shared:
+            block.close(unlink=True)
+
+
+def analyze_bead_convergence(bead_nums=[1, 32], temp=300, base_dir=BASE_DIR, max_workers=None):
+    """Parallel version of the notebook function: {P: observables of pimd_T{temp}_P{P}}"""
+    return analyze_runs({P: os.path.join(base_dir, run_dir_name({"temperature": temp, "nbeads": P}))
+                         for P in bead_nums}, max_workers)
+
+
+def analyze_temperature_effects(temps=[250, 300, 350], fixed_P=32, base_dir=BASE_DIR, max_workers=None):
+    """Parallel version of the notebook function: {T: observables of pimd_T{T}_P{fixed_P}}"""
+    return analyze_runs({T: os.path.join(base_dir, run_dir_name({"temperature": T, "nbeads": fixed_P}))
+                         for T in temps}, max_workers)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Analyse the runs of a sweep on a process pool")
+    parser.add_argument("run_dirs", nargs="*", help="Run directories (default: the --temperature/--nbeads grid)")
+    parser.add_argument("--temperature", nargs="+", default=["300"], help="Temperatures in K")
+    parser.add_argument("--nbeads", nargs="+", type=int, default=[32])
+    parser.add_argument("--base-dir", default=BASE_DIR, help="Directory of the pimd_T{T}_P{P} runs")
+    parser.add_argument("--max-workers", type=int, default=None, help="Processes (default: all cores)")
+    parser.add_argument("--discard", type=float, default=0.0, help="Fraction of every run left out")
+    parser.add_argument("--compare", action="store_true",
+                        help="Also analyse the runs one after another in this process and compare the times")
+    parser.add_argument("--summary", default=None, help="Write the summarized properties to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    run_dirs = args.run_dirs or [os.path.join(args.base_dir, run_dir_name({"temperature": T, "nbeads": P}))
+                                 for T in args.temperature for P in args.nbeads]
+    missing = [run_dir for run_dir in run_dirs if not os.path.isdir(run_dir)]
+    if missing:
+        print(f"Error: no run directory {', '.join(missing)}")
+        sys.exit(1)
+    runs = {os.path.basename(os.path.normpath(run_dir)): run_dir for run_dir in run_dirs}
+
+    start = time.perf_counter()
+    results = analyze_runs(runs, args.max_workers, args.discard)
+    parallel_time = time.perf_counter() - start
+    summaries = {key: summarize(observables, observables["atom_names"]) for key, observables in results.items()}
+    for key, summary in summaries.items():
+        print(f"{key}: Rg(H) = {summary['rg_H']:.4f} A, Rg(O) = {summary['rg_O']:.4f} A, "
+              f"r_OH = {summary['r_OH']:.4f} A, theta = {summary['theta_HOH']:.2f} deg")
+    print(f"Analysed {len(runs)} runs in {parallel_time:.2f} s "
+          f"with {args.max_workers or os.cpu_count() or 1} processes")
+
+    if args.compare:
+        start = time.perf_counter()
+        for run_dir in runs.values():
+            store = open_store(run_dir)
+            compute_observables(store.positions(start=int(args.discard * store.nframes)))
+        serial_time = time.perf_counter() - start
+        print(f"One process: {serial_time:.2f} s, speedup {serial_time / parallel_time:.2f}x")
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summaries, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Structural properties of PIMD water trajectories
+
+Positions have the layout returned by xyz_reader.read_run and
+TrajectoryStore.positions(): (beads, frames, atoms, 3) in Angstrom, with
+the atoms of every molecule in O, H, H order. Every function works on all
+beads, frames and molecules in one broadcast NumPy pass.
+
+For long runs compute_observables() processes the frames in chunks, so the
+temporary arrays never exceed a fixed budget (see frames_per_chunk) and a
+memory-mapped trajectory store is read from disk one chunk at a time. The
+results themselves are preallocated: per frame and atom for Rg and the
+largest bead-centroid distance, per bead, frame and molecule for the bond
+lengths and angles.
+
+Example:
+    from trajectory_store import open_store
+    from pimd_analysis import compute_observables, summarize
+    observables = compute_observables(open_store('../pimd_T300_P32').positions())
+    print(summarize(observables, ['O', 'H', 'H']))
+"""
+import numpy as np
+
+from trajectory_store import open_store
+
+# Default size of the temporary arrays of one chunk
+CHUNK_BYTES = 256 * 2**20
+
+
+def centroids(positions):
+    """Return the ring-polymer centroids, shape (frames, atoms, 3)"""
+    return positions.mean(axis=0)
+
+
+def bead_centroid_spreads(positions):
+    """Return the distance of every bead from its centroid, shape (beads, frames, atoms)"""
+    return np.linalg.norm(positions - centroids(positions), axis=-1)
+
+
+def radius_of_gyration(positions):
+    """Return the ring-polymer radius of gyration of every atom, shape (frames, atoms)
+
+    Rg = sqrt(1/P sum_i (r_i - r_c)^2) with r_c the centroid of the beads.
+    """
+    centroid = centroids(positions)
+    return np.sqrt(np.mean(np.sum((positions - centroid)**2, axis=-1), axis=0))
+
+
+def oh_bond_lengths(positions):
+    """Return the O-H distances of every bead, shape (beads, frames, molecules, 2)"""
+    molecules = positions.reshape(positions.shape[:2] + (-1, 3, 3))
+    return np.linalg.norm(molecules[..., 1:, :] - molecules[..., :1, :], axis=-1)
+
+
+def hoh_angles(positions):
+    """Return the H-O-H angles of every bead in degrees, shape (beads, frames, molecules)"""
+    molecules = positions.reshape(positions.shape[:2] + (-1, 3, 3))
+    d1 = molecules[..., 1, :] - molecules[..., 0, :]
+    d2 = molecules[..., 2, :] - molecules[..., 0, :]
+    cos = np.sum(d1 * d2, axis=-1) / (np.linalg.norm(d1, axis=-1) * np.linalg.norm(d2, axis=-1))
+    return np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))
+
+
+def frames_per_chunk(nbeads, natoms, max_bytes=CHUNK_BYTES):
+    """Return the number of frames whose temporaries fit in max_bytes
+
+    One chunk needs about eight float64 arrays of its positions' size (the
+    copy read from disk, displacements, bond vectors and their norms).
+    """
+    frame_bytes = 8 * nbeads * natoms * 3 * 8
+    return max(1, max_bytes // frame_bytes)
+
+
+def observable_shapes(nbeads, nframes, natoms):
+    """Return the shape of every array of compute_observables()"""
+    return {
+        "rg": (nframes, natoms),
+        "max_spread": (nframes, natoms),
+        "oh_lengths": (nbeads, nframes, natoms // 3, 2),
+        "hoh_angles": (nbeads, nframes, natoms // 3),
+    }
+
+
+def fill_observables(observables, chunk, start):
+    """Compute the observables of chunk, the frames from start on, into observables"""
+    chunk = np.asarray(chunk, dtype=np.float64)
+    stop = start + chunk.shape[1]
+    spreads = bead_centroid_spreads(chunk)
+    observables["rg"][start:stop] = np.sqrt(np.mean(spreads**2, axis=0))
+    observables["max_spread"][start:stop] = spreads.max(axis=0)
+    observables["oh_lengths"][:, start:stop] = oh_bond_lengths(chunk)
+    observables["hoh_angles"][:, start:stop] = hoh_angles(chunk)
+
+
+def compute_observables(positions, chunk_frames=None, max_bytes=CHUNK_BYTES):
+    """Compute all per-frame observables of a trajectory
+
+    Args:
+        positions: (beads, frames, atoms, 3) array or memmap
+        chunk_frames: frames per chunk (default: frames_per_chunk(max_bytes))
+        max_bytes: temporary memory per chunk when chunk_frames is not given
+
+    Returns:
+        dict of arrays:
+            rg          (frames, atoms)              radius of gyration
+            max_spread  (frames, atoms)              largest bead-centroid distance
+            oh_lengths  (beads, frames, molecules, 2)
+            hoh_angles  (beads, frames, molecules)   degrees
+    """
+    nbeads, nframes, natoms, _ = positions.shape
+    chunk_frames = chunk_frames or frames_per_chunk(nbeads, natoms, max_bytes)
+    observables = {name: np.empty(shape) for name, shape in observable_shapes(nbeads, nframes, natoms).items()}
+    for start in range(0, nframes, chunk_frames):
+        fill_observables(observables, positions[:, start:start + chunk_frames], start)
+    return observables
+
+
+def summarize(observables, names):
+    """Return the means and standard deviations of compute_observables() output"""
+    names = np.asarray(names)
+    rg = observables["rg"]
+    return {
+        "rg_H": float(rg[:, names == "H"].mean()),
+        "rg_O": float(rg[:, names == "O"].mean()),
+        "max_spread_H": float(observables["max_spread"][:, names == "H"].max()),
+        "max_spread_O": float(observables["max_spread"][:, names == "O"].max()),
+        "r_OH": float(observables["oh_lengths"].mean()),
+        "r_OH_std": float(observables["oh_lengths"].std()),
+        "theta_HOH": float(observables["hoh_angles"].mean()),
+        "theta_HOH_std": float(observables["hoh_angles"].std()),
+    }
+
+
+def frame_properties(positions, names):
+    """Return the H and O radius of gyration, O-H length and H-O-H angle of every frame
+
+    Returns:
+        dict: arrays of shape (frames,) averaged over beads and molecules
+    """
+    names = np.asarray(names)
+    rg = radius_of_gyration(positions)
+    return {
+        "rg_H": rg[:, names == "H"].mean(axis=1),
+        "rg_O": rg[:, names == "O"].mean(axis=1),
+        "r_OH": oh_bond_lengths(positions).mean(axis=(0, 2, 3)),
+        "theta_HOH": hoh_angles(positions).mean(axis=(0, 2)),
+    }
+
+
+def structural_summary(positions, names):
+    """Return the mean H and O radius of gyration, O-H length and H-O-H angle"""
+    return {key: float(values.mean()) for key, values in frame_properties(positions, names).items()}
+
+
+def run_properties(run_dir, discard=0.2, prefix="simulation"):
+    """Return summarize() of a run, skipping the first discard fraction of frames
+
+    The bead trajectories are read through the run's trajectory store
+    (created or updated first), one chunk of frames at a time.
+    """
+    store = open_store(run_dir, prefix=prefix)
+    positions = store.positions(start=int(discard * store.nframes))
+    return summarize(compute_observables(positions), store.atom_names)
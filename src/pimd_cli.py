@@ -0,0 +1,160 @@
+"""Run one PIMD simulation without a window
+
+The headless counterpart of water_pimd_gui.py for compute nodes: the same
+parameters (see simulation_config.DEFAULT_PARAMS), validated the same way
+and run by the same launcher.run_simulation, so a run started here and the
+same run started from the GUI write identical inputs. tkinter is never
+imported.
+
+Parameters come from a JSON file (e.g. the run_params.json of an earlier
+run) and/or flags, flags taking precedence; everything else keeps its
+default. The run directory is given by --work-dir (default: pimd_run_1
+next to the .sh file, as in the GUI).
+
+Exit status:
+    0    the run finished, stopped at its target errors or came from the cache
+    1    i-PI or a driver failed, or the run could not be started
+    2    invalid parameters, parameter file or command line, or nothing to resume
+    128 + signal number (130 for Ctrl+C, 143 for SIGTERM) when interrupted;
+         the processes are stopped and the run can be continued with --resume
+
+Example:
+    python pimd_cli.py --temperature 300 --nbeads 32 --total-steps 2000 --work-dir /scratch/pimd_300
+    python pimd_cli.py --params ../pimd_run_1/run_params.json --work-dir /scratch/rerun --no-cache
+    python pimd_cli.py --work-dir /scratch/pimd_300 --resume
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+from launcher import run_simulation, work_dir_path
+from simulation_config import DEFAULT_PARAMS, PARAM_CHOICES, validate_params
+
+EXIT_FAILED = 1
+EXIT_INVALID = 2
+PROGRESS_INTERVAL = 30.0  # seconds between printed progress lines
+
+
+def load_params(path):
+    """Return the parameters of a JSON file; a work_dir key (written by older GUI runs) is ignored"""
+    with open(path) as f:
+        params = json.load(f)
+    if not isinstance(params, dict):
+        raise ValueError(f"{path} does not hold a JSON object of parameters")
+    params.pop("work_dir", None)
+    return params
+
+
+class ConsoleReporter:
+    """Print the events of a run: status messages, a progress line every interval and, if verbose, all output"""
+
+    def __init__(self, verbose=False, interval=PROGRESS_INTERVAL):
+        self.verbose = verbose
+        self.interval = interval
+        self.next_progress = 0.0
+
+    def __call__(self, event):
+        stamp = time.strftime("%H:%M:%S", time.localtime(event.time))
+        if event.kind == "output":
+            if self.verbose:
+                print(f"[{stamp}] [{event.name}] {event.text}", flush=True)
+        elif event.kind == "exit":
+            print(f"[{stamp}] {event.name} exited with code {event.returncode}", flush=True)
+        elif event.kind == "progress":
+            if event.time >= self.next_progress:
+                self.next_progress = event.time + self.interval
+                print(f"[{stamp}] {event.text}", flush=True)
+        else:
+            print(f"[{stamp}] {event.text}", flush=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run one PIMD simulation without the GUI",
+                                     epilog="Exit status: 0 done, 1 run failed, 2 invalid input, "
+                                            "128 + signal number when interrupted")
+    parser.add_argument("--params", default=None, help="JSON file of parameters, e.g. run_params.json of a run")
+    parser.add_argument("--work-dir", default=None,
+                        help="Run directory (default: pimd_run_1 next to the .sh file, as in the GUI)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the run in --work-dir from its newest checkpoint")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always simulate, even a run found in the result cache")
+    parser.add_argument("--verbose", action="store_true", help="Also print the output of i-PI and the drivers")
+    parser.add_argument("--progress-interval", type=float, default=PROGRESS_INTERVAL, metavar="SECONDS",
+                        help="Seconds between printed progress lines")
+    parser.add_argument("--summary", default=None, help="Write the run result to this JSON file")
+    # One flag per parameter; values are kept as strings, like the GUI entries
+    params = parser.add_argument_group("simulation parameters (see simulation_config.DEFAULT_PARAMS)")
+    for key, default in DEFAULT_PARAMS.items():
+        params.add_argument(f"--{key.replace('_', '-')}", dest=key, default=None, choices=PARAM_CHOICES.get(key),
+                            help=f"default: {default!r}")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    try:
+        params = load_params(args.params) if args.params else {}
+        params.update({key: getattr(args, key) for key in DEFAULT_PARAMS if getattr(args, key) is not None})
+        params = validate_params(params)
+        run_dir = os.path.abspath(args.work_dir) if args.work_dir else work_dir_path("pimd_run_1")
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(EXIT_INVALID)
+    if args.resume and not os.path.isdir(run_dir):
+        print(f"Error: no run directory {run_dir} to resume")
+        sys.exit(EXIT_INVALID)
+    os.makedirs(run_dir, exist_ok=True)
+
+    # Batch schedulers send SIGTERM at the time limit; the processes are
+    # stopped cleanly and the run can be resumed from its checkpoint
+    stop_event = threading.Event()
+    received = []
+
+    def stop(signum, frame):
+        received.append(signum)
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # A cached run has nothing to profile
+    use_cache = not args.no_cache and not int(params["profile"])
+    print(f"Running in {run_dir}", flush=True)
+    try:
+        result = run_simulation(params, run_dir, resume=args.resume, use_cache=use_cache,
+                                on_event=ConsoleReporter(args.verbose, args.progress_interval),
+                                stop_event=stop_event)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(EXIT_INVALID)
+    except Exception as e:
+        print(f"Error starting the simulation: {e}")
+        sys.exit(EXIT_FAILED)
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if received:
+        print(f"Interrupted after {result['wall_time']:.1f} s; continue with --resume")
+        sys.exit(128 + received[0])
+    if not result["success"]:
+        error = result.get("error") or f"I-PI exited with code {result.get('ipi_returncode')}"
+        print(f"Run failed: {error}")
+        sys.exit(EXIT_FAILED)
+    if result.get("cached"):
+        print(f"Taken from the result cache ({os.path.basename(result['cache_dir'])[:12]})")
+    elif "timing" in result:
+        timing = result["timing"]
+        print(f"Done in {result['wall_time']:.1f} s: {timing['time_per_step']:.4f} s per step with "
+              f"{timing['nclients']} driver client(s) for {timing['nbeads']} beads"
+              + (f", {timing['steps_saved']} steps saved" if timing.get("steps_saved") else ""))
+
+
+if __name__ == "__main__":
+    main()
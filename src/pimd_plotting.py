@@ -0,0 +1,153 @@
+"""Plotly figures of PIMD trajectories whose size does not grow with the data
+
+A figure stores every point it draws, so plots built from raw trajectory
+data grow with the number of beads and frames. The helpers here keep the
+figure bounded:
+
+    ring_polymer_trace   one closed-line trace per ring polymer, not one per bond
+    histogram_trace      values binned in NumPy (a chunk at a time); only the
+                         bin heights go into the figure
+    time_series_trace    long series reduced to at most max_points points,
+                         keeping the minimum and maximum of every bucket so
+                         that peaks and the envelope survive
+
+Example:
+    from pimd_plotting import histogram_trace, plot_ring_polymer
+    fig = go.Figure(histogram_trace(observables['oh_lengths'], name='O-H bonds'))
+    plot_ring_polymer(positions[:, -1], atom_idx=1, title='Hydrogen Ring Polymer', color='red').show()
+"""
+import numpy as np
+import plotly.graph_objects as go
+from matplotlib.colors import to_rgb
+
+# Values binned at once by histogram(); bounds the temporary memory
+HISTOGRAM_CHUNK = 1 << 22
+
+
+def rgba(color, alpha):
+    """Return a plotly rgba() string for a named or hex color"""
+    red, green, blue = (int(round(255 * c)) for c in to_rgb(color))
+    return f"rgba({red}, {green}, {blue}, {alpha})"
+
+
+def ring_polymer_trace(beads, color="blue", name="Beads"):
+    """Return one Scatter3d trace with the beads of a ring polymer joined in a closed line
+
+    Args:
+        beads: (beads, 3) positions of one atom
+    """
+    ring = np.concatenate([beads, beads[:1]])
+    return go.Scatter3d(
+        x=ring[:, 0], y=ring[:, 1], z=ring[:, 2],
+        mode='lines+markers',
+        marker=dict(size=6, color=color, opacity=0.8),
+        line=dict(color=rgba(color, 0.3), width=2),
+        name=name,
+        hovertemplate='x: %{x:.3f}<br>y: %{y:.3f}<br>z: %{z:.3f}<extra>Bead</extra>'
+    )
+
+
+def plot_ring_polymer(positions, atom_idx, title, color='blue', layout=None):
+    """Return a 3D figure of the ring polymer of one atom and its centroid
+
+    Args:
+        positions: (beads, atoms, 3) positions of one frame
+        layout: base layout, e.g. the notebook's plotly_layout_3d
+    """
+    beads = np.asarray(positions[:, atom_idx])
+    centroid = beads.mean(axis=0)
+    fig = go.Figure([
+        ring_polymer_trace(beads, color),
+        go.Scatter3d(
+            x=[centroid[0]], y=[centroid[1]], z=[centroid[2]],
+            mode='markers',
+            marker=dict(size=10, color='red', symbol='diamond'),
+            name='Centroid',
+            hovertemplate='x: %{x:.3f}<br>y: %{y:.3f}<br>z: %{z:.3f}<extra>Centroid</extra>'
+        ),
+    ])
+    fig.update_layout(
+        layout or {},
+        title={
+            'text': f'{title}<br><sup>Interactive 3D Visualization</sup>',
+            'font': {'size': 20},
+            'y': 0.95,
+            'x': 0.5,
+            'xanchor': 'center',
+            'yanchor': 'top'
+        },
+        scene=dict(
+            xaxis_title='X (Å)',
+            yaxis_title='Y (Å)',
+            zaxis_title='Z (Å)',
+            aspectmode='cube'
+        ),
+        annotations=[{
+            'text': 'Drag to rotate | Scroll to zoom | Double-click to reset view',
+            'showarrow': False,
+            'x': 0.5,
+            'y': -0.08,
+            'xref': 'paper',
+            'yref': 'paper',
+            'font': {'size': 12}
+        }]
+    )
+    return fig
+
+
+def histogram(values, bins=50, value_range=None, density=True):
+    """Bin values of any shape (array or memmap) a chunk at a time
+
+    Returns:
+        tuple: bin edges and heights (probability density if density=True)
+    """
+    values = np.asarray(values).reshape(-1)
+    if value_range is None:
+        value_range = (float(np.min(values)), float(np.max(values)))
+    counts = np.zeros(bins, dtype=np.int64)
+    edges = np.linspace(value_range[0], value_range[1], bins + 1)
+    for start in range(0, len(values), HISTOGRAM_CHUNK):
+        counts += np.histogram(values[start:start + HISTOGRAM_CHUNK], bins=edges)[0]
+    if density and counts.sum() > 0:
+        return edges, counts / (counts.sum() * np.diff(edges))
+    return edges, counts.astype(float)
+
+
+def histogram_trace(values, bins=50, value_range=None, density=True, name=None, hover_label='Value'):
+    """Return a Bar trace of the histogram of values; the figure holds bins points, not len(values)"""
+    edges, heights = histogram(values, bins, value_range, density)
+    return go.Bar(
+        x=0.5 * (edges[1:] + edges[:-1]),
+        y=heights,
+        width=np.diff(edges),
+        name=name,
+        marker_line_width=0,
+        hovertemplate=f'{hover_label}: %{{x:.3f}}<br>{"Density" if density else "Count"}: %{{y:.3f}}<extra></extra>'
+    )
+
+
+def downsample_minmax(x, y, max_points=2000):
+    """Reduce a series to at most max_points points, keeping the extremes
+
+    The series is split into max_points / 2 buckets and the minimum and the
+    maximum of every bucket are kept in their original order.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    if len(y) <= max_points:
+        return x, y
+    nbuckets = max(max_points // 2, 1)
+    bucket_size = int(np.ceil(len(y) / nbuckets))
+    npadded = bucket_size * int(np.ceil(len(y) / bucket_size))
+    # Pad the last bucket with its own last value so that reshape works
+    padded = np.concatenate([y, np.full(npadded - len(y), y[-1])]).reshape(-1, bucket_size)
+    offsets = np.arange(0, npadded, bucket_size)
+    first = offsets + np.minimum(padded.argmin(axis=1), padded.argmax(axis=1))
+    second = offsets + np.maximum(padded.argmin(axis=1), padded.argmax(axis=1))
+    keep = np.unique(np.minimum(np.stack([first, second], axis=1).ravel(), len(y) - 1))
+    return x[keep], y[keep]
+
+
+def time_series_trace(x, y, max_points=2000, **kwargs):
+    """Return a Scatter line of a series downsampled with downsample_minmax()"""
+    x, y = downsample_minmax(x, y, max_points)
+    return go.Scatter(x=x, y=y, mode='lines', **kwargs)
@@ -0,0 +1,166 @@
+"""Opt-in profiling of the i-PI server and the force drivers
+
+With profile = 1 (GUI: "Profile" checkbox, campaign.py --profile) run_ipi.py
+runs Simulation.load_from_xml and simulation.run() under cProfile, and the
+drivers profile their force loop (lmp.file for LAMMPS, run_client for the
+NumPy driver). When a process ends, it writes to profiles/ in the run
+directory:
+
+    <name>.prof   the cProfile dump, for pstats, snakeviz or gprof2dot
+    <name>.txt    the top functions by own and by cumulative time
+    <name>.json   wall and CPU time and their split into compute, socket and wait
+
+The split takes the own time of the socket calls (recv, send, select, poll)
+as socket time and that of sleeps and lock waits as wait time; everything
+else is compute. i-PI exchanges the messages with the drivers in a thread
+of its own, so for i-PI, whose main thread is profiled, the wait time is
+the time the integrator waits for the forces. The LAMMPS force loop runs in
+C++, where cProfile sees nothing, so the LAMMPS split comes from the
+process times instead: a driver blocked on the socket uses no CPU, so its
+CPU time is compute and the rest of the wall time is socket time.
+
+A process that is killed (e.g. by "Stop Simulation") writes no profile;
+runs that finish or stop at their target errors do.
+
+Example:
+    python profiling.py ../pimd_run_1            # breakdown of every process of a run
+    python profiling.py ../pimd_run_1 --top 15   # and their hottest functions
+"""
+import argparse
+import cProfile
+import glob
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import time
+
+PROFILE_DIR = "profiles"
+TOP_FUNCTIONS = 30
+
+# Built-in functions (file "~" in pstats) that block on a socket or wait
+SOCKET_PATTERN = re.compile(r"_socket\.socket|select\.|\bpoll\b")
+WAIT_PATTERN = re.compile(r"time\.sleep|_thread\.(lock|RLock)|acquire|\bwait\b")
+
+
+def time_split(stats):
+    """Return the own time (s) of the profiled thread split into compute, socket and wait"""
+    split = {"compute": 0.0, "socket": 0.0, "wait": 0.0}
+    for (filename, _, function), (_, _, own_time, _, _) in stats.stats.items():
+        if filename == "~" and SOCKET_PATTERN.search(function):
+            split["socket"] += own_time
+        elif filename == "~" and WAIT_PATTERN.search(function):
+            split["wait"] += own_time
+        else:
+            split["compute"] += own_time
+    return split
+
+
+def profile_name(program, client_id=0, part=None):
+    """Return the profile name of a driver, e.g. "lammps_inter_1" """
+    return "_".join([program] + ([part] if part else []) + [str(client_id)])
+
+
+def top_functions(stats, sort="tottime", top=TOP_FUNCTIONS):
+    """Return the pstats listing of the top functions as text"""
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats(sort).print_stats(top)
+    return stream.getvalue()
+
+
+class Profiler:
+    """cProfile of one process with wall and CPU time
+
+    native=True is for work done in native code that cProfile cannot see
+    (LAMMPS); the split then comes from the process CPU time.
+    """
+
+    def __init__(self, name, native=False, directory=PROFILE_DIR, top=TOP_FUNCTIONS):
+        self.name = name
+        self.native = native
+        self.directory = directory
+        self.top = top
+        self.profile = cProfile.Profile()
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.profile.enable()
+
+    def stop(self):
+        """Stop profiling and write the .prof, .txt and .json files
+
+        Returns:
+            dict: the summary written to the .json file, None if never started
+        """
+        if self.started is None:
+            return None
+        self.profile.disable()
+        wall = time.perf_counter() - self.started
+        cpu = time.process_time() - self.cpu_started
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, self.name)
+        self.profile.dump_stats(f"{path}.prof")
+
+        stats = pstats.Stats(self.profile)
+        if self.native:
+            # Threads of MPI or OpenMP builds can use more CPU than wall time
+            compute = min(cpu, wall)
+            split = {"compute": compute, "socket": wall - compute, "wait": 0.0}
+        else:
+            split = time_split(stats)
+        summary = {"name": self.name, "wall": wall, "cpu": cpu, "split": split,
+                   "method": "cpu" if self.native else "profile"}
+        with open(f"{path}.json", 'w') as f:
+            json.dump(summary, f, indent=2)
+        with open(f"{path}.txt", 'w') as f:
+            f.write(summary_line(summary) + "\n\n")
+            f.write(f"Top {self.top} functions by own time\n")
+            f.write(top_functions(stats, "tottime", self.top))
+            f.write(f"Top {self.top} functions by cumulative time\n")
+            f.write(top_functions(stats, "cumulative", self.top))
+        print(f"Profile written to {path}.prof ({summary_line(summary)})")
+        return summary
+
+
+def summary_line(summary):
+    """Return e.g. "ipi: 12.3 s wall, 4.1 s CPU | compute 31.2% | socket 0.4% | wait 68.4%" """
+    split = summary["split"]
+    total = sum(split.values()) or 1.0
+    parts = [f"{key} {value / total:.1%}" for key, value in split.items()]
+    return f"{summary['name']}: {summary['wall']:.1f} s wall, {summary['cpu']:.1f} s CPU | " + " | ".join(parts)
+
+
+def load_profiles(run_dir):
+    """Return the summaries of all profiles written in run_dir"""
+    summaries = []
+    for path in sorted(glob.glob(os.path.join(run_dir, PROFILE_DIR, "*.json"))):
+        with open(path) as f:
+            summaries.append(json.load(f))
+    return summaries
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time breakdown of the profiled processes of a run")
+    parser.add_argument("run_dir")
+    parser.add_argument("--top", type=int, default=0, help="Also print the N hottest functions of every process")
+    parser.add_argument("--sort", choices=["tottime", "cumulative"], default="tottime",
+                        help="Order of the hottest functions")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    summaries = load_profiles(args.run_dir)
+    if not summaries:
+        print(f"Error: no profiles in {os.path.join(args.run_dir, PROFILE_DIR)} (run with profile = 1)")
+        sys.exit(1)
+    for summary in summaries:
+        print(summary_line(summary))
+        if args.top:
+            stats = pstats.Stats(os.path.join(args.run_dir, PROFILE_DIR, f"{summary['name']}.prof"))
+            print(top_functions(stats.strip_dirs(), args.sort, args.top))
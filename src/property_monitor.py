@@ -0,0 +1,103 @@
+"""Incremental reading of the i-PI properties file (simulation.out)
+
+PropertiesTail remembers how far the file has been read and only parses
+the rows appended since the previous call. DownsampledSeries keeps a
+bounded number of points of a growing time series, so the cost of
+following a run does not depend on how long it has been going.
+"""
+import os
+import re
+
+import numpy as np
+
+# i-PI header lines look like
+#   # column   3    --> temperature{kelvin} : The current temperature...
+#   # cols.  4-6    --> ...
+HEADER_PATTERN = re.compile(r"#\s*(?:column|cols\.)\s+(\d+)(?:-(\d+))?\s+-->\s+([^\s:]+)")
+
+
+class PropertiesTail:
+    """Follow an i-PI properties file by byte offset"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.partial = b""
+        self.columns = {}
+
+    def reset(self):
+        self.offset = 0
+        self.partial = b""
+        self.columns = {}
+
+    def _parse_header(self, line):
+        match = HEADER_PATTERN.match(line)
+        if match:
+            first = int(match.group(1)) - 1
+            last = int(match.group(2) or match.group(1)) - 1
+            name = match.group(3).split("{")[0]
+            self.columns[name] = first if first == last else slice(first, last + 1)
+
+    def read_new(self):
+        """Return the rows appended since the last call as a 2D array
+
+        Returns an array with zero rows if nothing new is complete. If the
+        file was truncated (a new run in the same directory) it is read
+        again from the start.
+        """
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            return np.empty((0, 0))
+        if size < self.offset:
+            self.reset()
+        if size == self.offset:
+            return np.empty((0, 0))
+
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        self.offset += len(data)
+
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        rows = []
+        for line in lines:
+            if line.startswith(b"#"):
+                self._parse_header(line.decode())
+            elif line.strip():
+                rows.append(line)
+        if not rows:
+            return np.empty((0, 0))
+        return np.loadtxt(rows, ndmin=2)
+
+    def column(self, rows, name):
+        """Return the column called name (without units) from rows"""
+        return rows[:, self.columns[name]]
+
+
+class DownsampledSeries:
+    """A time series that keeps at most max_points evenly strided points
+
+    Whenever the series grows beyond max_points every other point is
+    dropped and the sampling stride doubles, so memory and plotting cost
+    stay bounded for runs of any length.
+    """
+
+    def __init__(self, max_points=1000):
+        self.max_points = max_points
+        self.stride = 1
+        self.seen = 0
+        self.x = np.empty(0)
+        self.y = np.empty(0)
+
+    def append(self, x, y):
+        indices = np.arange(self.seen, self.seen + len(x))
+        keep = indices % self.stride == 0
+        self.seen += len(x)
+        self.x = np.concatenate([self.x, np.asarray(x)[keep]])
+        self.y = np.concatenate([self.y, np.asarray(y)[keep]])
+        while len(self.x) > self.max_points:
+            self.x = self.x[::2]
+            self.y = self.y[::2]
+            self.stride *= 2
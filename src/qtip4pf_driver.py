@@ -0,0 +1,310 @@
+"""Vectorized NumPy q-TIP4P/f force driver for i-PI
+
+Replaces run_lammps.py for a single molecule (either boundary) and for an
+isolated cluster: it connects to the same unix socket and computes
+energies, forces and the virial with the parameters used by
+create_lammps_input (simulation_config.QTIP4PF). Atoms must come in
+O, H, H order for every molecule, as in init.xyz and water.data.
+
+Intermolecular Coulomb and Lennard-Jones terms are summed directly over all
+pairs with the LAMMPS cutoff, which avoids the PPPM mesh that makes LAMMPS
+expensive for a handful of molecules. There is no Ewald sum, so periodic
+boxes of several molecules (pppm/tip4p in LAMMPS) are refused; run them
+with the LAMMPS driver.
+
+Usage:
+    python qtip4pf_driver.py --socket water_ipi
+    python qtip4pf_driver.py --check       # compare forces with LAMMPS
+    python qtip4pf_driver.py --benchmark   # force calls per second
+"""
+import argparse
+import ctypes
+import sys
+import time
+
+import numpy as np
+
+from ipi_socket import connect_server, run_client
+from profiling import Profiler, profile_name
+from simulation_config import INIT_XYZ, QTIP4PF, socket_path
+
+COULOMB = 332.06371  # kcal/mol Angstrom / e^2, as in LAMMPS real units
+BOHR = 0.52917721067  # Angstrom
+HARTREE = 627.509474  # kcal/mol
+
+
+def m_site_alpha(params=QTIP4PF):
+    """Weight of the H atoms in the M-site position, as defined by LAMMPS
+
+    M = O + alpha/2 ((H1 - O) + (H2 - O)) with
+    alpha = d_OM / (cos(theta0/2) r0).
+    """
+    return params["m_site"] / (np.cos(0.5 * np.radians(params["theta0"])) * params["r0"])
+
+
+def compute_qtip4pf(positions, cell=None, params=QTIP4PF, part=None):
+    """Return the q-TIP4P/f energy, forces and virial
+
+    Args:
+        positions: (3 nmol, 3) array in Angstrom, O H H for every molecule
+        cell: (3, 3) lattice vectors as columns in Angstrom of a single
+            periodic molecule, or None for an isolated molecule or cluster
+        params: force field parameters (LAMMPS real units)
+        part: "intra" for only the bonds and angles, "inter" for only the
+            Lennard-Jones and Coulomb terms, None for the full force field
+
+    Returns:
+        tuple: energy (kcal/mol), forces (3 nmol, 3) in kcal/mol/Angstrom
+        and the virial sum r_i f_j (3, 3) in kcal/mol
+
+    Raises:
+        ValueError: for several molecules in a periodic cell, which need an Ewald sum
+    """
+    x = np.asarray(positions, dtype=np.float64).reshape(-1, 3, 3)
+    nmol = len(x)
+    if cell is not None and nmol > 1 and part != "intra":
+        raise ValueError(f"The NumPy driver has no Ewald sum for {nmol} periodic molecules; "
+                         "use the LAMMPS driver or the cluster boundary")
+    oxygen = x[:, 0]
+
+    d = x[:, 1:] - oxygen[:, None]
+    d1, d2 = d[:, 0], d[:, 1]
+    energy = 0.0
+    f_h = np.zeros_like(d)
+    if part != "inter":
+        # Harmonic O-H bonds, E = K (r - r0)^2
+        r = np.linalg.norm(d, axis=2)
+        stretch = r - params["r0"]
+        energy += params["k_bond"] * np.sum(stretch**2)
+        f_h -= 2.0 * params["k_bond"] * (stretch / r)[..., None] * d
+
+        # Harmonic H-O-H angle, E = K (theta - theta0)^2
+        r1, r2 = r[:, 0], r[:, 1]
+        cos = np.clip(np.einsum('ij,ij->i', d1, d2) / (r1 * r2), -1.0, 1.0)
+        bend = np.arccos(cos) - np.radians(params["theta0"])
+        energy += params["k_angle"] * np.sum(bend**2)
+        sin = np.sqrt(np.maximum(1.0 - cos**2, 1e-12))
+        prefactor = (2.0 * params["k_angle"] * bend / sin)[:, None]
+        f_h[:, 0] += prefactor * (d2 / (r1 * r2)[:, None] - cos[:, None] * d1 / (r1**2)[:, None])
+        f_h[:, 1] += prefactor * (d1 / (r1 * r2)[:, None] - cos[:, None] * d2 / (r2**2)[:, None])
+
+    forces = np.empty_like(x)
+    forces[:, 1:] = f_h
+    forces[:, 0] = -f_h.sum(axis=1)
+    # The intramolecular forces of each molecule sum to zero, so the virial
+    # can be taken relative to its oxygen
+    virial = np.einsum('mai,maj->ij', d, f_h)
+
+    if nmol > 1 and part != "intra":
+        i, j = np.triu_indices(nmol, k=1)
+        cutoff = params["cutoff"]
+        d_oo = oxygen[i] - oxygen[j]
+
+        # Coulomb between the M and H sites of different molecules
+        alpha = m_site_alpha(params)
+        sites = x.copy()
+        sites[:, 0] = oxygen + 0.5 * alpha * (d1 + d2)
+        charges = np.array([params["charge_O"], params["charge_H"], params["charge_H"]])
+        qq = COULOMB * np.outer(charges, charges)
+
+        d_site = sites[i][:, :, None] - sites[j][:, None, :]
+        r_site = np.linalg.norm(d_site, axis=3)
+        inside = r_site < cutoff
+        energy += np.sum(np.where(inside, qq / r_site, 0.0))
+        f_pair = np.where(inside, qq / r_site**3, 0.0)[..., None] * d_site
+        virial += np.einsum('pabi,pabj->ij', d_site, f_pair)
+
+        f_sites = np.zeros_like(x)
+        np.add.at(f_sites, i, f_pair.sum(axis=2))
+        np.add.at(f_sites, j, -f_pair.sum(axis=1))
+
+        # The M-site force is shared between O and H with the weights of M
+        f_m = f_sites[:, 0]
+        forces[:, 0] += (1.0 - alpha) * f_m
+        forces[:, 1:] += f_sites[:, 1:] + 0.5 * alpha * f_m[:, None]
+
+        # Lennard-Jones between oxygens
+        r_oo = np.linalg.norm(d_oo, axis=1)
+        inside = r_oo < cutoff
+        sr6 = (params["sigma_OO"] / r_oo)**6
+        energy += np.sum(np.where(inside, 4.0 * params["epsilon_OO"] * (sr6**2 - sr6), 0.0))
+        f_lj = np.where(inside, 24.0 * params["epsilon_OO"] * (2.0 * sr6**2 - sr6) / r_oo**2, 0.0)[:, None] * d_oo
+        virial += np.einsum('pi,pj->ij', d_oo, f_lj)
+        np.add.at(forces[:, 0], i, f_lj)
+        np.add.at(forces[:, 0], j, -f_lj)
+
+    return energy, forces.reshape(-1, 3), virial
+
+
+def ipi_compute(cell, positions, periodic=True, part=None):
+    """compute_qtip4pf in the atomic units of the i-PI protocol"""
+    energy, forces, virial = compute_qtip4pf(positions * BOHR, cell * BOHR if periodic else None, part=part)
+    return energy / HARTREE, forces * BOHR / HARTREE, virial / HARTREE
+
+
+def reference_molecule():
+    """Return the init.xyz water molecule as a (3, 3) array in Angstrom"""
+    lines = INIT_XYZ.splitlines()[2:5]
+    return np.array([[float(v) for v in line.split()[1:4]] for line in lines])
+
+
+def test_geometries(nmol, count, seed=32345):
+    """Return count randomly displaced clusters of nmol molecules"""
+    rng = np.random.default_rng(seed)
+    molecule = reference_molecule()
+    offsets = 3.1 * np.arange(nmol)[:, None] * np.array([1.0, 0.3, 0.2])
+    base = (molecule[None] + offsets[:, None]).reshape(-1, 3)
+    return [base + rng.normal(scale=0.05, size=base.shape) for _ in range(count)]
+
+
+def lammps_forces(geometries, boundary="periodic"):
+    """Evaluate the run_lammps.py force field on single-molecule geometries
+
+    Returns:
+        list of (energy, forces) tuples in kcal/mol and kcal/mol/Angstrom
+    """
+    from run_lammps import create_engine
+
+    lmp = create_engine(boundary)
+    lmp.command("thermo_style custom step pe")
+    results = []
+    for geometry in geometries:
+        n = len(geometry)
+        lmp.scatter_atoms("x", 1, 3, (ctypes.c_double * (3 * n))(*geometry.ravel()))
+        lmp.command("run 0")
+        forces = np.array(lmp.gather_atoms("f", 1, 3)[:3 * n]).reshape(n, 3)
+        results.append((lmp.get_thermo("pe"), forces))
+    lmp.close()
+    return results
+
+
+def numerical_forces(positions, cell, h=1e-5):
+    """Central finite-difference forces of compute_qtip4pf"""
+    forces = np.zeros_like(positions)
+    for index in np.ndindex(positions.shape):
+        plus, minus = positions.copy(), positions.copy()
+        plus[index] += h
+        minus[index] -= h
+        forces[index] = -(compute_qtip4pf(plus, cell)[0] - compute_qtip4pf(minus, cell)[0]) / (2 * h)
+    return forces
+
+
+def check(tolerance=0.05):
+    """Regression check of the NumPy forces
+
+    1. Analytic forces against finite differences for an isolated cluster
+       (covers the M-site redistribution and the intermolecular terms).
+    2. The virial of an isolated cluster against sum r_i f_j.
+    3. Forces against the LAMMPS driver on displaced single molecules, if
+       the lammps module is available. The cluster input must agree to
+       round-off; in the periodic input LAMMPS adds the small PPPM
+       contribution of the periodic images, hence the tolerance.
+
+    Returns:
+        bool: True if every check passed
+    """
+    passed = True
+    cell = 20.0 * np.eye(3)
+
+    cluster = test_geometries(nmol=4, count=1)[0]
+    analytic = compute_qtip4pf(cluster, None)[1]
+    deviation = np.max(np.abs(analytic - numerical_forces(cluster, None)))
+    print(f"Finite-difference force deviation: {deviation:.2e} kcal/mol/A")
+    passed &= deviation < 1e-4
+
+    _, forces, virial = compute_qtip4pf(cluster, None)
+    deviation = np.max(np.abs(virial - np.einsum('ai,aj->ij', cluster, forces)))
+    print(f"Isolated-cluster virial deviation: {deviation:.2e} kcal/mol")
+    passed &= deviation < 1e-8
+
+    try:
+        import lammps  # noqa: F401
+    except ImportError:
+        print("LAMMPS Python module not found, skipping the LAMMPS comparison")
+        return bool(passed)
+
+    geometries = test_geometries(nmol=1, count=10)
+    for boundary, boundary_cell, boundary_tolerance in (("periodic", cell, tolerance),
+                                                        ("cluster", None, 1e-6)):
+        reference = lammps_forces(geometries, boundary)
+        deviation = max(np.max(np.abs(compute_qtip4pf(g, boundary_cell)[1] - f))
+                        for g, (_, f) in zip(geometries, reference))
+        print(f"Maximum force deviation from LAMMPS ({boundary}): {deviation:.2e} kcal/mol/A "
+              f"(tolerance {boundary_tolerance})")
+        passed &= deviation < boundary_tolerance
+    return bool(passed)
+
+
+def benchmark(ncalls=2000):
+    """Print force calls per second of the NumPy driver and of LAMMPS"""
+    cell = 20.0 * np.eye(3) / BOHR
+    positions = reference_molecule() / BOHR
+
+    start_time = time.perf_counter()
+    for _ in range(ncalls):
+        ipi_compute(cell, positions)
+    rate = ncalls / (time.perf_counter() - start_time)
+    print(f"NumPy q-TIP4P/f: {rate:10.1f} force calls/s")
+
+    try:
+        import lammps  # noqa: F401
+    except ImportError:
+        print("LAMMPS Python module not found, skipping the LAMMPS benchmark")
+        return
+    from run_lammps import benchmark as lammps_benchmark
+    print("LAMMPS:")
+    lammps_benchmark(ncalls)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the NumPy q-TIP4P/f force driver for i-PI")
+    parser.add_argument("--socket", default="water_ipi",
+                        help="Unix socket name of the i-PI server (default: water_ipi)")
+    parser.add_argument("--client-id", type=int, default=0,
+                        help="Index of this driver when several connect to the same server")
+    parser.add_argument("--boundary", choices=["periodic", "cluster"], default="periodic",
+                        help="Periodic cell (single molecule only), or isolated molecule/cluster")
+    parser.add_argument("--mode", choices=["unix", "inet"], default="unix",
+                        help="Socket type of the i-PI server (inet lets the driver run on another node)")
+    parser.add_argument("--host", default="localhost",
+                        help="Host of the i-PI server in inet mode")
+    parser.add_argument("--port", type=int, default=32345,
+                        help="TCP port of the i-PI server in inet mode")
+    parser.add_argument("--part", choices=["intra", "inter"], default=None,
+                        help="Compute only the intramolecular or the intermolecular forces (split force field)")
+    parser.add_argument("--check", action="store_true",
+                        help="Check the forces against finite differences and LAMMPS, then exit")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Compare force calls per second with LAMMPS, then exit")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the force loop, written to profiles/numpy*.* (see profiling.py)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.check:
+        sys.exit(0 if check() else 1)
+    if args.benchmark:
+        benchmark()
+        sys.exit(0)
+
+    address = (args.host, args.port) if args.mode == "inet" else socket_path(args.socket)
+    print(f"Connecting to i-PI at {address}...")
+    profiler = Profiler(profile_name("numpy", args.client_id, args.part)) if args.profile else None
+    try:
+        sock = connect_server(address)
+        start_time = time.time()
+        periodic = args.boundary == "periodic"
+        if profiler:
+            profiler.start()
+        nsteps = run_client(sock, lambda cell, positions: ipi_compute(cell, positions, periodic, args.part))
+        elapsed = time.time() - start_time
+        print(f"i-PI sent EXIT after {nsteps} force calls ({nsteps / max(elapsed, 1e-9):.1f} calls/s)")
+    except Exception as e:
+        print(f"Error running NumPy driver: {e}")
+        sys.exit(1)
+    finally:
+        if profiler:
+            profiler.stop()
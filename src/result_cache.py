@@ -0,0 +1,259 @@
+"""Content-addressed cache of finished PIMD runs
+
+Every run is keyed by the SHA-256 of its full configuration: the physical
+parameters, the generated input.xml (with the run directory and socket
+replaced by placeholders, so they do not change the key), the initial
+structure, the force-field input of the driver and the random seed, which
+is part of input.xml. Settings that do not change the result (number of
+driver clients, sockets, checkpoint stride, working directory) are left
+out.
+
+Finished runs are copied to <cache_dir>/<key>/ with a meta.json. The cache
+is limited in size; the least recently used runs are evicted first.
+
+From a notebook:
+    from result_cache import find_run, list_runs
+    for entry in list_runs():
+        print(entry["key"][:12], entry["params"]["temperature"], entry["params"]["nbeads"])
+    run_dir = find_run(temperature=300, nbeads=32, total_steps=10000)
+
+From the command line:
+    python result_cache.py list
+    python result_cache.py restore <key> ../pimd_run_2
+    python result_cache.py evict --max-gb 2
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from simulation_config import DEFAULT_PARAMS, INTEGER_PARAMS, QTIP4PF, build_input_xml, cell_length, init_xyz
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.environ.get("PIMD_CACHE_DIR", os.path.normpath(os.path.join(SCRIPT_DIR, '..', 'pimd_cache')))
+MAX_BYTES = int(float(os.environ.get("PIMD_CACHE_MAX_GB", "5")) * 1e9)
+META_FILE = "meta.json"
+
+# Parameters that do not change the trajectory
+NON_PHYSICAL_KEYS = {"nclients", "socket_mode", "host", "port", "driver_command", "checkpoint_stride", "work_dir",
+                     "metrics_format", "profile", "chunk_frames"}
+
+# Run files that are not part of the result
+SKIPPED_FILES = {"restart.xml", "gui_console.log", "metrics.prom", "metrics.csv"}
+
+
+def force_field_input(params):
+    """Return the force-field input the driver of a run would use, as text"""
+    boundary = params.get("boundary", "periodic")
+    text = json.dumps({"driver": params.get("driver", "lammps"), "boundary": boundary, "qtip4pf": QTIP4PF},
+                      sort_keys=True)
+    if params.get("driver", "lammps") == "lammps":
+        from run_lammps import create_lammps_input, create_water_data
+        with tempfile.TemporaryDirectory() as tmp:
+            data_file = os.path.join(tmp, "water.data")
+            input_file = os.path.join(tmp, "in.water_ipi")
+            create_water_data(data_file, cell_length(params))
+            create_lammps_input("SOCKET", input_file, "water.data", boundary)
+            for name in (input_file, data_file):
+                with open(name) as f:
+                    text += f.read()
+    return text
+
+
+def _canonical(value):
+    """Return value as text so that 300, 300.0 and "300" give the same key"""
+    try:
+        return repr(float(value))
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _typed(params):
+    """Return params with the numbers of DEFAULT_PARAMS as int or float
+
+    The inputs are built from these, so that 300, 300.0 and "300" also give
+    the same input.xml.
+    """
+    typed = dict(params)
+    for key, default in DEFAULT_PARAMS.items():
+        if isinstance(default, (int, float)) and key in typed:
+            value = float(typed[key])
+            typed[key] = int(value) if key in INTEGER_PARAMS else value
+    return typed
+
+
+def run_config(params):
+    """Return the canonical configuration that identifies a run"""
+    params = _typed(dict(DEFAULT_PARAMS, **params))
+    physical = {key: _canonical(value) for key, value in params.items() if key not in NON_PHYSICAL_KEYS}
+    xml = build_input_xml(dict(params, socket_mode="unix", checkpoint_stride=0), "RUN_DIR", "SOCKET")
+    return {
+        "params": physical,
+        "input_xml": xml,
+        "init_xyz": init_xyz(params),
+        "force_field": force_field_input(params),
+    }
+
+
+def run_key(params):
+    """Return the SHA-256 key of the run described by params"""
+    canonical = json.dumps(run_config(params), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+def _read_meta(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, META_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(entry_dir, meta):
+    tmp_file = os.path.join(entry_dir, META_FILE + ".tmp")
+    with open(tmp_file, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_file, os.path.join(entry_dir, META_FILE))
+
+
+def list_runs(cache_dir=CACHE_DIR):
+    """Return the meta data of all cached runs, most recently used first"""
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for key in os.listdir(cache_dir):
+        meta = _read_meta(os.path.join(cache_dir, key))
+        if meta is not None:
+            meta["path"] = os.path.join(cache_dir, key)
+            entries.append(meta)
+    return sorted(entries, key=lambda meta: meta["last_used"], reverse=True)
+
+
+def lookup(params, cache_dir=CACHE_DIR):
+    """Return the cache directory of the run described by params, or None
+
+    A hit counts as a use for the eviction order.
+    """
+    entry_dir = os.path.join(cache_dir, run_key(params))
+    meta = _read_meta(entry_dir)
+    if meta is None:
+        return None
+    meta["last_used"] = time.time()
+    _write_meta(entry_dir, meta)
+    return entry_dir
+
+
+def find_run(cache_dir=CACHE_DIR, **params):
+    """Return the cache directory of a run given its (non-default) parameters, or None"""
+    return lookup(params, cache_dir)
+
+
+def store(run_dir, params=None, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    """Copy a finished run into the cache and return its cache directory
+
+    params defaults to the run_params.json written with the run inputs.
+    """
+    if params is None:
+        with open(os.path.join(run_dir, "run_params.json")) as f:
+            params = json.load(f)
+    key = run_key(params)
+    entry_dir = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(entry_dir, META_FILE)):
+        return entry_dir
+
+    # Copy to a private directory first so that concurrent runs and readers
+    # never see a half-written entry
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f".{key[:12]}-", dir=cache_dir)
+    for name in os.listdir(run_dir):
+        path = os.path.join(run_dir, name)
+        if os.path.isfile(path) and name not in SKIPPED_FILES and not name.endswith(".prev"):
+            shutil.copy2(path, tmp_dir)
+    now = time.time()
+    _write_meta(tmp_dir, {"key": key, "params": params, "source": os.path.abspath(run_dir),
+                          "created": now, "last_used": now, "size": _dir_size(tmp_dir)})
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another process stored the same run first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    evict(max_bytes, cache_dir, keep=key)
+    return entry_dir
+
+
+def restore(key, run_dir, cache_dir=CACHE_DIR):
+    """Copy the cached run key into run_dir (files of the same name are replaced)"""
+    entry_dir = os.path.join(cache_dir, key)
+    meta = _read_meta(entry_dir)
+    if meta is None:
+        raise KeyError(f"No cached run {key}")
+    os.makedirs(run_dir, exist_ok=True)
+    for name in os.listdir(entry_dir):
+        path = os.path.join(entry_dir, name)
+        if os.path.isfile(path) and name != META_FILE:
+            shutil.copy2(path, run_dir)
+    meta["last_used"] = time.time()
+    _write_meta(entry_dir, meta)
+    return run_dir
+
+
+def evict(max_bytes=MAX_BYTES, cache_dir=CACHE_DIR, keep=None):
+    """Remove least recently used runs until the cache is below max_bytes
+
+    The run with key keep (e.g. the one just stored) is never removed.
+
+    Returns:
+        list: keys of the removed runs
+    """
+    entries = list_runs(cache_dir)
+    total = sum(meta["size"] for meta in entries)
+    entries = [meta for meta in entries if meta["key"] != keep]
+    removed = []
+    while entries and total > max_bytes:
+        meta = entries.pop()
+        shutil.rmtree(meta["path"], ignore_errors=True)
+        total -= meta["size"]
+        removed.append(meta["key"])
+    return removed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage the cache of finished PIMD runs")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="List the cached runs, most recently used first")
+    restore_parser = commands.add_parser("restore", help="Copy a cached run into a run directory")
+    restore_parser.add_argument("key", help="Cache key (a unique prefix is enough)")
+    restore_parser.add_argument("run_dir")
+    evict_parser = commands.add_parser("evict", help="Remove least recently used runs above a size limit")
+    evict_parser.add_argument("--max-gb", type=float, default=MAX_BYTES / 1e9)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "list":
+        for meta in list_runs(args.cache_dir):
+            params = meta["params"]
+            last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(meta["last_used"]))
+            print(f"{meta['key'][:12]}  T={params['temperature']} P={params['nbeads']} "
+                  f"steps={params['total_steps']} {params['driver']}/{params['boundary']}  "
+                  f"{meta['size'] / 1e6:8.1f} MB  last used {last_used}")
+    elif args.command == "restore":
+        keys = [meta["key"] for meta in list_runs(args.cache_dir) if meta["key"].startswith(args.key)]
+        if len(keys) != 1:
+            print(f"Error: {len(keys)} cached runs match {args.key}")
+            sys.exit(1)
+        print(f"Restored {keys[0][:12]} to {restore(keys[0], args.run_dir, args.cache_dir)}")
+    elif args.command == "evict":
+        removed = evict(int(args.max_gb * 1e9), args.cache_dir)
+        print(f"Removed {len(removed)} cached runs")
@@ -1,7 +1,10 @@
 from ipi.engine.simulation import Simulation
+import argparse
 import os
 import sys
 
+from profiling import Profiler
+
 def create_init_xyz():
     with open('init.xyz', 'w') as f:
         f.write("""3
@@ -11,9 +14,21 @@ H     0.958   0.000   0.000
 H    -0.239   0.927   0.000
 """)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the i-PI server for one PIMD run")
+    parser.add_argument("--socket", default="water_ipi",
+                        help="Unix socket name given in input.xml (default: water_ipi)")
+    parser.add_argument("--input", default="input.xml",
+                        help="i-PI input file (default: input.xml)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile loading the input and the run, written to profiles/ipi.* (see profiling.py)")
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = parse_args()
+
     # Check and remove socket if it exists
-    socket_path = "/tmp/ipi_water_ipi"
+    socket_path = f"/tmp/ipi_{args.socket}"
     if os.path.exists(socket_path):
         try:
             os.remove(socket_path)
@@ -21,19 +36,27 @@ if __name__ == "__main__":
         except Exception as e:
             print(f"Error removing socket file: {e}")
             sys.exit(1)
-    
+
     # Create init.xyz file
-    create_init_xyz()
-    
+    if not os.path.exists("init.xyz"):
+        create_init_xyz()
+
     # Check if input.xml exists
-    if not os.path.exists("input.xml"):
-        print("Error: input.xml file not found!")
+    if not os.path.exists(args.input):
+        print(f"Error: {args.input} file not found!")
         sys.exit(1)
-    
+
     print("Starting i-PI simulation...")
+    profiler = Profiler("ipi") if args.profile else None
+    if profiler:
+        profiler.start()
     try:
-        simulation = Simulation.load_from_xml("input.xml")
+        simulation = Simulation.load_from_xml(args.input)
         simulation.run()
     except Exception as e:
         print(f"Error running i-PI: {e}")
         sys.exit(1)
+    finally:
+        # i-PI ends the run with sys.exit(), so the profile is written here
+        if profiler:
+            profiler.stop()
@@ -1,12 +1,22 @@
-from lammps import lammps
+import argparse
 import time
 import os
 import sys
-
-
-def create_water_data():
-    with open('water.data', 'w') as f:
-        f.write("""# Water molecule structure (q-TIP4P/f)
+import tempfile
+
+from ipi_socket import wait_for_server
+from profiling import Profiler, profile_name
+from simulation_config import CELL_LENGTH, QTIP4PF
+from water_box import read_init_xyz, write_water_data
+
+def create_water_data(filename='water.data', cell_length=CELL_LENGTH["periodic"], positions=None):
+    """Write the LAMMPS data file of the single water molecule, or of the molecules at positions"""
+    if positions is not None and len(positions) > 3:
+        write_water_data(filename, positions, cell_length)
+        return
+    half = 0.5 * cell_length
+    with open(filename, 'w') as f:
+        f.write(f"""# Water molecule structure (q-TIP4P/f)
 
 3 atoms
 2 bonds
@@ -15,20 +25,20 @@ def create_water_data():
 1 bond types
 1 angle types
 
--10.0 10.0 xlo xhi
--10.0 10.0 ylo yhi
--10.0 10.0 zlo zhi
+{-half} {half} xlo xhi
+{-half} {half} ylo yhi
+{-half} {half} zlo zhi
 
 Masses
 
-1 15.9994 # O
-2 1.008   # H
+1 {QTIP4PF["mass_O"]} # O
+2 {QTIP4PF["mass_H"]}   # H
 
 Atoms # full
 
-1 1 1 -1.1128 0.0 0.0 0.0
-2 1 2 0.5564  0.9419 0.0 0.0
-3 1 2 0.5564  -0.2392 0.9087 0.0
+1 1 1 {QTIP4PF["charge_O"]} 0.0 0.0 0.0
+2 1 2 {QTIP4PF["charge_H"]}  0.9419 0.0 0.0
+3 1 2 {QTIP4PF["charge_H"]}  -0.2392 0.9087 0.0
 
 Bonds
 
@@ -40,29 +50,62 @@ Angles
 1 1 2 1 3
 """)
 
-def create_lammps_input():
-    socket_name = "water_ipi"
-    
-    with open('in.water_ipi', 'w') as f:
+def create_lammps_input(socket_name="water_ipi", filename='in.water_ipi', data_file='water.data',
+                        boundary="periodic", mode="unix", host="localhost", port=32345, part=None):
+    """Write the LAMMPS input of a q-TIP4P/f driver
+
+    part selects the terms for a split force field (see
+    simulation_config.forces_xml): "intra" only the O-H bonds and H-O-H
+    angles, "inter" only Lennard-Jones and Coulomb; None the full force field.
+    """
+    # An isolated molecule or small cluster needs no Ewald mesh: use
+    # non-periodic boundaries and direct, cut-off Coulomb instead of PPPM
+    if boundary == "cluster":
+        boundary_line = "boundary f f f"
+        pair_style = "lj/cut/tip4p/cut"
+        kspace = ""
+    else:
+        boundary_line = "boundary p p p"
+        pair_style = "lj/cut/tip4p/long"
+        kspace = "kspace_style pppm/tip4p 1.0e-4\n"
+
+    pair_lines = f"""pair_style {pair_style} 1 2 1 1 {QTIP4PF["m_site"]} {QTIP4PF["cutoff"]}
+pair_coeff * * 0.0 0.0
+pair_coeff 1 1 {QTIP4PF["epsilon_OO"]} {QTIP4PF["sigma_OO"]}  # O-O LJ parameters"""
+    bond_lines = f"""bond_style harmonic
+angle_style harmonic
+bond_coeff 1 {QTIP4PF["k_bond"]} {QTIP4PF["r0"]}    # O-H bond
+angle_coeff 1 {QTIP4PF["k_angle"]} {QTIP4PF["theta0"]}     # H-O-H angle"""
+    if part == "intra":
+        pair_lines = f"pair_style zero {QTIP4PF['cutoff']}\npair_coeff * *"
+        kspace = ""
+    elif part == "inter":
+        # The TIP4P pair styles place the M site with the equilibrium bond
+        # length and angle, so the zero styles keep them
+        bond_lines = f"""bond_style zero
+angle_style zero
+bond_coeff 1 {QTIP4PF["r0"]}
+angle_coeff 1 {QTIP4PF["theta0"]}"""
+
+    # unix: the address is the socket name; inet: host and TCP port
+    if mode == "inet":
+        ipi_fix = f"fix 1 all ipi {host} {port}"
+    else:
+        ipi_fix = f"fix 1 all ipi {socket_name} 32345 unix"
+
+    with open(filename, 'w') as f:
         f.write(f"""units real
 atom_style full
-boundary p p p
-read_data water.data
+{boundary_line}
+read_data {data_file}
 
 # Force field parameters (q-TIP4P/f)
-pair_style lj/cut/tip4p/long 1 2 1 1 0.1577 17.007
-bond_style harmonic
-angle_style harmonic
-
-pair_coeff * * 0.0 0.0
-pair_coeff 1 1 0.1852 3.1589  # O-O LJ parameters
-bond_coeff 1 1089.1 0.9419    # O-H bond
-angle_coeff 1 87.85 107.4     # H-O-H angle
-
-kspace_style pppm/tip4p 1.0e-4
+{pair_lines}
+{bond_lines}
 
+{kspace}
 # i-PI socket communication
-fix 1 all ipi {socket_name} 32345 unix
+{ipi_fix}
 
 timestep 0.5  # Match the timestep in i-PI input
 thermo_style custom step temp pe ke etotal press
@@ -70,31 +113,102 @@ thermo 10
 run 1000000000  # Let i-PI control the simulation length
 """)
 
+def create_engine(boundary="periodic", part=None):
+    """Return a LAMMPS instance with the q-TIP4P/f force field (or one part of it) but no i-PI coupling"""
+    from lammps import lammps
+    with tempfile.TemporaryDirectory() as tmp:
+        data_file = os.path.join(tmp, 'water.data')
+        input_file = os.path.join(tmp, 'in.water_ipi')
+        create_water_data(data_file, CELL_LENGTH[boundary])
+        create_lammps_input(filename=input_file, data_file=data_file, boundary=boundary, part=part)
+
+        # Everything up to the i-PI coupling defines the force field
+        with open(input_file) as f:
+            setup = f.read().split("# i-PI socket communication")[0]
+
+        lmp = lammps(cmdargs=["-log", "none", "-screen", "none"])
+        lmp.commands_string(setup)
+    return lmp
+
+def benchmark(ncalls=2000):
+    """Print LAMMPS force calls per second for the periodic and cluster inputs"""
+    for boundary in ("periodic", "cluster"):
+        lmp = create_engine(boundary)
+        lmp.command("run 0")
+        start_time = time.perf_counter()
+        lmp.command(f"run {ncalls} pre no post no")
+        rate = ncalls / (time.perf_counter() - start_time)
+        lmp.close()
+        print(f"{boundary:>8}: {rate:10.1f} force calls/s")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run a LAMMPS force driver for i-PI")
+    parser.add_argument("--socket", default="water_ipi",
+                        help="Unix socket name of the i-PI server (default: water_ipi)")
+    parser.add_argument("--client-id", type=int, default=0,
+                        help="Index of this driver when several connect to the same server")
+    parser.add_argument("--boundary", choices=["periodic", "cluster"], default="periodic",
+                        help="Periodic box with PPPM, or isolated molecule/cluster with direct Coulomb")
+    parser.add_argument("--mode", choices=["unix", "inet"], default="unix",
+                        help="Socket type of the i-PI server (inet lets the driver run on another node)")
+    parser.add_argument("--host", default="localhost",
+                        help="Host of the i-PI server in inet mode")
+    parser.add_argument("--port", type=int, default=32345,
+                        help="TCP port of the i-PI server in inet mode")
+    parser.add_argument("--part", choices=["intra", "inter"], default=None,
+                        help="Compute only the intramolecular or the intermolecular forces (split force field)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Compare force calls per second of the periodic and cluster inputs, then exit")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the force loop, written to profiles/lammps*.* (see profiling.py)")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    socket_path = "/tmp/ipi_water_ipi"
-    print(f"Looking for socket at: {socket_path}")
+    # Imported here so the input generators above work without LAMMPS
+    from lammps import lammps
+
+    args = parse_args()
+    if args.benchmark:
+        benchmark()
+        sys.exit(0)
+
+    if args.mode == "inet":
+        address = (args.host, args.port)
+    else:
+        address = f"/tmp/ipi_{args.socket}"
+    print(f"Looking for i-PI at: {address}")
     
-    create_water_data()
-    create_lammps_input()
+    # Several drivers can share a run directory, so each one after the
+    # first gets its own input, data and log files
+    suffix = f".{args.client_id}" if args.client_id else ""
+    input_file = f"in.water_ipi{suffix}"
+    data_file = f"water.data{suffix}"
+    # The data file holds the molecules i-PI starts from (init.xyz of the run)
+    positions, cell_length = read_init_xyz("init.xyz") if os.path.exists("init.xyz") else (None, None)
+    create_water_data(data_file, cell_length or CELL_LENGTH[args.boundary], positions)
+    create_lammps_input(args.socket, input_file, data_file, args.boundary, args.mode, args.host, args.port,
+                        args.part)
     
-    # Wait for i-PI to initialize
-    print("Waiting for i-PI to initialize...")
+    # fix ipi connects only once, so start LAMMPS as soon as i-PI accepts
+    # connections rather than when the socket file appears
+    print("Waiting for i-PI to accept connections...")
     max_wait = 30  # Maximum wait time in seconds
-    start_time = time.time()
-    
-    while not os.path.exists(socket_path):
-        if time.time() - start_time > max_wait:
-            print(f"Error: i-PI socket file not found at {socket_path} after waiting")
-            sys.exit(1)
-        time.sleep(1)
-        print(f"Waiting for socket file at {socket_path}...")
-    
-    print("Socket file found, starting LAMMPS...")
-    time.sleep(2)  # Give a little extra time for i-PI to be ready
+    if not wait_for_server(address, timeout=max_wait):
+        print(f"Error: i-PI is not listening at {address} after {max_wait} s")
+        sys.exit(1)
+    print("i-PI is listening, starting LAMMPS...")
     
+    # The force loop runs in C++, so the profile splits it by CPU time
+    profiler = Profiler(profile_name("lammps", args.client_id, args.part), native=True) if args.profile else None
+    if profiler:
+        profiler.start()
     try:
-        lmp = lammps()
-        lmp.file("in.water_ipi")
+        lmp = lammps(cmdargs=["-log", f"log.lammps{suffix}"])
+        lmp.file(input_file)
     except Exception as e:
         print(f"Error running LAMMPS: {e}")
         sys.exit(1)
+    finally:
+        # fix ipi ends the run with an error once i-PI sends EXIT
+        if profiler:
+            profiler.stop()
@@ -0,0 +1,250 @@
+"""Progress, throughput and ETA of a running simulation
+
+RunMetrics works out the current MD step of a run from the i-PI output
+(with verbosity 'high' i-PI reports "Average timings at MD step N" after
+every step) and, if that is not available, from the last row of
+simulation.out, which is only written every stride steps. The LAMMPS
+drivers only see force requests and know nothing about steps. From the
+steps done in a moving time window it computes steps/s, ns/day and the
+ETA against total_steps.
+
+The metrics are written to a file in the run directory:
+
+    prometheus  metrics.prom, a Prometheus textfile replaced atomically on
+                every update. If PIMD_METRICS_DIR is set (e.g. the
+                node_exporter textfile collector directory), a copy named
+                pimd_<run>.prom is written there as well
+    csv         metrics.csv, one row per update
+
+Example (follow a run started elsewhere):
+    python run_metrics.py ../pimd_run_1 --total-steps 80000 --timestep 0.5 --watch 5
+"""
+import argparse
+import collections
+import os
+import re
+import sys
+import threading
+import time
+
+from property_monitor import PropertiesTail
+from simulation_config import PARAM_CHOICES
+
+METRICS_FORMATS = PARAM_CHOICES["metrics_format"]
+METRICS_FILES = {"prometheus": "metrics.prom", "csv": "metrics.csv"}
+METRICS_DIR = os.environ.get("PIMD_METRICS_DIR", "")
+
+# i-PI prints " # Average timings at MD step     123. t/step: ..." every step
+IPI_STEP_PATTERN = re.compile(rb"MD step\s+(\d+)")
+
+# (name, help) of the gauges written to the Prometheus textfile
+GAUGES = [
+    ("pimd_running", "1 while the simulation is running"),
+    ("pimd_step", "Current MD step"),
+    ("pimd_total_steps", "MD steps of the whole run"),
+    ("pimd_progress_ratio", "Fraction of total_steps done"),
+    ("pimd_steps_per_second", "MD steps per second, moving average"),
+    ("pimd_ns_per_day", "Simulated nanoseconds per day, moving average"),
+    ("pimd_eta_seconds", "Estimated seconds until total_steps"),
+    ("pimd_elapsed_seconds", "Seconds since the run started"),
+]
+
+
+def format_duration(seconds):
+    """Return seconds as h:mm:ss"""
+    if seconds is None:
+        return "--:--:--"
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class RunMetrics:
+    """Current step, moving-average throughput and ETA of one run
+
+    observe_output() may be called from another thread (e.g. with the
+    i-PI lines of a ProcessSupervisor) while update() runs in this one.
+    """
+
+    def __init__(self, run_dir, total_steps, timestep_fs, start_step=0, metrics_format="prometheus", window=60.0,
+                 ipi_log=None, labels=None, prefix="simulation"):
+        self.run_dir = run_dir
+        self.total_steps = int(total_steps)
+        self.timestep_fs = float(timestep_fs)
+        self.start_step = int(start_step)
+        self.metrics_format = metrics_format
+        self.window = window
+        self.labels = dict(labels or {}, run=os.path.basename(os.path.normpath(run_dir)))
+        self.tail = PropertiesTail(os.path.join(run_dir, f"{prefix}.out"))
+        self.ipi_log = ipi_log
+        # A resumed run appends to the log of the earlier run
+        self.ipi_log_offset = os.path.getsize(ipi_log) if ipi_log and os.path.exists(ipi_log) else 0
+        self.ipi_step = None
+        self.step = self.start_step
+        self.started = time.time()
+        self.samples = collections.deque()
+        self.running = True
+        self.lock = threading.Lock()
+        if metrics_format == "csv":
+            with open(self.metrics_file, 'w') as f:
+                f.write("time,step,total_steps,steps_per_second,ns_per_day,eta_seconds\n")
+
+    @property
+    def metrics_file(self):
+        return os.path.join(self.run_dir, METRICS_FILES[self.metrics_format])
+
+    def observe_output(self, text):
+        """Take the current step from a chunk of i-PI output"""
+        if isinstance(text, str):
+            text = text.encode()
+        steps = IPI_STEP_PATTERN.findall(text)
+        if steps:
+            with self.lock:
+                self.ipi_step = int(steps[-1])
+
+    def _read_ipi_log(self):
+        try:
+            with open(self.ipi_log, 'rb') as f:
+                f.seek(self.ipi_log_offset)
+                data = f.read()
+        except OSError:
+            return
+        # Keep an incomplete last line for the next call
+        end = data.rfind(b"\n") + 1
+        self.ipi_log_offset += end
+        self.observe_output(data[:end])
+
+    def _properties_step(self):
+        rows = self.tail.read_new()
+        if len(rows) and "step" in self.tail.columns:
+            return int(self.tail.column(rows, "step")[-1])
+        return None
+
+    def update(self, now=None):
+        """Read the current step and return the metrics"""
+        now = now or time.time()
+        if self.ipi_log:
+            self._read_ipi_log()
+        properties_step = self._properties_step()
+        with self.lock:
+            # simulation.out lags by up to stride steps, so the larger step wins
+            steps = [step for step in (self.ipi_step, properties_step, self.step) if step is not None]
+            self.step = min(max(steps), self.total_steps)
+        self.samples.append((now, self.step))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+        return self.metrics(now)
+
+    def metrics(self, now=None):
+        now = now or time.time()
+        steps_per_second = None
+        if len(self.samples) > 1:
+            (first_time, first_step), (last_time, last_step) = self.samples[0], self.samples[-1]
+            if last_time > first_time:
+                steps_per_second = (last_step - first_step) / (last_time - first_time)
+        remaining = self.total_steps - self.step
+        return {
+            "running": int(self.running),
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "progress": self.step / self.total_steps if self.total_steps else 1.0,
+            "steps_per_second": steps_per_second,
+            "ns_per_day": steps_per_second * self.timestep_fs * 0.0864 if steps_per_second is not None else None,
+            "eta_seconds": (0.0 if remaining <= 0 else remaining / steps_per_second if steps_per_second else None),
+            "elapsed": now - self.started,
+        }
+
+    def status_line(self, metrics=None):
+        """Return e.g. "Step 12300 / 80000 (15.4%) | 152.3 steps/s | 6.58 ns/day | ETA 0:06:19" """
+        metrics = metrics or self.metrics()
+        line = f"Step {metrics['step']} / {metrics['total_steps']} ({metrics['progress']:.1%})"
+        if metrics["steps_per_second"] is not None:
+            line += f" | {metrics['steps_per_second']:.1f} steps/s | {metrics['ns_per_day']:.3f} ns/day"
+        return line + f" | ETA {format_duration(metrics['eta_seconds'])}"
+
+    def prometheus_text(self, metrics):
+        labels = ",".join(f'{key}="{value}"' for key, value in sorted(self.labels.items()))
+        values = {
+            "pimd_running": metrics["running"],
+            "pimd_step": metrics["step"],
+            "pimd_total_steps": metrics["total_steps"],
+            "pimd_progress_ratio": metrics["progress"],
+            "pimd_steps_per_second": metrics["steps_per_second"],
+            "pimd_ns_per_day": metrics["ns_per_day"],
+            "pimd_eta_seconds": metrics["eta_seconds"],
+            "pimd_elapsed_seconds": metrics["elapsed"],
+        }
+        lines = []
+        for name, help_text in GAUGES:
+            # Unknown values (no rate yet) are left out rather than written as NaN
+            if values[name] is not None:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name}{{{labels}}} {values[name]:g}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics=None):
+        """Write the metrics file (nothing with metrics_format 'none')"""
+        metrics = metrics or self.metrics()
+        if self.metrics_format == "prometheus":
+            text = self.prometheus_text(metrics)
+            paths = [self.metrics_file]
+            if METRICS_DIR:
+                paths.append(os.path.join(METRICS_DIR, f"pimd_{self.labels['run']}.prom"))
+            for path in paths:
+                # The collector must never read a half-written file
+                tmp_file = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_file, 'w') as f:
+                    f.write(text)
+                os.replace(tmp_file, path)
+        elif self.metrics_format == "csv":
+            fields = [metrics["step"], metrics["total_steps"], metrics["steps_per_second"], metrics["ns_per_day"],
+                      metrics["eta_seconds"]]
+            with open(self.metrics_file, 'a') as f:
+                f.write(",".join([f"{time.time():.1f}"] + ["" if value is None else f"{value:.6g}"
+                                                          for value in fields]) + "\n")
+
+    def finish(self, completed=True):
+        """Write the final metrics once the run has ended"""
+        self.running = False
+        if completed:
+            self.step = self.total_steps
+        self.write()
+
+
+def run_metrics(params, run_dir, start_step=0, ipi_log=None):
+    """Return the RunMetrics of a run, or None with metrics_format 'none'"""
+    metrics_format = params.get("metrics_format", "prometheus")
+    if metrics_format == "none":
+        return None
+    if metrics_format not in METRICS_FORMATS:
+        raise ValueError(f"Unknown metrics format '{metrics_format}' (choose from {', '.join(METRICS_FORMATS)})")
+    labels = {"temperature": params["temperature"], "nbeads": params["nbeads"]}
+    return RunMetrics(run_dir, params["total_steps"], params["timestep"], start_step, metrics_format,
+                      ipi_log=ipi_log, labels=labels)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Progress, steps/s, ns/day and ETA of a running simulation")
+    parser.add_argument("run_dir")
+    parser.add_argument("--total-steps", type=int, required=True)
+    parser.add_argument("--timestep", type=float, required=True, help="Timestep in fs")
+    parser.add_argument("--format", choices=METRICS_FORMATS, default="prometheus", help="Metrics file to write")
+    parser.add_argument("--watch", type=float, default=5.0, metavar="SECONDS", help="Seconds between updates")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not os.path.isdir(args.run_dir):
+        print(f"Error: no run directory {args.run_dir}")
+        sys.exit(1)
+    metrics = RunMetrics(args.run_dir, args.total_steps, args.timestep, metrics_format=args.format,
+                         ipi_log=os.path.join(args.run_dir, "ipi_stdout.log"))
+    try:
+        while True:
+            values = metrics.update()
+            metrics.write(values)
+            print(metrics.status_line(values))
+            if values["step"] >= args.total_steps:
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,341 @@
+import json
+import math
+import os
+import uuid
+
+# Default PIMD parameters, shared by the GUI and the headless runners
+DEFAULT_PARAMS = {
+    "temperature": 300,
+    "nbeads": 32,
+    "timestep": 0.5,
+    "total_steps": 80000,
+    "stride": 100,
+    "tau": 100,
+    "dynamics_mode": "nvt",
+    "thermostat_mode": "langevin",
+    "nclients": 1,  # force drivers connected to the i-PI server
+    "driver": "lammps",  # "lammps" or the NumPy q-TIP4P/f driver "numpy"
+    "boundary": "periodic",  # "periodic" (PPPM) or "cluster" (isolated, direct Coulomb)
+    "socket_mode": "unix",  # "unix" (same host) or "inet" (TCP, drivers may run on other nodes)
+    "host": "localhost",  # inet only: address i-PI listens on and the drivers connect to
+    "port": 0,  # inet only: 0 picks a free port for every run
+    "driver_command": "",  # start drivers through this template, e.g. "ssh node01 cd {run_dir} && {command}"
+    "checkpoint_stride": 1000,  # steps between i-PI checkpoints for resuming (0: none)
+    "target_errors": "",  # stop once the block-averaged errors reach these, e.g. "temperature=2, kinetic_cv=0.002"
+    "rpc_beads": 0,  # evaluate the intermolecular forces on this many contracted beads (0: all beads)
+    "mts_steps": 1,  # inner steps of the intramolecular forces per (outer) timestep (1: no MTS)
+    "write_forces": 0,  # 1: also write the bead forces (simulation.for_*.xyz) every stride steps
+    "metrics_format": "prometheus",  # progress metrics file: "prometheus" (metrics.prom), "csv" or "none"
+    "profile": 0,  # 1: profile i-PI and the drivers, written to profiles/ (see profiling.py)
+    "chunk_frames": 0,  # frames per gzip trajectory chunk written during the run (0: plain XYZ files)
+    "nmolecules": 1,  # water molecules; more than one fills a box at density (see water_box.py)
+    "density": 0.997,  # g/cm^3 of a box of nmolecules > 1
+}
+
+# Allowed values of the parameters with a fixed set of choices
+PARAM_CHOICES = {
+    "dynamics_mode": ["nvt", "npt", "nve"],
+    "thermostat_mode": ["langevin", "pile_g", "pile_l", "svr", "ggmt"],
+    "driver": ["lammps", "numpy"],
+    "boundary": ["periodic", "cluster"],
+    "socket_mode": ["unix", "inet"],
+    "metrics_format": ["prometheus", "csv", "none"],
+}
+INTEGER_PARAMS = {"nbeads", "total_steps", "stride", "nclients", "port", "checkpoint_stride", "rpc_beads",
+                  "mts_steps", "write_forces", "profile", "chunk_frames", "nmolecules"}
+POSITIVE_PARAMS = {"temperature", "nbeads", "timestep", "total_steps", "stride", "tau", "nclients", "mts_steps",
+                   "nmolecules", "density"}
+
+
+def validate_params(params):
+    """Return params completed with DEFAULT_PARAMS, as the GUI and pimd_cli.py run them
+
+    Values may be strings, as they come from the GUI entries or the
+    command line; they are checked, not converted.
+
+    Raises:
+        ValueError: for unknown parameters, numbers that are not numbers or out of range and unknown choices
+    """
+    unknown = sorted(set(params) - set(DEFAULT_PARAMS))
+    if unknown:
+        raise ValueError(f"Unknown parameter(s): {', '.join(unknown)}")
+    params = dict(DEFAULT_PARAMS, **params)
+    for key, default in DEFAULT_PARAMS.items():
+        value = params[key]
+        if key in PARAM_CHOICES:
+            if value not in PARAM_CHOICES[key]:
+                raise ValueError(f"{key} must be one of {', '.join(PARAM_CHOICES[key])}, not '{value}'")
+        elif isinstance(default, (int, float)):
+            try:
+                number = int(str(value)) if key in INTEGER_PARAMS else float(value)
+            except (TypeError, ValueError):
+                kind = "an integer" if key in INTEGER_PARAMS else "a number"
+                raise ValueError(f"{key} must be {kind}, not '{value}'") from None
+            if number < 0 or (number == 0 and key in POSITIVE_PARAMS):
+                raise ValueError(f"{key} must be {'positive' if key in POSITIVE_PARAMS else 'non-negative'}, "
+                                 f"not {value}")
+    check_driver(params)
+    return params
+
+
+# Parts of the force field when it is split into a cheap intramolecular
+# (bonds, angles) and an expensive intermolecular (LJ, Coulomb) driver
+FORCE_PARTS = ("intra", "inter")
+
+# Edge of the cubic cell in Angstrom. In cluster mode the cell is only the
+# frame of the non-periodic LAMMPS box, so it is made large enough that the
+# molecules never reach its faces.
+CELL_LENGTH = {
+    "periodic": 20.0,
+    "cluster": 50.0,
+}
+
+# q-TIP4P/f force field as used by the LAMMPS and NumPy drivers (LAMMPS
+# real units: kcal/mol, Angstrom, degrees, e). Bonds and angles are
+# harmonic with E = K (x - x0)^2, as in LAMMPS bond/angle_style harmonic.
+QTIP4PF = {
+    "mass_O": 15.9994,
+    "mass_H": 1.008,
+    "charge_O": -1.1128,
+    "charge_H": 0.5564,
+    "epsilon_OO": 0.1852,
+    "sigma_OO": 3.1589,
+    "k_bond": 1089.1,
+    "r0": 0.9419,
+    "k_angle": 87.85,
+    "theta0": 107.4,
+    "m_site": 0.1577,  # O-M distance
+    "cutoff": 17.007,
+}
+
+INIT_XYZ = """3
+Water molecule
+O     0.000   0.000   0.000
+H     0.958   0.000   0.000
+H    -0.239   0.927   0.000
+"""
+
+AVOGADRO = 6.02214076e23
+
+
+def equilibrium_molecule(params=QTIP4PF):
+    """Return the (O, H, H) rows of a water molecule at the q-TIP4P/f bond length and angle (Angstrom, O at 0)"""
+    half_angle = 0.5 * math.radians(params["theta0"])
+    r0 = params["r0"]
+    return [[0.0, 0.0, 0.0],
+            [r0 * math.sin(half_angle), r0 * math.cos(half_angle), 0.0],
+            [-r0 * math.sin(half_angle), r0 * math.cos(half_angle), 0.0]]
+
+
+def box_length(nmolecules, density):
+    """Return the edge (Angstrom) of the cubic box of nmolecules water molecules at density (g/cm^3)"""
+    grams = nmolecules * (QTIP4PF["mass_O"] + 2 * QTIP4PF["mass_H"]) / AVOGADRO
+    return (grams / density * 1e24) ** (1 / 3)
+
+
+def cell_length(params):
+    """Return the edge of the cubic cell of a run in Angstrom
+
+    A single molecule sits in the CELL_LENGTH cell of its boundary. A box
+    of nmolecules has the edge of its density; in cluster mode the frame
+    leaves the cutoff as room on every side.
+    """
+    boundary = params.get("boundary", "periodic")
+    nmolecules = int(float(params.get("nmolecules", 1)))
+    if nmolecules <= 1:
+        return CELL_LENGTH[boundary]
+    length = box_length(nmolecules, float(params.get("density", DEFAULT_PARAMS["density"])))
+    if boundary == "cluster":
+        return max(CELL_LENGTH["cluster"], length + 2 * QTIP4PF["cutoff"])
+    return length
+
+
+def init_xyz(params):
+    """Return the init.xyz content of a run: INIT_XYZ, or a water box (see water_box.py)"""
+    nmolecules = int(float(params.get("nmolecules", 1)))
+    if nmolecules <= 1:
+        return INIT_XYZ
+    # Imported here: water_box needs this module
+    from water_box import water_box, xyz_text
+    periodic = params.get("boundary", "periodic") == "periodic"
+    positions, length = water_box(nmolecules, float(params.get("density", DEFAULT_PARAMS["density"])),
+                                  periodic=periodic)
+    if not periodic:
+        # A cluster is centered in its larger non-periodic frame
+        positions -= 0.5 * length
+    return xyz_text(positions, cell_length(params))
+
+
+def make_socket_name(prefix="water_ipi"):
+    """Return a socket name that is unique to one run
+
+    i-PI turns a unix socket name into /tmp/ipi_<name>, which must stay
+    below the 108 character limit of AF_UNIX addresses, so keep it short.
+    """
+    return f"{prefix}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+
+
+def socket_path(socket_name):
+    """Return the file i-PI creates for a unix socket name"""
+    return f"/tmp/ipi_{socket_name}"
+
+
+def split_forces(params):
+    """Return True if the run uses ring-polymer contraction or multiple time stepping"""
+    return int(params.get("rpc_beads", 0)) > 0 or int(params.get("mts_steps", 1)) > 1
+
+
+def check_driver(params):
+    """Raise a ValueError if the force driver cannot run the system of params
+
+    The NumPy driver sums the Coulomb terms directly, without the Ewald
+    (PPPM) sum of LAMMPS, so it only runs periodic boxes of one molecule.
+    """
+    nmolecules = int(float(params.get("nmolecules", 1)))
+    if params.get("driver") == "numpy" and params.get("boundary", "periodic") == "periodic" and nmolecules > 1:
+        raise ValueError(f"The NumPy driver has no Ewald sum for a periodic box of {nmolecules} molecules; "
+                         "use driver 'lammps' or boundary 'cluster'")
+
+
+def force_parts(params):
+    """Return the force-field parts that need their own drivers: FORCE_PARTS, or [None] for the full force field"""
+    return list(FORCE_PARTS) if split_forces(params) else [None]
+
+
+def part_socket_name(socket_name, part=None):
+    """Return the unix socket name of one force-field part"""
+    return f"{socket_name}_{part}" if part else socket_name
+
+
+def forcefield_part(forcefield):
+    """Return the part an i-PI forcefield name belongs to (None for the full force field)"""
+    part = forcefield[len("water_"):]
+    return part if part in FORCE_PARTS else None
+
+
+def server_address(params, socket_name, part=None):
+    """Return the address the drivers connect to: a socket path or (host, port)"""
+    if params.get("socket_mode", "unix") == "inet":
+        return (params.get("host", "localhost"), int(params["port"]))
+    return socket_path(part_socket_name(socket_name, part))
+
+
+def forces_xml(params, socket_name):
+    """Return the <ffsocket> and <forces> elements and the <nmts> of the dynamics
+
+    The full force field is one forcefield on all beads. With ring-polymer
+    contraction the intermolecular part is evaluated on rpc_beads beads
+    only; with multiple time stepping it is evaluated once per timestep and
+    the intramolecular part mts_steps times with a timestep/mts_steps step.
+    """
+    check_driver(params)
+    rpc_beads = int(params.get("rpc_beads", 0))
+    mts_steps = int(params.get("mts_steps", 1))
+    if not split_forces(params):
+        if params.get("socket_mode", "unix") == "inet":
+            sockets = f"""<ffsocket mode='inet' name='water_ipi'>
+        <address>{params.get("host", "localhost")}</address>
+        <port>{params["port"]}</port>
+    </ffsocket>"""
+        else:
+            sockets = f"""<ffsocket mode='unix' name='water_ipi'>
+        <address>{socket_name}</address>
+        <port>32345</port>
+    </ffsocket>"""
+        return sockets, "<forces><force forcefield='water_ipi'></force></forces>", ""
+
+    if params.get("socket_mode", "unix") == "inet":
+        raise ValueError("Ring-polymer contraction and multiple time stepping need socket_mode 'unix'")
+    if rpc_beads > int(params["nbeads"]):
+        raise ValueError(f"rpc_beads ({rpc_beads}) cannot exceed nbeads ({params['nbeads']})")
+    sockets = "\n    ".join(f"""<ffsocket mode='unix' name='water_{part}'>
+        <address>{part_socket_name(socket_name, part)}</address>
+        <port>32345</port>
+    </ffsocket>""" for part in FORCE_PARTS)
+    contraction = f" nbeads='{rpc_beads}'" if rpc_beads > 0 else ""
+    if mts_steps > 1:
+        forces = f"""<forces>
+            <force forcefield='water_intra'><mts_weights>[0, 1]</mts_weights></force>
+            <force forcefield='water_inter'{contraction}><mts_weights>[1, 0]</mts_weights></force>
+        </forces>"""
+        nmts = f"\n                <nmts>[1, {mts_steps}]</nmts>"
+    else:
+        forces = f"""<forces>
+            <force forcefield='water_intra'></force>
+            <force forcefield='water_inter'{contraction}></force>
+        </forces>"""
+        nmts = ""
+    return sockets, forces, nmts
+
+
+def run_dir_name(params, extra_keys=()):
+    """Return the run directory name used by the analysis notebooks
+
+    Runs are named pimd_T{temperature}_P{nbeads}; any keys in extra_keys
+    (e.g. the other axes of a campaign grid) are appended so that every
+    point of a grid gets its own directory.
+    """
+    name = f"pimd_T{params['temperature']}_P{params['nbeads']}"
+    for key in extra_keys:
+        name += f"_{key}-{params[key]}"
+    return name
+
+
+def build_input_xml(params, work_dir, socket_name="water_ipi"):
+    """Return the i-PI input.xml content for the given parameters"""
+    cell = cell_length(params)
+    # A checkpoint holds positions and momenta of all beads plus the
+    # thermostat and random number state; it is overwritten every time
+    checkpoint_stride = int(params.get("checkpoint_stride", 0))
+    checkpoint_xml = (f"\n        <checkpoint stride='{checkpoint_stride}' filename='chk' overwrite='true'/>"
+                      if checkpoint_stride > 0 else "")
+    socket_xml, forces, nmts = forces_xml(params, socket_name)
+    # Forces at the same frames as the positions, for the centroid-virial estimator
+    forces_trajectory = (f"\n        <trajectory filename='for' stride='{params['stride']}'> forces{{ev/ang}} </trajectory>"
+                         if int(params.get("write_forces", 0)) else "")
+    return f'''<simulation verbosity='high'>
+    <output prefix='{os.path.join(work_dir, "simulation")}'>
+        <properties stride='{params["stride"]}' filename='out'>  [ step, time{{picosecond}}, temperature{{kelvin}},
+            conserved{{electronvolt}}, potential{{electronvolt}}, kinetic_cv{{electronvolt}} ] </properties>
+        <trajectory filename='pos' stride='{params["stride"]}'> positions{{angstrom}} </trajectory>{forces_trajectory}{checkpoint_xml}
+    </output>
+    <total_steps>{params["total_steps"]}</total_steps>
+    <prng><seed>32345</seed></prng>
+    {socket_xml}
+    <system>
+        <initialize nbeads='{params["nbeads"]}'>
+            <file mode='xyz'> {os.path.join(work_dir, "init.xyz")} </file>
+            <cell mode='abc' units='angstrom'> [{cell}, {cell}, {cell}] </cell>
+        </initialize>
+        {forces}
+        <ensemble>
+            <temperature units='kelvin'>{params["temperature"]}</temperature>
+        </ensemble>
+        <motion mode='dynamics'>
+            <dynamics mode='{params["dynamics_mode"]}'>
+                <timestep units='femtosecond'>{params["timestep"]}</timestep>{nmts}
+                <thermostat mode='{params["thermostat_mode"]}'>
+                    <tau units='femtosecond'>{params["tau"]}</tau>
+                </thermostat>
+            </dynamics>
+        </motion>
+    </system>
+</simulation>'''
+
+
+def write_run_inputs(params, work_dir, socket_name="water_ipi"):
+    """Write input.xml, init.xyz and run_params.json into work_dir and return the XML content"""
+    os.makedirs(work_dir, exist_ok=True)
+    xml_content = build_input_xml(params, work_dir, socket_name)
+
+    with open(os.path.join(work_dir, "input.xml"), "w") as f:
+        f.write(xml_content)
+
+    with open(os.path.join(work_dir, "init.xyz"), "w") as f:
+        f.write(init_xyz(params))
+
+    # The parameters of the run, for the result cache and the analysis
+    with open(os.path.join(work_dir, "run_params.json"), "w") as f:
+        json.dump(params, f, indent=2)
+
+    return xml_content
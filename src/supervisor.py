@@ -0,0 +1,210 @@
+"""Single-threaded supervision of the i-PI and driver processes
+
+One selector watches the stdout pipes of all child processes and, where
+the platform has pidfds (Linux), the processes themselves. Output lines
+and exits are turned into ProcessEvent tuples as soon as they happen,
+without a thread per stream. process.poll() only collects the exit code
+of each child after the selector woke up (output, a readable pidfd, a
+closed pipe or the timeout tick of events()), never in a busy loop.
+
+close() releases the selector, its wakeup sockets and the pidfds; the
+stdout pipes belong to the Popen objects and are closed by their owner.
+
+Headless use (events() blocks in the calling thread):
+    supervisor = ProcessSupervisor()
+    supervisor.add("I-PI", ipi_process)
+    for event in supervisor.events():
+        if event.kind == "exit":
+            print(event.name, event.returncode)
+
+launcher.run_simulation (used by the GUI, pimd_cli.py and campaign.py) runs
+this loop and writes the output lines to the log files of the run;
+start() runs the same loop in one background thread and hands every
+event to a callback.
+"""
+import collections
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+
+ProcessEvent = collections.namedtuple("ProcessEvent", ["kind", "name", "text", "returncode", "time"])
+ProcessEvent.__doc__ = """kind is "output" (text holds one line) or "exit" (returncode is set)"""
+
+# Fallback check interval for processes that can be watched neither by a
+# pidfd nor by the end of their stdout pipe
+POLL_INTERVAL = 0.5
+
+
+class _Child:
+    def __init__(self, name, process):
+        self.name = name
+        self.process = process
+        self.partial = b""
+        self.pipe_open = False
+        self.pidfd = None
+        self.exited = False
+
+
+class ProcessSupervisor:
+    """Watch the output and exit of several subprocess.Popen objects"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.children = []
+        self.added = queue.SimpleQueue()
+        self.closed = False
+        self.released = False
+        self.loop_thread = None
+        # Wakes the selector when processes are added from another thread
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, None)
+
+    def add(self, name, process):
+        """Supervise process under name (safe from any thread)
+
+        The stdout of process must be a pipe or a file; a pipe is read by the
+        supervisor and must not be read anywhere else.
+        """
+        self.added.put(_Child(name, process))
+        self.wakeup_writer.send(b"\0")
+
+    def close(self):
+        """Stop the event loop and release its file descriptors; the processes themselves are left alone
+
+        Called from another thread while events() runs, the loop is woken
+        up and releases them when it ends.
+        """
+        self.closed = True
+        if self.loop_thread is not None and self.loop_thread is not threading.current_thread():
+            self.wakeup_writer.send(b"\0")
+        else:
+            self._release()
+
+    def _release(self):
+        if self.released:
+            return
+        self.released = True
+        for child in self.children:
+            if child.pidfd is not None:
+                os.close(child.pidfd)
+                child.pidfd = None
+        self.selector.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+    def _register_added(self):
+        while True:
+            try:
+                child = self.added.get_nowait()
+            except queue.Empty:
+                return
+            self.children.append(child)
+            stdout = child.process.stdout
+            if stdout is not None:
+                os.set_blocking(stdout.fileno(), False)
+                self.selector.register(stdout.fileno(), selectors.EVENT_READ, (child, "pipe"))
+                child.pipe_open = True
+            if hasattr(os, "pidfd_open"):
+                try:
+                    child.pidfd = os.pidfd_open(child.process.pid)
+                    self.selector.register(child.pidfd, selectors.EVENT_READ, (child, "exit"))
+                except OSError:
+                    child.pidfd = None
+
+    def _read_pipe(self, child):
+        """Return output events for what can be read from the pipe of child now"""
+        events = []
+        fd = child.process.stdout.fileno()
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return events
+        now = time.time()
+        if data:
+            lines = (child.partial + data).split(b"\n")
+            child.partial = lines.pop()
+        else:
+            lines = [child.partial] if child.partial else []
+            child.partial = b""
+            self.selector.unregister(fd)
+            child.pipe_open = False
+        for line in lines:
+            events.append(ProcessEvent("output", child.name, line.decode(errors="replace").rstrip("\r"),
+                                       None, now))
+        return events
+
+    def _check_exit(self, child):
+        """Return the remaining output and the exit event if child has exited"""
+        if child.exited or child.process.poll() is None:
+            return []
+        child.exited = True
+        if child.pidfd is not None:
+            self.selector.unregister(child.pidfd)
+            os.close(child.pidfd)
+            child.pidfd = None
+        # Output still buffered in the pipe comes before the exit
+        events = []
+        while child.pipe_open:
+            new_events = self._read_pipe(child)
+            if not new_events and child.pipe_open:
+                # Only a process that inherited the pipe can keep it open
+                self.selector.unregister(child.process.stdout.fileno())
+                child.pipe_open = False
+                if child.partial:
+                    new_events.append(ProcessEvent("output", child.name, child.partial.decode(errors="replace"),
+                                                   None, time.time()))
+                    child.partial = b""
+            events.extend(new_events)
+        events.append(ProcessEvent("exit", child.name, None, child.process.returncode, time.time()))
+        return events
+
+    def _needs_polling(self):
+        return any(not c.exited and c.pidfd is None and not c.pipe_open for c in self.children)
+
+    def events(self, timeout=None):
+        """Yield events until every supervised process has exited
+
+        With a timeout, None is yielded whenever nothing happened for that
+        many seconds, so the caller can do periodic work in the same loop.
+        """
+        self.loop_thread = threading.current_thread()
+        try:
+            self._register_added()
+            while not self.closed and (any(not c.exited for c in self.children) or not self.added.empty()):
+                wait = timeout
+                if self._needs_polling():
+                    wait = POLL_INTERVAL if wait is None else min(wait, POLL_INTERVAL)
+
+                ready = self.selector.select(wait)
+                if not ready and timeout is not None:
+                    yield None
+                for key, _ in ready:
+                    if key.data is None:
+                        self.wakeup_reader.recv(4096)
+                        continue
+                    child, source = key.data
+                    if source == "pipe" and child.pipe_open:
+                        yield from self._read_pipe(child)
+
+                # Only checked after the selector woke up (output, a readable
+                # pidfd, a closed pipe) or on a timeout tick, never in a busy loop
+                for child in self.children:
+                    yield from self._check_exit(child)
+                self._register_added()
+        finally:
+            self.loop_thread = None
+            if self.closed:
+                self._release()
+
+    def start(self, callback):
+        """Run the event loop in a daemon thread, calling callback(event)"""
+        def loop():
+            for event in self.events():
+                callback(event)
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        return thread
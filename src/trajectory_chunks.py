@@ -0,0 +1,424 @@
+"""Background compression of the trajectory files of a running simulation
+
+i-PI appends every frame of every bead to simulation.pos_<bead>.xyz (and
+simulation.for_<bead>.xyz), uncompressed. With chunk_frames > 0 a
+ChunkCompressor thread rotates the completed frames of these files into
+gzip chunks while the run goes on:
+
+    simulation.pos_07.xyz.00000.gz     chunk_frames frames each
+    simulation.pos_07.xyz.chunks.json  the chunks with their byte range in
+                                       the original file
+
+i-PI keeps the .xyz file open and appends to it, so it can be neither
+renamed nor cut. Instead the disk space of a compressed range is freed in
+place by punching a hole into the file (Linux, fallocate), which keeps its
+size and the offset i-PI writes at. Holes are punched PUNCH_DELAY seconds
+after a chunk is written, so readers that opened the file before keep
+reading valid data. When the run ends, finish() compresses the rest and
+removes the .xyz file. The thread runs at a lower priority and zlib
+releases the GIL, so neither the simulation nor the launcher has to wait
+for it.
+
+open_trajectory(path) returns a binary file object that reads the chunks
+(decompressed as a stream) followed by the uncompressed rest, at the byte
+offsets of the original file. xyz_reader and trajectory_store read through
+it, so compressed and plain runs are read alike.
+
+Example:
+    python trajectory_chunks.py ../pimd_run_1 --chunk-frames 1000   # compress a finished run
+    python trajectory_chunks.py ../pimd_run_1 --watch 10            # follow a running one
+    python trajectory_chunks.py ../pimd_run_1 --expand              # back to plain XYZ files
+"""
+import argparse
+import bisect
+import ctypes
+import glob
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+MANIFEST_SUFFIX = ".chunks.json"
+NAMES = ("pos", "for")
+READ_BLOCK = 1 << 20
+COMPRESS_LEVEL = 6
+INTERVAL = 10.0  # seconds between compression passes
+PUNCH_DELAY = 60.0  # seconds a compressed range stays readable in the .xyz file
+
+# fallocate(2) modes
+FALLOC_FL_KEEP_SIZE = 1
+FALLOC_FL_PUNCH_HOLE = 2
+
+
+def manifest_path(path):
+    return path + MANIFEST_SUFFIX
+
+
+def chunk_path(path, index):
+    return f"{path}.{index:05d}.gz"
+
+
+def read_manifest(path):
+    """Return the chunk manifest of the trajectory file path, or None if it is not compressed"""
+    try:
+        with open(manifest_path(path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_manifest(path, manifest):
+    # Replace atomically so readers never see a half-written manifest
+    tmp_file = manifest_path(path) + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_file, manifest_path(path))
+
+
+def trajectory_paths(pattern):
+    """Return the trajectory files matching pattern, including those compressed completely"""
+    paths = set(glob.glob(pattern))
+    paths.update(path[:-len(MANIFEST_SUFFIX)] for path in glob.glob(pattern + MANIFEST_SUFFIX))
+    return sorted(paths)
+
+
+def punch_hole(path, start, end):
+    """Free the disk blocks of bytes start:end of path without changing its size
+
+    Returns:
+        bool: False where fallocate is not available (the space is then
+        freed when the file is removed at the end of the run)
+    """
+    fallocate = getattr(ctypes.CDLL(None, use_errno=True), "fallocate", None)
+    if fallocate is None or end <= start:
+        return False
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        result = fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                           ctypes.c_int64(start), ctypes.c_int64(end - start))
+    finally:
+        os.close(fd)
+    return result == 0
+
+
+def _chunk_end(f, offset, nlines):
+    """Return the offset after the next nlines lines from offset, or None if they are not all written"""
+    f.seek(offset)
+    end = offset
+    while True:
+        block = f.read(READ_BLOCK)
+        if not block:
+            return None
+        count = block.count(b'\n')
+        if count >= nlines:
+            index = -1
+            for _ in range(nlines):
+                index = block.index(b'\n', index + 1)
+            return end + index + 1
+        nlines -= count
+        end += len(block)
+
+
+def compress_file(path, chunk_frames, final=False, level=COMPRESS_LEVEL):
+    """Move the completed chunks of one trajectory file into gzip chunks
+
+    With final=True (the simulation has ended) the rest of the file goes
+    into a last, shorter chunk and the .xyz file is removed.
+
+    Returns:
+        int: number of chunks written
+    """
+    manifest = read_manifest(path)
+    if manifest is None:
+        with open(path, 'rb') as f:
+            first_line = f.readline()
+        if not first_line.endswith(b'\n'):
+            return 0
+        manifest = {"version": 1, "natoms": int(first_line), "offset": 0, "punched": 0, "chunks": []}
+    nlines = chunk_frames * (manifest["natoms"] + 2)
+
+    written = 0
+    with open(path, 'rb') as f:
+        while True:
+            start = manifest["offset"]
+            end = _chunk_end(f, start, nlines)
+            if end is None and final:
+                end = os.fstat(f.fileno()).st_size
+            if end is None or end <= start:
+                break
+            name = chunk_path(path, len(manifest["chunks"]))
+            f.seek(start)
+            with gzip.open(name + ".tmp", 'wb', compresslevel=level) as out:
+                remaining = end - start
+                while remaining:
+                    block = f.read(min(READ_BLOCK, remaining))
+                    out.write(block)
+                    remaining -= len(block)
+            os.replace(name + ".tmp", name)
+            manifest["chunks"].append({"file": os.path.basename(name), "start": start, "end": end,
+                                       "time": time.time()})
+            manifest["offset"] = end
+            _write_manifest(path, manifest)
+            written += 1
+
+    if final:
+        # Everything is in the chunks now; readers fall back to them once the file is gone
+        if os.path.exists(manifest_path(path)):
+            os.remove(path)
+        return written
+
+    # Free the ranges that readers may still have been reading
+    punch_end = manifest["punched"]
+    for chunk in manifest["chunks"]:
+        if chunk["end"] > punch_end and chunk["time"] < time.time() - PUNCH_DELAY:
+            punch_end = chunk["end"]
+    if punch_end > manifest["punched"] and punch_hole(path, manifest["punched"], punch_end):
+        manifest["punched"] = punch_end
+        _write_manifest(path, manifest)
+    return written
+
+
+def expand_file(path):
+    """Turn a compressed trajectory back into one plain XYZ file"""
+    manifest = read_manifest(path)
+    if manifest is None:
+        return
+    tmp_file = path + ".tmp"
+    with open_trajectory(path) as f, open(tmp_file, 'wb') as out:
+        shutil.copyfileobj(f, out, READ_BLOCK)
+    os.replace(tmp_file, path)
+    remove_chunks(path, manifest)
+
+
+def remove_chunks(path, manifest=None):
+    """Remove the chunks and the manifest of one trajectory file"""
+    manifest = manifest or read_manifest(path)
+    if manifest is None:
+        return
+    for chunk in manifest["chunks"]:
+        try:
+            os.remove(os.path.join(os.path.dirname(path), chunk["file"]))
+        except FileNotFoundError:
+            pass
+    os.remove(manifest_path(path))
+
+
+def run_trajectories(run_dir, prefix="simulation", names=NAMES):
+    """Return the trajectory files of a run, plain or compressed"""
+    paths = []
+    for name in names:
+        paths += trajectory_paths(os.path.join(run_dir, f"{prefix}.{name}_*.xyz"))
+    return paths
+
+
+def expand_run(run_dir, prefix="simulation"):
+    """Turn every compressed trajectory of a run back into a plain XYZ file (e.g. before a resume)"""
+    for path in run_trajectories(run_dir, prefix):
+        expand_file(path)
+
+
+def remove_run_chunks(run_dir, prefix="simulation"):
+    """Remove the chunks of an earlier run, which would otherwise be read as part of a new one"""
+    for path in run_trajectories(run_dir, prefix):
+        remove_chunks(path)
+
+
+class ChunkedReader(io.RawIOBase):
+    """Raw binary stream over the chunks and the uncompressed rest of one trajectory file"""
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self._set_manifest(manifest)
+        self.position = 0
+        self.chunk_index = None
+        self.chunk_file = None
+        self.raw = None
+
+    def _set_manifest(self, manifest):
+        self.manifest = manifest
+        self.starts = [chunk["start"] for chunk in manifest["chunks"]]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += max(self.manifest["offset"], os.path.getsize(self.path) if os.path.exists(self.path) else 0)
+        self.position = max(offset, 0)
+        return self.position
+
+    def _open_chunk(self, index):
+        if self.chunk_index != index:
+            if self.chunk_file is not None:
+                self.chunk_file.close()
+            chunk = self.manifest["chunks"][index]
+            self.chunk_file = gzip.open(os.path.join(os.path.dirname(self.path), chunk["file"]), 'rb')
+            self.chunk_index = index
+        offset = self.position - self.starts[index]
+        # Seeking forward decompresses and skips, seeking back starts over
+        if self.chunk_file.tell() != offset:
+            self.chunk_file.seek(offset)
+        return self.chunk_file
+
+    def _open_raw(self):
+        if self.raw is None:
+            try:
+                self.raw = open(self.path, 'rb')
+            except FileNotFoundError:
+                # Compressed completely since this reader was opened
+                self._set_manifest(read_manifest(self.path) or self.manifest)
+                return None
+        return self.raw
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)
+        if self.position < self.manifest["offset"]:
+            index = bisect.bisect_right(self.starts, self.position) - 1
+            end = self.manifest["chunks"][index]["end"]
+            count = self._open_chunk(index).readinto(view[:min(len(view), end - self.position)])
+        else:
+            raw = self._open_raw()
+            if raw is None:
+                return self.readinto(buffer) if self.position < self.manifest["offset"] else 0
+            raw.seek(self.position)
+            count = raw.readinto(view)
+        self.position += count
+        return count
+
+    def close(self):
+        for f in (self.chunk_file, self.raw):
+            if f is not None:
+                f.close()
+        super().close()
+
+
+def open_trajectory(path, buffer_size=READ_BLOCK):
+    """Open a plain or compressed trajectory file for binary reading"""
+    manifest = read_manifest(path)
+    if manifest is None:
+        return open(path, 'rb')
+    return io.BufferedReader(ChunkedReader(path, manifest), buffer_size)
+
+
+def _lower_priority():
+    # Linux nice values apply to single threads
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+    except (AttributeError, OSError):
+        pass
+
+
+class ChunkCompressor:
+    """Worker thread that compresses the trajectory files of a running simulation"""
+
+    def __init__(self, run_dir, chunk_frames, prefix="simulation", names=NAMES, interval=INTERVAL,
+                 level=COMPRESS_LEVEL):
+        self.run_dir = run_dir
+        self.chunk_frames = int(chunk_frames)
+        self.prefix = prefix
+        self.names = names
+        self.interval = interval
+        self.level = level
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.chunks_written = 0
+
+    def files(self):
+        """Return the .xyz files still to be compressed (i-PI creates them with its first frame)"""
+        paths = []
+        for name in self.names:
+            paths += sorted(glob.glob(os.path.join(self.run_dir, f"{self.prefix}.{name}_*.xyz")))
+        return paths
+
+    def compress(self, final=False):
+        written = 0
+        for path in self.files():
+            written += compress_file(path, self.chunk_frames, final, self.level)
+        self.chunks_written += written
+        return written
+
+    def _run(self):
+        _lower_priority()
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.compress()
+            except OSError as e:
+                print(f"Warning: trajectory compression stopped: {e}")
+                return
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the worker, leaving the rest of the files uncompressed"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def finish(self):
+        """Stop the worker and compress the rest of every file; call once the simulation has ended
+
+        Returns:
+            int: number of chunks written in total
+        """
+        self.stop()
+        self.compress(final=True)
+        return self.chunks_written
+
+
+def trajectory_compressor(params, run_dir):
+    """Return the ChunkCompressor of a run, or None with chunk_frames 0"""
+    chunk_frames = int(params.get("chunk_frames", 0))
+    if chunk_frames <= 0:
+        return None
+    return ChunkCompressor(run_dir, chunk_frames)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compress the trajectory files of a run into gzip chunks")
+    parser.add_argument("run_dir")
+    parser.add_argument("--chunk-frames", type=int, default=1000, help="Frames per chunk")
+    parser.add_argument("--watch", type=float, default=None, metavar="SECONDS",
+                        help="Compress the completed chunks of a running simulation every SECONDS "
+                             "until interrupted")
+    parser.add_argument("--expand", action="store_true", help="Turn the chunks back into plain XYZ files")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not os.path.isdir(args.run_dir):
+        print(f"Error: no run directory {args.run_dir}")
+        sys.exit(1)
+    if args.expand:
+        expand_run(args.run_dir)
+        print(f"Expanded the trajectories of {args.run_dir}")
+        sys.exit(0)
+    compressor = ChunkCompressor(args.run_dir, args.chunk_frames)
+    if args.watch is not None:
+        compressor.interval = args.watch
+        compressor.start()
+        try:
+            while True:
+                time.sleep(args.watch)
+                print(f"{compressor.chunks_written} chunks written")
+        except KeyboardInterrupt:
+            # i-PI may still be writing, so the rest stays uncompressed
+            compressor.stop()
+    else:
+        compressor.finish()
+    print(f"Wrote {compressor.chunks_written} chunks in {args.run_dir}")
@@ -0,0 +1,234 @@
+"""Indexed binary store for the bead trajectories of a run
+
+The text files simulation.pos_*.xyz written by i-PI are packed into
+<run_dir>/trajectory_store/:
+
+    positions.f8   raw float64 array of shape (frames, beads, atoms, 3)
+    steps.i8       raw int64 array with the MD step of every frame
+    index.json     shape, atom names, units, stride, timestep and the byte
+                   offsets up to which every XYZ file has been converted
+
+Frames are stored frame-major so that new frames are simply appended;
+positions() returns a zero-copy (beads, frames, atoms, 3) memmap view.
+update() converts only what was appended to the XYZ files since the last
+call, so it can be run repeatedly while i-PI is still writing.
+
+The forces trajectory simulation.for_*.xyz (write_forces) is packed the
+same way into <run_dir>/trajectory_store_for/ with name="for".
+
+Example:
+    from trajectory_store import open_store
+    store = open_store('../pimd_run_1')
+    positions = store.positions()                  # (beads, frames, atoms, 3)
+    last_100 = store.positions(start=-100)
+    forces = open_store('../pimd_run_1', name='for').positions()
+
+From the command line (``--watch`` keeps updating during a run):
+    python trajectory_store.py ../pimd_run_1 --watch 10
+"""
+import argparse
+import json
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from trajectory_chunks import open_trajectory
+from xyz_reader import bead_files, parse_frames, read_header, select_frames
+
+STORE_DIR = "trajectory_store"
+INDEX_FILE = "index.json"
+POSITIONS_FILE = "positions.f8"
+STEPS_FILE = "steps.i8"
+
+
+def store_dir(name="pos"):
+    """Return the store directory of the trajectory name ("pos", "for", ...)"""
+    return STORE_DIR if name == "pos" else f"{STORE_DIR}_{name}"
+
+
+def read_run_settings(run_dir):
+    """Return the trajectory stride and the timestep (fs) from input.xml"""
+    settings = {"stride": None, "timestep_fs": None}
+    try:
+        root = ET.parse(os.path.join(run_dir, "input.xml")).getroot()
+    except (OSError, ET.ParseError):
+        return settings
+    for trajectory in root.iter("trajectory"):
+        if trajectory.get("filename") == "pos":
+            settings["stride"] = int(trajectory.get("stride", 1))
+    timestep = root.find(".//dynamics/timestep")
+    if timestep is not None and timestep.get("units", "femtosecond") == "femtosecond":
+        settings["timestep_fs"] = float(timestep.text)
+    return settings
+
+
+class TrajectoryStore:
+    """Memory-mapped positions (or forces) of all beads of one run"""
+
+    def __init__(self, run_dir, name="pos"):
+        self.run_dir = run_dir
+        self.path = os.path.join(run_dir, store_dir(name))
+        with open(os.path.join(self.path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+
+    @classmethod
+    def create(cls, run_dir, prefix="simulation", name="pos"):
+        """Create an empty store for the XYZ files of run_dir"""
+        files = bead_files(run_dir, prefix, name)
+        if not files:
+            raise FileNotFoundError(f"No {prefix}.{name}_*.xyz files in {run_dir}")
+        natoms, names, comment = read_header(files[0])
+        units = re.search(r"(?:positions|forces)\{([\w/]+)\}", comment)
+
+        path = os.path.join(run_dir, store_dir(name))
+        os.makedirs(path, exist_ok=True)
+        index = {
+            "version": 1,
+            "layout": ["frame", "bead", "atom", "xyz"],
+            "dtype": "<f8",
+            "nframes": 0,
+            "nbeads": len(files),
+            "natoms": natoms,
+            "atom_names": names,
+            "units": units.group(1) if units else ("angstrom" if name == "pos" else "atomic_unit"),
+            **read_run_settings(run_dir),
+            "sources": [{"file": os.path.basename(f), "offset": 0} for f in files],
+        }
+        for filename in (POSITIONS_FILE, STEPS_FILE):
+            open(os.path.join(path, filename), 'wb').close()
+        cls._write_index(path, index)
+        return cls(run_dir, name)
+
+    @staticmethod
+    def _write_index(path, index):
+        # Replace atomically so readers never see a half-written index
+        tmp_file = os.path.join(path, INDEX_FILE + ".tmp")
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp_file, os.path.join(path, INDEX_FILE))
+
+    @property
+    def nframes(self):
+        return self.index["nframes"]
+
+    @property
+    def atom_names(self):
+        return self.index["atom_names"]
+
+    def _memmap(self, name, dtype, shape):
+        if self.nframes == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=shape)
+
+    def positions(self, start=None, stop=None, step=None):
+        """Return positions of frames start:stop:step as (beads, frames, atoms, 3)
+
+        The result is a read-only view of the memory-mapped file; nothing is
+        read from disk until the data is used.
+        """
+        index = self.index
+        data = self._memmap(POSITIONS_FILE, index["dtype"],
+                            (self.nframes, index["nbeads"], index["natoms"], 3))
+        frames = select_frames(self.nframes, start, stop, step)
+        return data[frames.start:frames.stop:frames.step].swapaxes(0, 1)
+
+    def steps(self, start=None, stop=None, step=None):
+        """Return the MD step of frames start:stop:step"""
+        data = self._memmap(STEPS_FILE, "<i8", (self.nframes,))
+        frames = select_frames(self.nframes, start, stop, step)
+        return data[frames.start:frames.stop:frames.step]
+
+    def frame_times(self, start=None, stop=None, step=None):
+        """Return the simulation time (fs) of frames start:stop:step"""
+        if self.index["timestep_fs"] is None:
+            raise ValueError("The timestep of this run is unknown (no input.xml)")
+        return self.steps(start, stop, step) * self.index["timestep_fs"]
+
+    def update(self, chunk_bytes=1 << 26):
+        """Append the frames completed in every bead since the last update
+
+        Returns:
+            int: number of frames added
+        """
+        index = self.index
+        natoms = index["natoms"]
+        lines_per_frame = natoms + 2
+        frame_bytes = index["nbeads"] * natoms * 3 * 8
+        positions_file = os.path.join(self.path, POSITIONS_FILE)
+        steps_file = os.path.join(self.path, STEPS_FILE)
+
+        # Drop anything written after the last index update (e.g. a crash)
+        os.truncate(positions_file, index["nframes"] * frame_bytes)
+        os.truncate(steps_file, index["nframes"] * 8)
+
+        added = 0
+        while True:
+            chunks = []
+            for source in index["sources"]:
+                with open_trajectory(os.path.join(self.run_dir, source["file"])) as f:
+                    f.seek(source["offset"])
+                    chunks.append(f.read(chunk_bytes).split(b'\n'))
+
+            # The last element of every split is an incomplete line
+            nnew = min((len(lines) - 1) // lines_per_frame for lines in chunks)
+            if nnew == 0:
+                break
+
+            block = np.empty((nnew, index["nbeads"], natoms, 3))
+            for bead, (source, lines) in enumerate(zip(index["sources"], chunks)):
+                frame_lines = lines[:nnew * lines_per_frame]
+                source["offset"] += sum(len(line) + 1 for line in frame_lines)
+                block[:, bead], comments = parse_frames(frame_lines, natoms)
+                if bead == 0:
+                    steps = np.array([int(re.search(rb"Step:\s*(\d+)", c).group(1)) for c in comments],
+                                     dtype="<i8")
+
+            with open(positions_file, 'ab') as f:
+                f.write(block.astype(index["dtype"]).tobytes())
+            with open(steps_file, 'ab') as f:
+                f.write(steps.tobytes())
+            index["nframes"] += nnew
+            self._write_index(self.path, index)
+            added += nnew
+        return added
+
+
+def open_store(run_dir, update=True, prefix="simulation", name="pos"):
+    """Open the trajectory store of run_dir, creating it if needed
+
+    With update=True frames appended to the XYZ files since the last call
+    are converted first.
+    """
+    if os.path.exists(os.path.join(run_dir, store_dir(name), INDEX_FILE)):
+        store = TrajectoryStore(run_dir, name)
+    else:
+        store = TrajectoryStore.create(run_dir, prefix, name)
+    if update:
+        store.update()
+    return store
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert the bead trajectories of a run to a binary store")
+    parser.add_argument("run_dir", help="Run directory with simulation.pos_*.xyz files")
+    parser.add_argument("--watch", type=float, default=None, metavar="SECONDS",
+                        help="Keep converting new frames every SECONDS until interrupted")
+    parser.add_argument("--name", default="pos", help="Trajectory to convert: pos (positions) or for (forces)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    store = open_store(args.run_dir, update=False, name=args.name)
+    try:
+        while True:
+            added = store.update()
+            print(f"Added {added} frames ({store.nframes} frames of {store.index['nbeads']} beads stored)")
+            if args.watch is None:
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
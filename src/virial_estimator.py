@@ -0,0 +1,220 @@
+"""Streaming centroid-virial estimator of the quantum kinetic energy
+
+The centroid-virial estimator of the kinetic energy of P-bead ring polymers
+at temperature T is
+
+    K_cv = 3 N k_B T / 2 - 1/(2P) sum_i sum_atoms (r_i - r_c) . F_i
+
+with r_i and F_i the position of and the force on bead i and r_c the
+centroid. It needs the bead forces, which i-PI writes to
+simulation.for_*.xyz when a run is made with write_forces = 1.
+
+CentroidVirialEstimator goes through the position and force trajectory
+stores a chunk of frames at a time (one vectorized pass per chunk), writes
+K_cv of every frame to kinetic_cv.dat together with the running mean and
+its blocking standard error, and keeps nothing else, so memory does not
+grow with the length of the run. i-PI computes the same quantity as the
+kinetic_cv column of simulation.out; compare_with_ipi() checks that both
+agree.
+
+Example:
+    python virial_estimator.py ../pimd_run_1 --check          # finished run
+    python virial_estimator.py ../pimd_run_1 --watch 10       # running simulation
+"""
+import argparse
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from block_stats import BlockAverage
+from pimd_analysis import CHUNK_BYTES, frames_per_chunk
+from property_monitor import PropertiesTail
+from trajectory_store import open_store
+
+KB_EV = 8.617333262e-5  # eV/K
+KCV_FILE = "kinetic_cv.dat"
+
+# Conversion of the trajectory units to Angstrom and eV/Angstrom
+LENGTH_UNITS = {"angstrom": 1.0, "atomic_unit": 0.529177210903}
+FORCE_UNITS = {"ev/ang": 1.0, "ev/angstrom": 1.0, "atomic_unit": 27.211386245988 / 0.529177210903}
+
+
+def read_temperature(run_dir):
+    """Return the ensemble temperature in K from the input.xml of a run"""
+    root = ET.parse(os.path.join(run_dir, "input.xml")).getroot()
+    temperature = root.find(".//ensemble/temperature")
+    if temperature is None or temperature.get("units", "kelvin") != "kelvin":
+        raise ValueError(f"No temperature in kelvin in {os.path.join(run_dir, 'input.xml')}")
+    return float(temperature.text)
+
+
+def centroid_virial(positions, forces, temperature):
+    """Return K_cv (eV) of every frame
+
+    Args:
+        positions: (beads, frames, atoms, 3) in Angstrom
+        forces: (beads, frames, atoms, 3) in eV/Angstrom
+        temperature: in K
+    """
+    nbeads, _, natoms, _ = positions.shape
+    displacements = positions - positions.mean(axis=0)
+    virial = np.einsum("bfax,bfax->f", displacements, forces)
+    return 1.5 * natoms * KB_EV * temperature - 0.5 * virial / nbeads
+
+
+class CentroidVirialEstimator:
+    """K_cv series of a (running) simulation with a running blocking error
+
+    update() may be called repeatedly while i-PI is still writing; every
+    call processes only the frames completed since the previous one.
+    """
+
+    def __init__(self, run_dir, temperature=None, discard_steps=0, max_bytes=CHUNK_BYTES, prefix="simulation",
+                 output=KCV_FILE):
+        self.run_dir = run_dir
+        self.temperature = float(temperature) if temperature is not None else read_temperature(run_dir)
+        self.discard_steps = discard_steps
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.average = BlockAverage()
+        self.nframes = 0
+        self.last_step = None
+        self.position_store = None
+        self.force_store = None
+        self.output = os.path.join(run_dir, output)
+        with open(self.output, 'w') as f:
+            f.write("# step  kinetic_cv{electronvolt}  mean{electronvolt}  error{electronvolt}\n")
+
+    def _open_stores(self):
+        if self.force_store is None:
+            try:
+                self.position_store = open_store(self.run_dir, update=False, prefix=self.prefix)
+                self.force_store = open_store(self.run_dir, update=False, prefix=self.prefix, name="for")
+            except FileNotFoundError:
+                return False
+            for store, units in ((self.position_store, LENGTH_UNITS), (self.force_store, FORCE_UNITS)):
+                if store.index["units"] not in units:
+                    raise ValueError(f"Unsupported units {store.index['units']} in {store.path}")
+        return True
+
+    def update(self):
+        """Process the frames written since the last call
+
+        Returns:
+            int: number of frames added
+        """
+        if not self._open_stores():
+            return 0
+        self.position_store.update()
+        self.force_store.update()
+        stop = min(self.position_store.nframes, self.force_store.nframes)
+        length_scale = LENGTH_UNITS[self.position_store.index["units"]]
+        force_scale = FORCE_UNITS[self.force_store.index["units"]]
+        index = self.position_store.index
+        chunk_frames = frames_per_chunk(index["nbeads"], index["natoms"], self.max_bytes)
+
+        start = self.nframes
+        with open(self.output, 'a') as f:
+            for first in range(start, stop, chunk_frames):
+                last = min(first + chunk_frames, stop)
+                steps = self.position_store.steps(first, last)
+                if not np.array_equal(steps, self.force_store.steps(first, last)):
+                    raise ValueError("Positions and forces are not written at the same steps "
+                                     "(the forces trajectory uses the position stride)")
+                kinetic = centroid_virial(self.position_store.positions(first, last) * length_scale,
+                                          self.force_store.positions(first, last) * force_scale, self.temperature)
+                lines = []
+                for step, value in zip(steps, kinetic):
+                    if step >= self.discard_steps:
+                        self.average.add(value)
+                    lines.append(f"{step:10d}  {value:.8e}  {self.average.mean:.8e}  {self.average.error:.8e}\n")
+                f.writelines(lines)
+                self.last_step = int(steps[-1])
+        self.nframes = stop
+        return stop - start
+
+    def summary_line(self):
+        if self.position_store is None:
+            return "no frames yet"
+        classical = 1.5 * self.position_store.index["natoms"] * KB_EV * self.temperature
+        return (f"K_cv = {self.average.mean:.6f} +/- {self.average.error:.2g} eV "
+                f"({self.average.count} frames, classical {classical:.6f} eV)")
+
+
+def compare_with_ipi(run_dir, output=KCV_FILE, prefix="simulation"):
+    """Compare the K_cv series in output with the kinetic_cv column of simulation.out
+
+    Returns:
+        dict: number of common steps and largest absolute (eV) and relative difference
+    """
+    tail = PropertiesTail(os.path.join(run_dir, f"{prefix}.out"))
+    rows = tail.read_new()
+    if len(rows) == 0 or "kinetic_cv" not in tail.columns:
+        raise ValueError(f"No kinetic_cv column in {tail.filename}")
+    series = np.loadtxt(os.path.join(run_dir, output), ndmin=2)
+    ipi_kinetic = tail.column(rows, "kinetic_cv")
+    _, mine, theirs = np.intersect1d(series[:, 0].astype(int), tail.column(rows, "step").astype(int),
+                                     return_indices=True)
+    if len(mine) == 0:
+        raise ValueError(f"No common steps in {output} and {tail.filename}")
+    difference = np.abs(series[mine, 1] - ipi_kinetic[theirs])
+    return {
+        "frames": len(mine),
+        "max_abs": float(difference.max()),
+        "max_rel": float((difference / np.abs(ipi_kinetic[theirs])).max()),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Centroid-virial kinetic energy from the bead positions and forces")
+    parser.add_argument("run_dir", help="Run directory with simulation.pos_*.xyz and simulation.for_*.xyz")
+    parser.add_argument("--temperature", type=float, default=None, help="Temperature in K (default: input.xml)")
+    parser.add_argument("--discard-steps", type=int, default=0, help="Equilibration steps left out of the mean")
+    parser.add_argument("--watch", type=float, default=None, metavar="SECONDS",
+                        help="Follow a running simulation until interrupted")
+    parser.add_argument("--check", action="store_true",
+                        help="Compare with the kinetic_cv column of simulation.out and fail above --rtol")
+    parser.add_argument("--rtol", type=float, default=1e-4,
+                        help="Largest relative difference accepted by --check")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    try:
+        estimator = CentroidVirialEstimator(args.run_dir, args.temperature, args.discard_steps)
+        while True:
+            added = estimator.update()
+            print(f"step {estimator.last_step}: {estimator.summary_line()}" if added or args.watch is None
+                  else "waiting for frames...")
+            if args.watch is None:
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if estimator.nframes == 0:
+        print(f"Error: no position and force frames in {args.run_dir} (run with write_forces = 1)")
+        sys.exit(1)
+    print(f"Wrote {estimator.nframes} frames to {estimator.output}")
+
+    if args.check:
+        try:
+            match = compare_with_ipi(args.run_dir)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print(f"Compared {match['frames']} frames with i-PI kinetic_cv: largest difference "
+              f"{match['max_abs']:.3g} eV ({match['max_rel']:.3g} relative)")
+        if match["max_rel"] > args.rtol:
+            print(f"Error: the difference exceeds --rtol {args.rtol:g}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Boxes of many q-TIP4P/f water molecules
+
+water_box() places N molecules with the q-TIP4P/f equilibrium geometry in
+a cubic box at a target density. The oxygens go on randomly chosen sites
+of a simple or body-centred cubic lattice that fills the box (whichever
+has the larger spacing), so no two molecules start closer than the
+lattice spacing (about 3.1 A at 1 g/cm^3), and every molecule gets a
+random orientation. Orientations whose atoms come closer than
+MIN_DISTANCE to another molecule are drawn again, checking all molecules
+at once against those in the neighbouring cells of a cell list. The lattice
+melts within the first picoseconds of dynamics.
+
+write_init_xyz() and write_water_data() write the matching init.xyz (with
+the i-PI CELL(abcABC) comment) and LAMMPS water.data, atoms in O, H, H
+order as the drivers expect.
+
+Example:
+    python water_box.py 1000 --density 0.997 --output ../box_1000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from simulation_config import QTIP4PF, box_length, equilibrium_molecule
+
+MIN_DISTANCE = 1.6  # Angstrom between atoms of different molecules
+MIN_SPACING = 2.5  # Angstrom between lattice sites; liquid water has O-O distances from about 2.5 A
+MAX_ROUNDS = 100
+SEED = 32345
+
+
+def random_rotations(count, rng):
+    """Return count uniformly distributed rotation matrices, shape (count, 3, 3)"""
+    q = rng.normal(size=(count, 4))
+    w, x, y, z = (q / np.linalg.norm(q, axis=1, keepdims=True)).T
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)], axis=-1),
+        np.stack([2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)], axis=-1),
+        np.stack([2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], axis=-1),
+    ], axis=1)
+
+
+def _cube_root(count):
+    """Return the smallest n with n**3 >= count"""
+    n = int(round(count ** (1 / 3)))
+    return n + 1 if n**3 < count else n
+
+
+def lattice_sites(count, length):
+    """Return at least count sites of a cubic lattice filling the box, and their nearest-neighbour distance
+
+    Of the simple cubic and the body-centred cubic lattice with enough
+    sites, the one with the larger spacing is used.
+    """
+    n = _cube_root(count)
+    m = _cube_root((count + 1) // 2)
+    if length / n >= np.sqrt(3) / 2 * length / m:
+        return (np.indices((n,) * 3).reshape(3, -1).T + 0.5) * (length / n), length / n
+    corners = (np.indices((m,) * 3).reshape(3, -1).T + 0.25) * (length / m)
+    return np.concatenate([corners, corners + 0.5 * length / m]), np.sqrt(3) / 2 * length / m
+
+
+def neighbour_pairs(oxygens, length, cutoff, periodic=True):
+    """Return the index arrays (first, second) of the molecule pairs in the same or adjacent cells
+
+    The oxygens (in [0, length)) are binned into cells with edges of at
+    least cutoff, so every pair closer than cutoff is among them.
+    """
+    ncells = max(int(length // cutoff), 1)
+    cells = np.minimum((oxygens / length * ncells).astype(int), ncells - 1)
+    flat = np.ravel_multi_index(cells.T, (ncells,) * 3)
+    order = np.argsort(flat, kind="stable")
+    counts = np.bincount(flat, minlength=ncells**3)
+    rank = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    table = np.full((ncells**3, counts.max()), -1)
+    table[flat[order], rank] = order
+    table = table.reshape((ncells,) * 3 + (-1,))
+
+    index = np.indices((ncells,) * 3)
+    firsts, seconds = [], []
+    for offset in np.ndindex(3, 3, 3):
+        offset = [o - 1 for o in offset]
+        neighbour = np.roll(table, shift=[-o for o in offset], axis=(0, 1, 2))
+        first, second = np.broadcast_arrays(table[..., :, None], neighbour[..., None, :])
+        valid = (first >= 0) & (first < second)
+        if not periodic:
+            # Without periodic images np.roll must not wrap around the box
+            inside = np.ones((ncells,) * 3, dtype=bool)
+            for axis, o in enumerate(offset):
+                inside &= (index[axis] + o >= 0) & (index[axis] + o < ncells)
+            valid &= inside[..., None, None]
+        firsts.append(first[valid])
+        seconds.append(second[valid])
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def _clashes(positions, first, second, length, periodic):
+    """Return a mask of the molecules closer than MIN_DISTANCE to another one
+
+    Of every clashing pair only the second molecule is marked, so that the
+    first keeps its orientation.
+    """
+    d = positions[first][:, :, None, :] - positions[second][:, None, :, :]
+    if periodic:
+        d -= length * np.round(d / length)
+    too_close = np.min(np.sum(d * d, axis=-1), axis=(1, 2)) < MIN_DISTANCE**2
+    clash = np.zeros(len(positions), dtype=bool)
+    clash[second[too_close]] = True
+    return clash
+
+
+def water_box(nmolecules, density=0.997, seed=SEED, periodic=True):
+    """Return the positions (nmolecules * 3, 3) in Angstrom and the box edge of a water box
+
+    Raises:
+        ValueError: if the density leaves no room for non-overlapping molecules
+    """
+    rng = np.random.default_rng(seed)
+    length = box_length(nmolecules, density)
+    sites, spacing = lattice_sites(nmolecules, length)
+    if spacing < MIN_SPACING:
+        raise ValueError(f"{density} g/cm^3 is too dense for a lattice start ({spacing:.2f} A spacing)")
+
+    # Oxygens on randomly chosen lattice sites
+    oxygens = sites[rng.permutation(len(sites))[:nmolecules]]
+    molecule = np.array(equilibrium_molecule())
+    # Molecules whose oxygens are further apart cannot overlap
+    reach = 2 * QTIP4PF["r0"] + MIN_DISTANCE
+    first, second = neighbour_pairs(oxygens, length, reach, periodic)
+
+    positions = oxygens[:, None, :] + molecule @ random_rotations(nmolecules, rng).transpose(0, 2, 1)
+    for _ in range(MAX_ROUNDS):
+        clash = _clashes(positions, first, second, length, periodic)
+        if not clash.any():
+            break
+        rotations = random_rotations(int(clash.sum()), rng)
+        positions[clash] = oxygens[clash][:, None, :] + molecule @ rotations.transpose(0, 2, 1)
+    else:
+        raise ValueError(f"Could not orient all molecules without overlaps in {MAX_ROUNDS} rounds")
+    return positions.reshape(-1, 3), length
+
+
+def xyz_text(positions, cell_length):
+    """Return an i-PI init.xyz of O, H, H molecules with the cell in the comment line"""
+    names = ["O", "H", "H"] * (len(positions) // 3)
+    header = (f"{len(positions)}\n# CELL(abcABC): {cell_length:.6f} {cell_length:.6f} {cell_length:.6f} "
+              f"90.00000 90.00000 90.00000 positions{{angstrom}} cell{{angstrom}} "
+              f"Water box of {len(positions) // 3} molecules\n")
+    return header + "".join(f"{name} {x:12.6f} {y:12.6f} {z:12.6f}\n" for name, (x, y, z) in zip(names, positions))
+
+
+def write_init_xyz(filename, positions, cell_length):
+    with open(filename, 'w') as f:
+        f.write(xyz_text(positions, cell_length))
+
+
+def write_water_data(filename, positions, cell_length):
+    """Write the LAMMPS data file (atom_style full) of O, H, H molecules in a cubic box centered on 0
+
+    The positions are wrapped into [-L/2, L/2); i-PI sends the actual
+    positions with every force request, so only the topology and the box
+    have to match.
+    """
+    nmolecules = len(positions) // 3
+    half = 0.5 * cell_length
+    wrapped = positions - cell_length * np.floor((positions + half) / cell_length)
+    oxygens = 3 * np.arange(nmolecules) + 1
+    atoms = np.column_stack([np.arange(1, 3 * nmolecules + 1), np.repeat(np.arange(1, nmolecules + 1), 3),
+                             np.tile([1, 2, 2], nmolecules),
+                             np.tile([QTIP4PF["charge_O"], QTIP4PF["charge_H"], QTIP4PF["charge_H"]], nmolecules),
+                             wrapped])
+    bonds = np.column_stack([np.arange(1, 2 * nmolecules + 1), np.ones(2 * nmolecules, dtype=int),
+                             np.repeat(oxygens, 2), np.column_stack([oxygens + 1, oxygens + 2]).ravel()])
+    angles = np.column_stack([np.arange(1, nmolecules + 1), np.ones(nmolecules, dtype=int),
+                              oxygens + 1, oxygens, oxygens + 2])
+    with open(filename, 'w') as f:
+        f.write(f"""# Water box of {nmolecules} molecules (q-TIP4P/f)
+
+{3 * nmolecules} atoms
+{2 * nmolecules} bonds
+{nmolecules} angles
+2 atom types
+1 bond types
+1 angle types
+
+{-half} {half} xlo xhi
+{-half} {half} ylo yhi
+{-half} {half} zlo zhi
+
+Masses
+
+1 {QTIP4PF["mass_O"]} # O
+2 {QTIP4PF["mass_H"]}   # H
+
+Atoms # full
+
+""")
+        np.savetxt(f, atoms, fmt=["%d", "%d", "%d", "%g", "%.6f", "%.6f", "%.6f"])
+        f.write("\nBonds\n\n")
+        np.savetxt(f, bonds, fmt="%d")
+        f.write("\nAngles\n\n")
+        np.savetxt(f, angles, fmt="%d")
+
+
+def read_init_xyz(filename):
+    """Return the positions and the cubic cell edge (None if the comment has no cell) of an init.xyz"""
+    with open(filename) as f:
+        natoms = int(f.readline())
+        comment = f.readline()
+    positions = np.loadtxt(filename, skiprows=2, usecols=(1, 2, 3), max_rows=natoms, ndmin=2)
+    cell_length = None
+    if "CELL(abcABC):" in comment:
+        cell_length = float(comment.split("CELL(abcABC):")[1].split()[0])
+    return positions, cell_length
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write init.xyz and water.data of an N-molecule water box")
+    parser.add_argument("nmolecules", type=int)
+    parser.add_argument("--density", type=float, default=0.997, help="Density in g/cm^3")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--output", default=".", help="Directory for init.xyz and water.data")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    start_time = time.perf_counter()
+    try:
+        positions, length = water_box(args.nmolecules, args.density, args.seed)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    os.makedirs(args.output, exist_ok=True)
+    write_init_xyz(os.path.join(args.output, "init.xyz"), positions, length)
+    write_water_data(os.path.join(args.output, "water.data"), positions, length)
+    print(f"Wrote {args.nmolecules} molecules in a {length:.3f} A box to {args.output} "
+          f"in {time.perf_counter() - start_time:.2f} s")
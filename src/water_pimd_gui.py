@@ -1,12 +1,14 @@
 import tkinter as tk
 from tkinter import ttk, scrolledtext
-import subprocess
 import threading
 import queue
-import sys
 import os
-import time
-from datetime import datetime
+
+from gui_console import ConsolePipeline
+from launcher import run_simulation, work_dir_path
+from live_dashboard import LiveDashboard
+from result_cache import store
+from simulation_config import validate_params
 
 class SimulationGUI:
     def __init__(self, root):
@@ -30,43 +32,24 @@ class SimulationGUI:
         
         # Initialize variables
         self.running = False
-        self.processes = []
-        self.output_queues = []
-        self.socket_path = "/tmp/ipi_water_ipi"
+        self.run_dir = None
+        self.run_params = None
+        self.stop_event = threading.Event()
+        self.ui_calls = queue.Queue()
         
         # Create all widgets
         self.create_widgets(main_frame)
         
+        # Worker threads only post text and callbacks; the Tk main loop
+        # does all widget updates
+        self.console_log = ConsolePipeline(root, self.console)
+        self.root.after(100, self.process_ui_calls)
+        
     def on_closing(self):
         """Handle window closing event"""
         if self.running:
             self.stop_simulation()
-            
-        # Move any remaining files
-        work_dir_name = self.work_dir.get()
-        
-        # Get the parent directory of the current script
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        work_dir = os.path.normpath(os.path.join(script_dir, '..', work_dir_name))
-        
-        files_to_move = ['input.xml', 'init.xyz', 'water.data', 'in.water_ipi', 'log.lammps']
-        
-        for file in files_to_move:
-            if os.path.exists(file):
-                try:
-                    dest_path = os.path.join(work_dir, file)
-                    
-                    # Ensure destination directory exists
-                    os.makedirs(work_dir, exist_ok=True)
-                    
-                    # Remove existing file at destination if it exists
-                    if os.path.exists(dest_path):
-                        os.remove(dest_path)
-                    
-                    # Move the file
-                    os.rename(file, dest_path)
-                except Exception as e:
-                    print(f"Error moving {file}: {str(e)}")
+        self.console_log.close_log()
         
         # Destroy the window
         self.root.destroy()
@@ -104,6 +87,17 @@ class SimulationGUI:
             ("Total Steps", "total_steps", "80000"),
             ("Output Stride", "stride", "100"),
             ("Thermostat τ (fs)", "tau", "100"),
+            ("Driver Clients", "nclients", "1"),
+            ("Socket Host", "host", "localhost"),
+            ("Socket Port (0: auto)", "port", "0"),
+            ("Checkpoint Stride", "checkpoint_stride", "1000"),
+            ("Target Errors", "target_errors", ""),
+            ("Contracted Beads (0: off)", "rpc_beads", "0"),
+            ("MTS Inner Steps", "mts_steps", "1"),
+            ("Write Forces (0/1)", "write_forces", "0"),
+            ("Chunk Frames (0: off)", "chunk_frames", "0"),
+            ("Water Molecules", "nmolecules", "1"),
+            ("Density (g/cm³)", "density", "0.997"),
         ]
         
         for i, (label, key, default) in enumerate(parameters):
@@ -144,6 +138,51 @@ class SimulationGUI:
                                          width=7,
                                          state="readonly")
         thermostat_dropdown.grid(row=row, column=3, padx=5, pady=2)
+
+        # Add force driver dropdown
+        row += 1
+        ttk.Label(param_frame, text="Force Driver:").grid(
+            row=row, column=0, padx=5, pady=2, sticky="w")
+        
+        self.driver = tk.StringVar(value="lammps")
+        driver_options = ["lammps", "numpy"]
+        driver_dropdown = ttk.Combobox(param_frame,
+                                     textvariable=self.driver,
+                                     values=driver_options,
+                                     width=7,
+                                     state="readonly")
+        driver_dropdown.grid(row=row, column=1, padx=5, pady=2)
+
+        # Add boundary dropdown: periodic box with PPPM or isolated cluster
+        ttk.Label(param_frame, text="Boundary:").grid(
+            row=row, column=2, padx=5, pady=2, sticky="w")
+        
+        self.boundary = tk.StringVar(value="periodic")
+        boundary_options = ["periodic", "cluster"]
+        boundary_dropdown = ttk.Combobox(param_frame,
+                                       textvariable=self.boundary,
+                                       values=boundary_options,
+                                       width=7,
+                                       state="readonly")
+        boundary_dropdown.grid(row=row, column=3, padx=5, pady=2)
+
+        # Add socket mode dropdown: inet lets drivers run on other nodes
+        row += 1
+        ttk.Label(param_frame, text="Socket Mode:").grid(
+            row=row, column=0, padx=5, pady=2, sticky="w")
+        
+        self.socket_mode = tk.StringVar(value="unix")
+        socket_mode_dropdown = ttk.Combobox(param_frame,
+                                          textvariable=self.socket_mode,
+                                          values=["unix", "inet"],
+                                          width=7,
+                                          state="readonly")
+        socket_mode_dropdown.grid(row=row, column=1, padx=5, pady=2)
+
+        # Profile i-PI and the drivers (written to profiles/ in the run directory)
+        self.profile = tk.IntVar(value=0)
+        ttk.Checkbutton(param_frame, text="Profile i-PI and drivers", variable=self.profile).grid(
+            row=row, column=2, columnspan=2, padx=5, pady=2, sticky="w")
         
         current_row += 1
         
@@ -160,15 +199,27 @@ class SimulationGUI:
         self.stop_btn = ttk.Button(btn_frame, text="Stop Simulation", 
                                  command=self.stop_simulation, state=tk.DISABLED)
         self.stop_btn.pack(side=tk.LEFT, padx=5)
+        
+        # Continue the run in the working directory from its last checkpoint
+        self.resume_btn = ttk.Button(btn_frame, text="Resume Simulation",
+                                   command=lambda: self.start_simulation(resume=True))
+        self.resume_btn.pack(side=tk.LEFT, padx=5)
         current_row += 1
         
-        # Output Console Frame
-        console_frame = ttk.LabelFrame(frame, text="Simulation Output")
-        console_frame.grid(row=current_row, column=0, columnspan=2, sticky="nsew", pady=5)
+        # Output tabs: console and live property plots
+        output_tabs = ttk.Notebook(frame)
+        output_tabs.grid(row=current_row, column=0, columnspan=2, sticky="nsew", pady=5)
         frame.rowconfigure(current_row, weight=1)
         
+        console_frame = ttk.Frame(output_tabs)
+        output_tabs.add(console_frame, text="Simulation Output")
         self.console = scrolledtext.ScrolledText(console_frame, height=20)
         self.console.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        # Follows simulation.out by file offset, so each refresh only
+        # parses the rows i-PI appended since the previous one
+        self.dashboard = LiveDashboard(output_tabs)
+        output_tabs.add(self.dashboard.frame, text="Live Properties")
         current_row += 1
         
         # Status Bar
@@ -178,294 +229,151 @@ class SimulationGUI:
         status_label.grid(row=current_row, column=0, columnspan=2, pady=5, sticky="w")
 
     def log_message(self, message):
-        """Add timestamped message to console"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        self.console.insert(tk.END, f"[{timestamp}] {message}\n")
-        self.console.see(tk.END)
-        
-    def check_socket_exists(self):
-        """Check if the IPI socket file exists"""
-        return os.path.exists(self.socket_path)
+        """Add timestamped message to console (safe from any thread)"""
+        self.console_log.post(message)
 
-    def wait_for_socket(self, timeout=30):
-        """Wait for the IPI socket file to appear"""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            if self.check_socket_exists():
-                return True
-            time.sleep(0.1)
-        return False
-        
-    def start_simulation(self):
-        if not self.running:
-            self.running = True
-            self.start_btn.configure(state=tk.DISABLED)
-            self.stop_btn.configure(state=tk.NORMAL)
-            self.console.delete(1.0, tk.END)
-            
-            # Remove existing socket file if it exists
-            if self.check_socket_exists():
-                try:
-                    os.remove(self.socket_path)
-                    self.log_message("Removed existing socket file")
-                except OSError as e:
-                    self.log_message(f"Warning: Could not remove old socket file: {e}")
-            
-            self.status_var.set("Simulation running...")
-            self.output_queues = [queue.Queue(), queue.Queue()]
-            threading.Thread(target=self.run_simulation).start()
+    def call_in_main(self, function, *args):
+        """Run function(*args) on the Tk main loop (safe from any thread)"""
+        self.ui_calls.put((function, args))
 
-    def stop_simulation(self):
-        if self.running:
-            self.running = False
-            self.status_var.set("Stopping simulation...")
-            
-            # Terminate all processes
-            for process in self.processes:
-                if process and process.poll() is None:
-                    try:
-                        process.terminate()
-                        process.wait(timeout=5)
-                    except subprocess.TimeoutExpired:
-                        process.kill()
-            
-            self.processes = []
-            
-            # Clean up socket file
-            if self.check_socket_exists():
-                try:
-                    os.remove(self.socket_path)
-                    self.log_message("Cleaned up socket file")
-                except OSError as e:
-                    self.log_message(f"Warning: Could not remove socket file: {e}")
-            
-            self.start_btn.configure(state=tk.NORMAL)
-            self.stop_btn.configure(state=tk.DISABLED)
-            self.status_var.set("Simulation stopped")
-    
-    def monitor_process(self, process, name):
-        """Monitor a process and log if it exits unexpectedly"""
-        while self.running:
-            if process.poll() is not None:
-                exit_code = process.poll()
-                self.log_message(f"{name} process exited unexpectedly with code {exit_code}")
-                self.stop_simulation()
+    def process_ui_calls(self):
+        while True:
+            try:
+                function, args = self.ui_calls.get_nowait()
+            except queue.Empty:
                 break
-            time.sleep(0.5)
-
-    def ensure_work_dir(self):
-        """Create working directory if it doesn't exist"""
-        work_dir_name = self.work_dir.get()
-        if not work_dir_name:
-            raise ValueError("Working directory name cannot be empty")
-        
-        # Get the parent directory of the current script
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        work_dir = os.path.normpath(os.path.join(script_dir, '..', work_dir_name))
-            
-        # Create directory if it doesn't exist
-        if not os.path.exists(work_dir):
-            os.makedirs(work_dir)
-            self.log_message(f"Created working directory: {work_dir}")
-        return work_dir
-
-    def update_xml(self):
-        """Update the input.xml file with current parameter values"""
-        work_dir = self.ensure_work_dir()
-        
-        # Log current parameter values
-        self.log_message("Current parameter values:")
-        for key, var in self.params.items():
-            self.log_message(f"  {key}: {var.get()}")
-        
-        xml_content = f'''<simulation verbosity='high'>
-    <output prefix='{os.path.join(work_dir, "simulation")}'>
-        <properties stride='{self.params["stride"].get()}' filename='out'>  [ step, time{{picosecond}}, temperature{{kelvin}}, 
-            conserved{{electronvolt}}, potential{{electronvolt}}, kinetic_cv{{electronvolt}} ] </properties>
-        <trajectory filename='pos' stride='{self.params["stride"].get()}'> positions{{angstrom}} </trajectory>
-    </output>
-    <total_steps>{self.params["total_steps"].get()}</total_steps>
-    <prng><seed>32345</seed></prng>
-    <ffsocket mode='unix' name='water_ipi'>
-        <address>water_ipi</address>
-        <port>32345</port>
-    </ffsocket>
-    <system>
-        <initialize nbeads='{self.params["nbeads"].get()}'>
-            <file mode='xyz'> {os.path.join(work_dir, "init.xyz")} </file>
-            <cell mode='abc'> [20.0, 20.0, 20.0] </cell>
-        </initialize>
-        <forces><force forcefield='water_ipi'></force></forces>
-        <ensemble>
-            <temperature units='kelvin'>{self.params["temperature"].get()}</temperature>
-        </ensemble>
-        <motion mode='dynamics'>
-            <dynamics mode='{self.dynamics_mode.get()}'>
-                <timestep units='femtosecond'>{self.params["timestep"].get()}</timestep>
-                <thermostat mode='{self.thermostat_mode.get()}'>
-                    <tau units='femtosecond'>{self.params["tau"].get()}</tau>
-                </thermostat>
-            </dynamics>
-        </motion>
-    </system>
-</simulation>'''
-
-        # Write the XML file to working directory
-        xml_path = os.path.join(work_dir, 'input.xml')
-        try:
-            with open(xml_path, 'w') as f:
-                f.write(xml_content)
-            self.log_message(f"Created input.xml in {work_dir}")
-            
-            # Create init.xyz in working directory
-            xyz_path = os.path.join(work_dir, 'init.xyz')
-            with open(xyz_path, 'w') as f:
-                f.write("""3
-Water molecule
-O     0.000   0.000   0.000
-H     0.958   0.000   0.000
-H    -0.239   0.927   0.000
-""")
-            self.log_message(f"Created init.xyz in {work_dir}")
-            
-        except Exception as e:
-            self.log_message(f"Error writing files: {str(e)}")
-            raise
+            function(*args)
+        self.root.after(100, self.process_ui_calls)
         
-        # Write the XML file
+    def start_simulation(self, resume=False):
+        if self.running:
+            return
         try:
-            with open('input.xml', 'w') as f:
-                f.write(xml_content)
-            
-            # Verify the file was written correctly
-            with open('input.xml', 'r') as f:
-                written_content = f.read()
-                self.log_message("Verifying XML file content:")
-                self.log_message(written_content)
-                
-        except Exception as e:
-            self.log_message(f"Error writing XML file: {str(e)}")
-            raise
-            
-    def run_simulation(self):
+            work_dir = work_dir_path(self.work_dir.get())
+            # Worker threads use this snapshot instead of reading the widgets
+            self.run_params = validate_params(self.get_params())
+        except ValueError as e:
+            self.log_message(f"Error: {e}")
+            self.status_var.set("Invalid parameters")
+            return
+        self.running = True
+        self.run_dir = work_dir
+        self.stop_event = threading.Event()
+        self.start_btn.configure(state=tk.DISABLED)
+        self.resume_btn.configure(state=tk.DISABLED)
+        self.stop_btn.configure(state=tk.NORMAL)
+        self.console_log.clear()
+        self.status_var.set("Simulation running...")
+        threading.Thread(target=self.simulation_worker, args=(work_dir, resume)).start()
+
+    def stop_simulation(self):
+        """Ask the running simulation to stop; simulation_finished() resets the buttons"""
+        if self.running and not self.stop_event.is_set():
+            self.stop_event.set()
+            self.stop_btn.configure(state=tk.DISABLED)
+            self.status_var.set("Stopping simulation...")
+
+    def simulation_worker(self, work_dir, resume):
+        """Run the simulation with the launcher core that pimd_cli.py uses as well (worker thread)"""
+        result = None
         try:
-            # Clean up any existing files
-            if os.path.exists('input.xml'):
-                os.remove('input.xml')
-                self.log_message("Removed existing input.xml")
-            
-            # Update input.xml with current parameters
-            self.update_xml()
-            self.log_message("Created new input.xml with current parameters")
-            
-            # Start I-PI process with environment variable to increase socket timeout
-            env = os.environ.copy()
-            env['IPI_TIMEOUT'] = '600'  # 10 minutes timeout
-            
-            self.log_message("Starting I-PI process...")
-            ipi_process = subprocess.Popen(
-                [sys.executable, 'run_ipi.py'],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                bufsize=1,
-                env=env
-            )
-            self.processes.append(ipi_process)
-            
-            # Start process monitor for I-PI
-            threading.Thread(
-                target=self.monitor_process,
-                args=(ipi_process, "I-PI"),
-                daemon=True
-            ).start()
-            
-            # Start output reader for I-PI
-            threading.Thread(
-                target=self.read_output,
-                args=(ipi_process, self.output_queues[0], "I-PI"),
-                daemon=True
-            ).start()
-            
-            # Wait for socket file to appear
-            self.log_message("Waiting for I-PI to initialize...")
-            if not self.wait_for_socket():
-                raise Exception("Timeout waiting for I-PI socket file")
-            
-            self.log_message("I-PI socket file detected, starting LAMMPS...")
-            
-            # Additional delay to ensure I-PI is fully initialized
-            time.sleep(5)
-            
-            # Start LAMMPS process with environment variable for socket timeout
-            env = os.environ.copy()
-            env['LAMMPS_IPI_TIMEOUT'] = '600'  # 10 minutes timeout
-            
-            lammps_process = subprocess.Popen(
-                [sys.executable, 'run_lammps.py'],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                bufsize=1,
-                env=env
-            )
-            self.processes.append(lammps_process)
-            
-            # Start output reader for LAMMPS
-            threading.Thread(
-                target=self.read_output,
-                args=(lammps_process, self.output_queues[1], "LAMMPS"),
-                daemon=True
-            ).start()
-            
-            # Start output processor
-            self.process_output()
-            
+            if not os.path.exists(work_dir):
+                os.makedirs(work_dir)
+                self.log_message(f"Created working directory: {work_dir}")
+            self.console_log.open_log(os.path.join(work_dir, "gui_console.log"), append=resume)
+            self.log_message("Current parameter values:")
+            for key, value in self.run_params.items():
+                self.log_message(f"  {key}: {value}")
+            if not resume:
+                self.archive_previous_run(work_dir)
+            # A cached run has nothing to profile
+            result = run_simulation(self.run_params, work_dir, resume=resume,
+                                    use_cache=not int(self.run_params["profile"]),
+                                    on_event=self.on_run_event, stop_event=self.stop_event)
         except Exception as e:
             self.log_message(f"Error starting simulation: {str(e)}")
-            self.stop_simulation()
-    
-    def read_output(self, process, output_queue, prefix):
-        try:
-            for line in process.stdout:
-                if self.running:
-                    output_queue.put(f"[{prefix}] {line.strip()}")
-                else:
-                    break
-        except Exception as e:
-            output_queue.put(f"[{prefix}] Error reading output: {str(e)}")
-        finally:
-            output_queue.put(None)  # Signal that the process has ended
-    
-    def process_output(self):
-        # Process any pending output from both queues
-        for q in self.output_queues:
-            try:
-                while True:
-                    line = q.get_nowait()
-                    if line is None:  # Process has ended
-                        break
-                    self.log_message(line)
-            except queue.Empty:
-                pass
-        
-        # Check processes status
-        all_finished = True
-        for process in self.processes:
-            if process and process.poll() is None:
-                all_finished = False
-                break
-        
-        if self.running and not all_finished:
-            self.root.after(100, self.process_output)
+        self.call_in_main(self.simulation_finished, result)
+
+    def on_run_event(self, event):
+        """Show an event of the processes or of the run (worker thread)"""
+        if event.kind == "output":
+            self.log_message(f"[{event.name}] {event.text.strip()}")
+        elif event.kind == "exit":
+            if event.returncode != 0:
+                self.log_message(f"{event.name} process exited unexpectedly with code {event.returncode}")
+        elif event.kind == "progress":
+            self.call_in_main(self.status_var.set, event.text)
         else:
-            if self.running:  # If we were running but all processes finished
-                self.log_message("All processes have finished")
-                self.stop_simulation()
+            self.log_message(event.text)
+            if event.kind == "started":
+                self.call_in_main(self.start_progress)
+
+    def simulation_finished(self, result):
+        """Report the outcome of a run and reset the buttons (main thread)"""
+        self.running = False
+        self.start_btn.configure(state=tk.NORMAL)
+        self.resume_btn.configure(state=tk.NORMAL)
+        self.stop_btn.configure(state=tk.DISABLED)
+        if result is None:
+            self.status_var.set("Simulation failed to start")
+        elif result.get("cached"):
+            self.dashboard.reset(os.path.join(self.run_dir, "simulation.out"))
+            self.status_var.set("Loaded cached result")
+        else:
+            self.dashboard.update()
+            if result["success"]:
+                timing = result["timing"]
+                self.log_message(f"I-PI finished: {timing['time_per_step']:.4f} s per step "
+                                 f"with {timing['nclients']} driver client(s) for {timing['nbeads']} beads")
+                if timing.get("steps_saved"):
+                    self.log_message(f"Stopped early at step {timing['steps_done']}, "
+                                     f"{timing['steps_saved']} steps saved")
+                self.status_var.set("Simulation finished")
+            elif result.get("stopped"):
+                self.status_var.set("Simulation stopped")
+            else:
+                error = result.get("error") or f"I-PI exited with code {result.get('ipi_returncode')}"
+                self.log_message(f"Simulation failed: {error}")
+                self.status_var.set("Simulation failed")
+        self.console_log.close_log()
+
+    def archive_previous_run(self, work_dir):
+        """Add a finished run left in work_dir to the cache before it is overwritten"""
+        if not (os.path.exists(os.path.join(work_dir, "timing.json"))
+                and os.path.exists(os.path.join(work_dir, "run_params.json"))):
+            return
+        try:
+            store(work_dir)
+            self.log_message(f"Stored the earlier run in {work_dir} in the result cache")
+        except (OSError, ValueError) as e:
+            self.log_message(f"Warning: Could not store the earlier run in the cache: {e}")
+
+    def get_params(self):
+        """Return the current parameter values as a dictionary"""
+        params = {key: var.get() for key, var in self.params.items()}
+        params["dynamics_mode"] = self.dynamics_mode.get()
+        params["thermostat_mode"] = self.thermostat_mode.get()
+        params["driver"] = self.driver.get()
+        params["boundary"] = self.boundary.get()
+        params["socket_mode"] = self.socket_mode.get()
+        params["profile"] = self.profile.get()
+        return params
+
+    def start_progress(self):
+        """Follow the simulation.out of the new run once the drivers are started (main thread)"""
+        self.dashboard.reset(os.path.join(self.run_dir, "simulation.out"))
+        self.refresh_progress()
+
+    def refresh_progress(self):
+        """Update the property plots while running; the status line comes with the progress events"""
+        if not self.running:
+            return
+        self.dashboard.update()
+        self.root.after(1000, self.refresh_progress)
 
 def main():
     root = tk.Tk()
-    app = SimulationGUI(root)
+    SimulationGUI(root)
     root.mainloop()
 
 if __name__ == "__main__":
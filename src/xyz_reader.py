@@ -0,0 +1,139 @@
+"""Fast reader for the XYZ trajectories written by i-PI
+
+Frames are parsed in blocks with NumPy's C text parser and written straight
+into a preallocated array, so memory stays close to the size of the result.
+Frame ranges and strides are selected before parsing; skipped frames are
+only scanned for line ends. A truncated last frame (from a simulation that
+is still running) is ignored. Trajectories compressed into gzip chunks
+(see trajectory_chunks.py) are read the same way.
+
+Example:
+    from xyz_reader import read_run
+    positions = read_run('../pimd_run_1')           # (beads, frames, atoms, 3)
+    every_10th = read_run('../pimd_run_1', step=10)
+"""
+import collections
+import itertools
+import os
+import re
+
+import numpy as np
+
+from trajectory_chunks import open_trajectory, trajectory_paths
+
+
+def read_header(filename):
+    """Return the number of atoms, the atom names and the first comment line"""
+    with open_trajectory(filename) as f:
+        natoms = int(f.readline())
+        comment = f.readline().decode().rstrip("\n")
+        names = [f.readline().split()[0].decode() for _ in range(natoms)]
+    return natoms, names, comment
+
+
+def count_frames(filename, natoms, chunk_size=1 << 24):
+    """Return the number of complete frames in an XYZ file"""
+    nlines = 0
+    with open_trajectory(filename) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            nlines += chunk.count(b'\n')
+    return nlines // (natoms + 2)
+
+
+def _skip_lines(f, nlines):
+    collections.deque(itertools.islice(f, nlines), maxlen=0)
+
+
+def parse_frames(lines, natoms):
+    """Parse a list of complete frames (count, comment and atom lines)
+
+    The atom-count and comment lines are removed from lines in place.
+
+    Returns:
+        tuple: positions of shape (frames, natoms, 3) and the comment lines
+    """
+    lines_per_frame = natoms + 2
+    comments = lines[1::lines_per_frame]
+    del lines[0::lines_per_frame]
+    del lines[0::lines_per_frame - 1]
+    positions = np.loadtxt(lines, usecols=(1, 2, 3), dtype=np.float64, ndmin=2)
+    return positions.reshape(-1, natoms, 3), comments
+
+
+def select_frames(nframes, start=None, stop=None, step=None):
+    """Return the range of frame indices selected by start:stop:step"""
+    if step is not None and step < 1:
+        raise ValueError("step must be a positive integer")
+    return range(nframes)[slice(start, stop, step)]
+
+
+def read_xyz(filename, start=None, stop=None, step=None, out=None, nframes=None, block_frames=4096):
+    """Read frames start:stop:step of an XYZ trajectory
+
+    Args:
+        filename: XYZ file
+        start, stop, step: frame selection with slice semantics (step > 0)
+        out: optional preallocated (frames, atoms, 3) array to fill
+        nframes: number of frames to consider (default: all complete frames)
+        block_frames: number of frames parsed per NumPy call
+
+    Returns:
+        numpy.ndarray: positions of shape (frames, atoms, 3)
+    """
+    natoms = read_header(filename)[0]
+    lines_per_frame = natoms + 2
+    if nframes is None:
+        nframes = count_frames(filename, natoms)
+    frames = select_frames(nframes, start, stop, step)
+    if out is None:
+        out = np.empty((len(frames), natoms, 3))
+    if len(frames) == 0:
+        return out
+
+    with open_trajectory(filename) as f:
+        _skip_lines(f, frames.start * lines_per_frame)
+        gap = (frames.step - 1) * lines_per_frame
+        filled = 0
+        while filled < len(frames):
+            count = min(block_frames, len(frames) - filled)
+            if gap:
+                block = []
+                for index in range(count):
+                    if filled + index > 0:
+                        _skip_lines(f, gap)
+                    block.extend(itertools.islice(f, lines_per_frame))
+            else:
+                block = list(itertools.islice(f, count * lines_per_frame))
+
+            out[filled:filled + count] = parse_frames(block, natoms)[0]
+            filled += count
+    return out
+
+
+def bead_files(run_dir, prefix="simulation", name="pos"):
+    """Return the per-bead trajectory files of a run ordered by bead index (also compressed ones)"""
+    files = trajectory_paths(os.path.join(run_dir, f"{prefix}.{name}_*.xyz"))
+    return sorted(files, key=lambda path: int(re.search(r"_(\d+)\.xyz$", path).group(1)))
+
+
+def read_beads(files, start=None, stop=None, step=None):
+    """Read several bead trajectories into one (beads, frames, atoms, 3) array
+
+    Only frames that are complete in every file are used, so the beads of a
+    running simulation stay aligned.
+    """
+    if not files:
+        raise FileNotFoundError("No trajectory files to read")
+    natoms = read_header(files[0])[0]
+    nframes = min(count_frames(path, natoms) for path in files)
+    frames = select_frames(nframes, start, stop, step)
+
+    positions = np.empty((len(files), len(frames), natoms, 3))
+    for bead, path in enumerate(files):
+        read_xyz(path, frames.start, frames.stop, frames.step, out=positions[bead], nframes=nframes)
+    return positions
+
+
+def read_run(run_dir, start=None, stop=None, step=None, prefix="simulation"):
+    """Read all bead position trajectories of a run directory"""
+    return read_beads(bead_files(run_dir, prefix), start, stop, step)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from qtip4pf_driver import compute_qtip4pf, lammps_forces, numerical_forces, test_geometries as geometries
+
+
+def test_forces_match_finite_differences():
+    cluster = geometries(nmol=4, count=1)[0]
+    analytic = compute_qtip4pf(cluster, None)[1]
+    assert np.max(np.abs(analytic - numerical_forces(cluster, None))) < 1e-4
+
+
+def test_single_molecule_forces_do_not_depend_on_the_cell():
+    molecule = geometries(nmol=1, count=1)[0]
+    energy, forces, _ = compute_qtip4pf(molecule, None)
+    periodic_energy, periodic_forces, _ = compute_qtip4pf(molecule, 20.0 * np.eye(3))
+    assert periodic_energy == energy
+    assert np.array_equal(periodic_forces, forces)
+
+
+def test_cluster_virial():
+    cluster = geometries(nmol=4, count=1)[0]
+    _, forces, virial = compute_qtip4pf(cluster, None)
+    assert np.max(np.abs(virial - np.einsum('ai,aj->ij', cluster, forces))) < 1e-8
+
+
+def test_periodic_molecules_are_refused():
+    cluster = geometries(nmol=4, count=1)[0]
+    with pytest.raises(ValueError):
+        compute_qtip4pf(cluster, 20.0 * np.eye(3))
+    # The intramolecular part has no periodic sum
+    compute_qtip4pf(cluster, 20.0 * np.eye(3), part="intra")
+
+
+@pytest.mark.parametrize("boundary, cell, tolerance", [("periodic", 20.0 * np.eye(3), 0.05), ("cluster", None, 1e-6)])
+def test_forces_match_lammps(boundary, cell, tolerance):
+    pytest.importorskip("lammps")
+    molecules = geometries(nmol=1, count=10)
+    reference = lammps_forces(molecules, boundary)
+    deviation = max(np.max(np.abs(compute_qtip4pf(g, cell)[1] - f)) for g, (_, f) in zip(molecules, reference))
+    assert deviation < tolerance
@@ -0,0 +1,14 @@
+from result_cache import run_key
+from simulation_config import DEFAULT_PARAMS
+
+
+def test_run_key_of_default_params():
+    assert len(run_key(DEFAULT_PARAMS)) == 64
+
+
+def test_run_key_ignores_number_format():
+    assert run_key(DEFAULT_PARAMS) == run_key(dict(DEFAULT_PARAMS, temperature="300.0", nbeads="32", rpc_beads="0"))
+
+
+def test_run_key_changes_with_physical_params():
+    assert run_key(DEFAULT_PARAMS) != run_key(dict(DEFAULT_PARAMS, temperature=301))
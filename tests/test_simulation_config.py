@@ -0,0 +1,34 @@
+import re
+
+import pytest
+
+from simulation_config import DEFAULT_PARAMS, build_input_xml, cell_length, validate_params
+from water_box import water_box
+
+
+def xml_cell(params):
+    xml = build_input_xml(params, "RUN_DIR", "SOCKET")
+    match = re.search(r"<cell mode='abc' units='angstrom'> \[([^,]+),", xml)
+    assert match, "input.xml has no cell in angstrom"
+    return float(match.group(1))
+
+
+def test_cell_of_single_molecule():
+    assert xml_cell(DEFAULT_PARAMS) == cell_length(DEFAULT_PARAMS)
+
+
+def test_cell_matches_water_box():
+    params = dict(DEFAULT_PARAMS, nmolecules=32)
+    _, length = water_box(32, DEFAULT_PARAMS["density"])
+    assert abs(xml_cell(params) - length) < 1e-9
+    assert abs(cell_length(params) - length) < 1e-9
+
+
+def test_numpy_driver_refuses_periodic_boxes():
+    with pytest.raises(ValueError):
+        validate_params({"driver": "numpy", "nmolecules": "64", "boundary": "periodic"})
+    with pytest.raises(ValueError):
+        build_input_xml(dict(DEFAULT_PARAMS, driver="numpy", nmolecules=64), "RUN_DIR", "SOCKET")
+    validate_params({"driver": "numpy", "nmolecules": "64", "boundary": "cluster"})
+    validate_params({"driver": "numpy", "nmolecules": "1", "boundary": "periodic"})
+    validate_params({"driver": "lammps", "nmolecules": "64", "boundary": "periodic"})
@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+
+from virial_estimator import KB_EV, CentroidVirialEstimator, centroid_virial, compare_with_ipi
+
+TEMPERATURE = 300.0
+K_SPRING = 2.0  # eV/Angstrom^2
+
+
+def harmonic_beads(nbeads=8, nframes=5, natoms=3, seed=1):
+    """Return positions and forces of beads in a harmonic well around a fixed point, and the exact K_cv
+
+    With F = -k (r - a) the virial term is -k sum |r_i - r_c|^2, whatever a is.
+    """
+    rng = np.random.default_rng(seed)
+    positions = rng.normal(scale=0.1, size=(nbeads, nframes, natoms, 3)) + rng.normal(size=(natoms, 3))
+    forces = -K_SPRING * (positions - np.array([0.3, -0.2, 0.1]))
+    spread = np.sum((positions - positions.mean(axis=0))**2, axis=(0, 2, 3))
+    expected = 1.5 * natoms * KB_EV * TEMPERATURE + 0.5 * K_SPRING * spread / nbeads
+    return positions, forces, expected
+
+
+def test_centroid_virial_of_harmonic_beads():
+    positions, forces, expected = harmonic_beads()
+    assert np.allclose(centroid_virial(positions, forces, TEMPERATURE), expected, rtol=1e-12)
+
+
+def test_centroid_virial_of_one_bead_is_classical():
+    positions, forces, _ = harmonic_beads(nbeads=1)
+    assert np.allclose(centroid_virial(positions, forces, TEMPERATURE), 1.5 * 3 * KB_EV * TEMPERATURE)
+
+
+def write_trajectories(run_dir, name, arrays, units, stride=10):
+    for bead, frames in enumerate(arrays):
+        with open(os.path.join(run_dir, f"simulation.{name}_{bead}.xyz"), 'w') as f:
+            for frame, atoms in enumerate(frames):
+                f.write(f"{len(atoms)}\n# CELL(abcABC): 20 20 20 90 90 90 Step: {frame * stride} Bead: {bead} "
+                        f"{'positions' if name == 'pos' else 'forces'}{{{units}}} cell{{angstrom}}\n")
+                f.writelines(f"{atom} {x:.10f} {y:.10f} {z:.10f}\n" for atom, (x, y, z) in zip("OHH", atoms))
+
+
+def test_estimator_matches_ipi_kinetic_cv(tmp_path):
+    positions, forces, expected = harmonic_beads()
+    write_trajectories(tmp_path, "pos", positions, "angstrom")
+    write_trajectories(tmp_path, "for", forces, "ev/ang")
+    with open(tmp_path / "simulation.out", 'w') as f:
+        f.write("# column   1    --> step : The current simulation time step.\n"
+                "# column   2    --> kinetic_cv{electronvolt} : The centroid-virial quantum kinetic energy.\n")
+        f.writelines(f"{10 * frame} {value:.10e}\n" for frame, value in enumerate(expected))
+
+    estimator = CentroidVirialEstimator(str(tmp_path), temperature=TEMPERATURE)
+    assert estimator.update() == len(expected)
+    assert abs(estimator.average.mean - expected.mean()) < 1e-8
+    comparison = compare_with_ipi(str(tmp_path))
+    assert comparison["frames"] == len(expected)
+    assert comparison["max_rel"] < 1e-6